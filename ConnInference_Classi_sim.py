@@ -21,6 +21,11 @@ import tensorflow as tf
 nJobs  = 75 #Number of jobs
 N      = 75 #Number of neurons in network
 nCross = 10 #Number of cross-validations
+nPerm  = 0  #Number of label-shuffled replicas per pair for p-values (batched only, uses __classLogitPairs__)
+
+batched  = False #Train all decoding cells and folds of a target in a single graph
+screened = False #Only classify the pairs passing a cheap screening (see OCM.screenPairs)
+minT     = 3.    #Screening threshold on Welch's t statistic
 
 path  =  '/groups/turaga/home/castonguayp/research/' + \
          'optoConn/classiMat/perceptron/simulClassi/'
@@ -60,25 +65,116 @@ def allNclassi(target):
         G,D,L = OCM.simul(argDict, run = True, graph = G)
 
         acc[decode-1] = G.AccTe
+
+    G.close()
         
     return acc
 
+
+def allNclassiBatch(target):
+    #Classify all neurons and all cross-validations in a single batched graph
+
+    argDict = {    
+                 'seqRange'   : [[-5, 0],[0,20]], 
+                 'actfct'     : tf.nn.relu, 
+                 'nbIters'    : 1500, 
+                 'keepProb'   : 0.5,
+                 'sparsW'     : .000005,   
+                 'nhidclassi' : 100,
+                 'dataset'    : 'stblock_N01_30Hz_25obs_20spar_Opto.npy',
+                 'model'      : '__classLogitPairs__' if nPerm else '__classOptoNNPairs__',
+                 'multiLayer' : 3,
+                 'method'     : 3,
+                 'learnRate'  : 0.0005,   
+                 'detail'     : False, 
+                 'batchSize'  : 1,
+                 'ctrl'       : 'noStim',
+                 'pairs'      : [[target,decode] for decode in range(1,N+1)],
+                 'nFolds'     : nCross,
+                 'nNull'      : nPerm
+                }
+
+    G,D,L = OCM.simul(argDict, run = True)
+    G.close()
+
+    #Accuracy for each cross-validation (nCross x N) and p-values (N)
+    pVal = G.pVal[0] if nPerm else np.zeros(N)*np.nan
+    return G.accAll[:,0,:], pVal
+
+
+def allNclassiScreened():
+    #Screen all pairs, then classify the escalated ones in a single batched graph
+
+    argDict = {    
+                 'seqRange'   : [[-5, 0],[0,20]], 
+                 'actfct'     : tf.nn.relu, 
+                 'nbIters'    : 1500, 
+                 'keepProb'   : 0.5,
+                 'sparsW'     : .000005,   
+                 'nhidclassi' : 100,
+                 'dataset'    : 'stblock_N01_30Hz_25obs_20spar_Opto.npy',
+                 'multiLayer' : 3,
+                 'method'     : 3,
+                 'learnRate'  : 0.0005,   
+                 'detail'     : False, 
+                 'batchSize'  : 1,
+                 'ctrl'       : 'noStim',
+                 'targets'    : list(range(1,N+1)),
+                 'nFolds'     : nCross
+                }
+
+    screen = OCM.screenPairs(argDict, stat = 't', threshold = minT)
+
+    #Accuracy for each cross-validation (nCross x N x N)
+    return screen['map'], screen['escalated']
+
+
 t = time.time()
-#Cross-validationww
-for cross in range(0,nCross):
-    saveName = mSaveName + '_cross_' + str(cross)
 
-    print('Saving in '+ path + saveName)
+if screened:
+    accCross, escalated = allNclassiScreened()
+    print('\nTotal time:  ' + str(datetime.timedelta(seconds = time.time()-t)))
+
+    np.save(path + mSaveName + '_escalated', escalated)
+    for cross in range(0,nCross):
+        saveName = mSaveName + '_cross_' + str(cross)
+        print('Saving in '+ path + saveName)
+        np.save(path+saveName,accCross[cross])
 
-    #Executing in parralle
-    accAll = Parallel(n_jobs=nJobs)( delayed(allNclassi)(i) 
-		                             for i in np.arange(1,N+1) )
+elif batched:
+    #Executing in parralle, all cross-validations at once
+    out = Parallel(n_jobs=nJobs)( delayed(allNclassiBatch)(i) 
+                                  for i in np.arange(1,N+1) )
 
-    #Stacking into a single matrix
-    accAll = np.vstack(accAll)
+    #Stacking into a matrix per cross-validation (nCross x N x N)
+    accCross = np.stack([acc for acc, _ in out], axis = 1)
     print('\nTotal time:  ' + str(datetime.timedelta(seconds = time.time()-t)))
 
-    np.save(path+saveName,accAll)
+    if nPerm:
+        #Permutation p-values of all pairs (N x N)
+        np.save(path + mSaveName + '_pVal', np.vstack([p for _, p in out]))
+
+    for cross in range(0,nCross):
+        saveName = mSaveName + '_cross_' + str(cross)
+        print('Saving in '+ path + saveName)
+        np.save(path+saveName,accCross[cross])
+
+else:
+    #Cross-validationww
+    for cross in range(0,nCross):
+        saveName = mSaveName + '_cross_' + str(cross)
+
+        print('Saving in '+ path + saveName)
+
+        #Executing in parralle
+        accAll = Parallel(n_jobs=nJobs)( delayed(allNclassi)(i) 
+    		                             for i in np.arange(1,N+1) )
+
+        #Stacking into a single matrix
+        accAll = np.vstack(accAll)
+        print('\nTotal time:  ' + str(datetime.timedelta(seconds = time.time()-t)))
+
+        np.save(path+saveName,accAll)
 
 #Sending sms when job completed
 #sendSMS('Job completed ;\n'  + mSaveName + '\n\nElapsed time ; ' +
@@ -31,6 +31,21 @@ from tensorflow.python.ops.constant_op import constant  as const
             stimulated or not at t-z. 
 
 
+    '__classOptoNNPairs__' :
+            Stack of independent '__classOptoNN__' classifiers, one for each 
+            (stimulated cell, decoding cell) pair and cross-validation fold. 
+            All the classifiers are trained together in the same session with 
+            batched matrix products, which removes the per pair overhead of 
+            building and launching a graph. 
+
+
+    '__classLogit__', '__classLDA__' (and '...Pairs__') :
+            Regularized logistic regression or shrinkage LDA on the same 
+            sequences as '__classOptoNN__', fitted in closed form with numpy 
+            by linClassiGraph (no tensorflow graph). Used as a fast screen 
+            of the pairs. 
+
+
     '__classOptoRNN__' :
 
             Reccurent neural network with a classifer (logistic) as output layer
@@ -44,6 +59,12 @@ from tensorflow.python.ops.constant_op import constant  as const
             Non linear regressive model that predicts the calcium activity at t+i
             based on the activity of the recorded population. 
 
+    '__NARridge__' :
+
+            Linear variant of '__NAR__' fitted in closed form (ridge regression)
+            with numpy by narRidgeGraph (no tensorflow graph). Gives the exact
+            linear connectivity matrix NAR_W in a single pass over the data.
+
 
 
     '__NGCmodel__' : 
@@ -84,6 +105,9 @@ from tensorflow.python.ops.constant_op import constant  as const
     _masking      : Adding masks in the tensorflow graph that will 
                     be applied to the designed weights after every
                     variables update.
+
+    _loopSteps    : Running multiple training steps in a single session
+                    run (stepsPerRun).
     
     _VNoise       : Adding stochasticity in all the tensorflow graph 
                     variables after every update for a stotastic 
@@ -92,6 +116,9 @@ from tensorflow.python.ops.constant_op import constant  as const
     
     launchGraph   : Will lauch the training of the model
 
+    reset         : Will re-initialize the variables in the session kept
+                    by the graph. close() will close it.
+
     showVars      : Will plot the variables with imshow (matrices)
                     and plot (vectors)
 
@@ -163,7 +190,11 @@ class actConnGraph(object):
 
             #Variable placeholders  
 
-            if 'class' in self.model:
+            if 'Pairs' in self.model:
+                self._Y = tf.placeholder("float32", [self.nPairs, None, 1], name = 'Y')
+                self._X = tf.placeholder("float32", [self.nPairs, None, self.seqLen], name = 'X') 
+                self._keepProb =  tf.placeholder("float32", [] , name = 'keepProb') 
+            elif 'class' in self.model:
                 self._Y = tf.placeholder("float32", [None,1], name = 'Y')
                 self._X = tf.placeholder("float32", [None, self.seqLen], name = 'X') 
                 self._keepProb =  tf.placeholder("float32", [] , name = 'keepProb') 
@@ -175,6 +206,10 @@ class actConnGraph(object):
             self._batch     = tf.placeholder("int32", [], name = 'batch')
             self._batchSize = tf.placeholder("int32",[],  name = 'batchSize')                                               
 
+            #Rows of Y used in the cost (1), others are only evaluated (0)
+            self._lossMask  = tf.placeholder_with_default( tf.ones_like(self._Y), 
+                                                           self._Y.get_shape(), name = 'lossMask')
+
             #Learning rate decay 
             self._currLR = tf.train.exponential_decay(self.learnRate, #LR intial value
                                             self._batch,         #Current batch
@@ -209,21 +244,52 @@ class actConnGraph(object):
             #To test the precision of the network
             self.precision = tf.reduce_mean(tf.pow(self._Z2 - self._Y, 2))
  
-            #Backpropagation
-            self.optimizer = tf.train.AdamOptimizer( learning_rate = 
-                                                     self._currLR ).minimize(cost)
+            #Backpropagation (Adam parameters also used by _loopSteps)
+            self._adam = {'beta1': 0.9, 'beta2': 0.999, 'epsilon': 1e-08}
+            optim    = tf.train.AdamOptimizer( learning_rate = self._currLR, **self._adam )
+            gradVars = optim.compute_gradients(cost)
+
+            self.optimizer = optim.apply_gradients(gradVars)
 
             #Adding gaussian noise to variables updates
             #self.V_add_noise = self._VNoise(self.variables) # List of var.assign_add(noise) for all variables
 
-            #Applying masking for restained connectivity
-            self.masking = self._masking()
+            #Training step, masks applied after the update in the same run
+            self._trainStep = self._maskedStep(self.optimizer)
+
+            #Same, but after the diagnostics of the step are evaluated (see launchGraph)
+            diag = [self._ngml, self._ngmlTe, self._resp[0]] + \
+                   [ g for G in self._grad.values() for g in G if g is not None ]
+
+            with tf.control_dependencies(diag):
+                self._trainDiag = self._maskedStep(optim.apply_gradients(gradVars))
+
+            #Multiple training steps per run 
+            if getattr(self, 'stepsPerRun', 1) > 1:
+                if not self.model in ['__classOptoNN__', '__classOptoNNPairs__'] or self.masks:
+                    raise ValueError('stepsPerRun > 1 is only available for __classOptoNN__ ' +
+                                     'and __classOptoNNPairs__ without masks.')
+
+                self._loopOps = {d: self._loopSteps(optim, d) for d in [False, True]}
 
             #Saving graph
             self.saver = tf.train.Saver()
 
+            #Initialization of all variables and optimizer slots (see reset)
+            self._initOp = tf.initialize_all_variables()
+
+            #Mean loss of the rows in lossMask, for each pair classifier (see _stopCheck)
+            axes = [1,2] if 'Pairs' in self.model else None
+            self._heldLoss = tf.reduce_sum(self._lossRows*self._lossMask, axes) / \
+                             tf.reduce_sum(self._lossMask, axes)
+
+            #Assigning saved values to the variables (see _stopCheck)
+            self._restorePh = [ tf.placeholder(v.dtype.base_dtype, v.get_shape()) for v in self.variables ]
+            self._restore   = tf.group(*[ v.assign(ph) for v, ph in zip(self.variables, self._restorePh) ])
+
 
         self.graph = graph
+        self.sess  = None #Session kept between launchGraph calls (see _session)
 
 
     '''
@@ -320,22 +386,65 @@ class actConnGraph(object):
 
         self.masks   = { }
 
+        return self._classiNN(_Z1, self.weights, self.biases)
+
+        #Network prediction
+
+
+    def __classOptoNNPairs__(self,_Z1):
+
+        ''' Independent __classOptoNN__ classifiers for nPairs (stimulated cell,
+            decoding cell) pairs. Every weight and bias has a leading dimension 
+            of size nPairs and the layers are batched matrix products, so each 
+            pair only sees its own parameters.
+
+        '''
+
+        P = self.nPairs #Number of pair classifiers
+
+        #Creating weight matrices 
+        self.weights = {   l: varInit([P]+[self.nhidclassi]*2, 'hidW'+str(l),
+                                       ortho = False, std = 0.01 ) 
+                                       for l in range(self.multiLayer)   }
+        self.weights      ['in']  = varInit( [P,self.seqLen,self.nhidclassi],'inW',
+                                       ortho = False, std = 0.01 )
+        self.weights['out'] = varInit( [P,self.nhidclassi,1],'outW', 
+                                       ortho = False, std = 0.01 )
+
+        #Creating biases (same std as __classOptoNN__)
+        stdB = 1/np.sqrt(self.nhidclassi)
+        self.biases  = {  l: varInit([P,1,self.nhidclassi],'bias'+str(l), std = stdB)
+                             for l in range(self.multiLayer) } 
+        self.biases['in']  = varInit([P,1,self.nhidclassi],'inB', std = stdB)
+        self.biases['out'] = varInit([P,1,1],'outB', std = 1)
+
+        self.masks   = { }
+
+        return self._classiNN(_Z1, self.weights, self.biases)
+
+
+    def _classiNN(self, _Z1, W, B):
+        ''' Forward pass of __classOptoNN__ (and __classOptoNNPairs__ with 
+            batched products) with weights W and biases B, which can be the 
+            variables or tensors holding their values (see _loopSteps). '''
+
+        matmul = tf.batch_matmul if 'Pairs' in self.model else tf.matmul
+
         #Input layer
-        H = tf.add( tf.matmul( _Z1,self. weights['in'] ), self.biases['in'] )
+        H = tf.add( matmul( _Z1, W['in'] ), B['in'] )
         H = self.actfct(H)
 
         #Hidden layers
         for l in range(self.multiLayer):
-            H = tf.add( tf.matmul( H, self.weights[l] ), self.biases[l] )
+            H = tf.add( matmul( H, W[l] ), B[l] )
             H = tf.nn.dropout(H, self._keepProb) #Dropout
             H = self.actfct(H)
 
         #Output layer
-        pred = tf.matmul(H,self.weights['out']) + self.biases['out']
+        pred = matmul(H, W['out']) + B['out']
 
         return pred
 
-        #Network prediction
 
     def __NAR__(self,_Z1):
       ''' Non Linear Regressive model used to infer the connectivity '''
@@ -400,7 +509,7 @@ class actConnGraph(object):
 
                        '2ng_IH_HH': tf.random_normal([self.nInput + nhid, nhid],
                                                     0.001) * self.learnRate/2,
-                       '0alpha_M' : tf.clip_by_value(self.weights['alpha_W'],0,1)
+                       '0alpha_M' : lambda W: tf.clip_by_value(W['alpha_W'],0,1)
                       } 
 
         #Defining biases
@@ -414,8 +523,9 @@ class actConnGraph(object):
         ngCell  = rnn_cell.BasicRNNCell(nhid, activation= self.actfct)
         ngCellS = rnn_cell.MultiRNNCell([ngCell])
 
-        #Initialization
-        ngO = ngCellS.zero_state(self.batchSize,tf.float32) #Netw+Glob state initialization 
+        #Initialization, sized from the fed rows (stacked train+test feeds in detail mode)
+        nRows = tf.shape(_Z1[0])[0]
+        ngO = ngCellS.zero_state(nRows,tf.float32) #Netw+Glob state initialization 
         Z2  = tf.zeros(1)                                   #Model prediction
 
         #RNN looping through sequence time points
@@ -437,7 +547,7 @@ class actConnGraph(object):
                 ng_Z2 = ngO[:,:self.nhidNetw]
 
                 #Gaussian noise
-                gNoise = tf.random_normal([self.batchSize,self.nOut], mean   = ng_Gmean, 
+                gNoise = tf.random_normal([nRows,self.nOut], mean   = ng_Gmean, 
                                                                       stddev = ng_Gstd,  
                                                                       dtype  = 'float32' )
                 gNoise = 0
@@ -572,9 +682,11 @@ _______
             #L1 loss
             #self._sparsC = tf.add_n([tf.reduce_sum(tf.abs(v)) for v in self.variables])
 
-            #Cross entropy
+            #Cross entropy (training rows and evaluated rows)
             ngml = tf.nn.sigmoid_cross_entropy_with_logits(self._Z2, self._Y)
-            self._ngml = tf.reduce_sum(ngml)
+            self._ngml   = tf.reduce_sum(ngml*self._lossMask)
+            self._ngmlTe = tf.reduce_sum(ngml*(1-self._lossMask))
+            self._lossRows = ngml
 
             #cost = (self._ngml*self.lossW +self._sparsC*self.sparsW) / \
             #       (2*self.batchSize)
@@ -586,8 +698,11 @@ _______
             sparsC = tf.add_n([tf.reduce_sum(tf.abs(v)) for v in self.variables]) 
             self._sparsC = sparsC*self.sparsW
 
-            #Sum of square distance
-            self._ngml = tf.reduce_sum(tf.pow(self._Z2 - self._Y,2))*self.lossW
+            #Sum of square distance (training rows and evaluated rows)
+            sqDist = tf.pow(self._Z2 - self._Y,2)
+            self._ngml   = tf.reduce_sum(sqDist*self._lossMask)*self.lossW
+            self._ngmlTe = tf.reduce_sum(sqDist*(1-self._lossMask))*self.lossW
+            self._lossRows = sqDist
 
             #Prior
             ngprior = 0
@@ -599,6 +714,16 @@ _______
           return cost
 
 
+    def _maskedStep(self, update):
+        ''' Update followed by the masks operations, as a single op '''
+
+        if not self.masks:
+            return update
+
+        with tf.control_dependencies([update]):
+            return tf.group(update, *self._masking())
+
+
     def _masking(self):
         ''' Will create the operations to update the weights
 
@@ -608,31 +733,40 @@ _______
                            1 : Mask is added to the respective weight
                            2 : Mask is multipled with the respective weight
         
-         Mask operations will be executed in the same order '''
+         Mask operations will be executed in the same order. Masks that 
+         depend on the weights are functions of the weights dictionnary 
+         (e.g. lambda W: tf.clip_by_value(W['alpha_W'],0,1)). The variables
+         are read when the ops the masks depend on are done (see 
+         _maskedStep), and the masks are built from these values.'''
 
         Vars = self.variables.copy()
 
         #Names of variables
         vnames = [var.name[:-2] for var in Vars]
 
-        #Will hold variables changes
-        tempM =  [var.value() for var in Vars] 
+        #Will hold variables changes, from their value after the update
+        tempM = [tf.identity(var.ref()) for var in Vars] 
+
+        #Masks computed from the updated weights
+        W     = { k: tempM[i] for k, v in self.weights.items() 
+                              for i, var in enumerate(Vars) if var is v }
+        masks = { m: M(W) if callable(M) else M for m, M in self.masks.items() }
 
         #Which variables will the masks be applied on
         vidxAll = []     
 
         # Applying masks
-        for m in sorted(self.masks):
+        for m in sorted(masks):
             if m[1:] in vnames:
                 #If mask is present in variables as it is
                 vidx = vnames.index(m[1:]) #Index of variable
 
                 if   m[0] == '0':
-                    tempM[vidx] = self.masks[m]
+                    tempM[vidx] = masks[m]
                 elif m[0] == '1':
-                    tempM[vidx] = tf.add(tempM[vidx],self.masks[m])
+                    tempM[vidx] = tf.add(tempM[vidx],masks[m])
                 elif m[0] == '2':
-                    tempM[vidx] = tf.mul(tempM[vidx],self.masks[m])
+                    tempM[vidx] = tf.mul(tempM[vidx],masks[m])
 
 
             elif any([ (m[1:] in var and 'Matrix' in var) for var in vnames]):
@@ -643,11 +777,11 @@ _______
                     if  (m[1:] in var and 'Matrix' in var):
                         vidx = vnames.index(var) #Index of variable
                 if   m[0] == '0':
-                    tempM[vidx] = self.masks[m]
+                    tempM[vidx] = masks[m]
                 elif m[0] == '1':
-                    tempM[vidx] = tf.add(tempM[vidx],self.masks[m])
+                    tempM[vidx] = tf.add(tempM[vidx],masks[m])
                 elif m[0] == '2':
-                    tempM[vidx] = tf.mul(tempM[vidx],self.masks[m])
+                    tempM[vidx] = tf.mul(tempM[vidx],masks[m])
 
 
             elif m[-2:] == '_B' and any([ (m[1:] in var and 'Bias' in var) for var in vnames]):
@@ -658,11 +792,11 @@ _______
                     if  m[1:] in var and 'Bias' in var and m[-2:] == '_B':
                         vidx = vnames.index(var) #Index of variable
                 if   m[0] == '0':
-                    tempM[vidx] = self.masks[m]
+                    tempM[vidx] = masks[m]
                 elif m[0] == '1':
-                    tempM[vidx] = tf.add(tempM[vidx],self.masks[m])
+                    tempM[vidx] = tf.add(tempM[vidx],masks[m])
                 elif m[0] == '2':
-                    tempM[vidx] = tf.mul(tempM[vidx],self.masks[m])
+                    tempM[vidx] = tf.mul(tempM[vidx],masks[m])
 
 
 
@@ -672,11 +806,11 @@ _______
                 vidx = vnames.index(m[1:-1]+'W') #Index of variable
 
                 if   m[0] == '0':
-                    tempM[vidx] = self.masks[m]
+                    tempM[vidx] = masks[m]
                 elif m[0] == '1':
-                    tempM[vidx] = tf.add(tempM[vidx],self.masks[m])
+                    tempM[vidx] = tf.add(tempM[vidx],masks[m])
                 elif m[0] == '2':
-                    tempM[vidx] = tf.mul(tempM[vidx],self.masks[m])
+                    tempM[vidx] = tf.mul(tempM[vidx],masks[m])
 
             vidxAll.append(vidx) 
             
@@ -685,6 +819,124 @@ _______
         return [Vars[i].assign(tempM[i]) for i in vidxAll]
 
 
+    def _loopSteps(self, optim, detail):
+        ''' 
+        Will create the operations running up to stepsPerRun training steps
+        of __classOptoNN__ (or __classOptoNNPairs__) in a single session run,
+        with a tf.while_loop over the batch index tables. The training and 
+        testing sequences and the index tables are graph variables, loaded 
+        once per launchGraph (see _loopFeed). 
+
+        Inside the loop, the weights and the Adam moments are tensors 
+        updated with the same rule as optim, which has to be the 
+        tf.train.AdamOptimizer built with self._adam. They are assigned back
+        to the variables, to the slots and to the beta powers of optim at 
+        the end of the run, so that the steps are identical to launchGraph's
+        steps (see tests/test_graphs.py). If detail, the 
+        testing batch is evaluated with the training batch at every step
+        (see _stackFeed) and the losses, answers and predictions of all the 
+        steps are returned.
+        '''
+
+        #The beta powers are only reachable through Adam's attributes
+        if not isinstance(optim, tf.train.AdamOptimizer) or \
+           not hasattr(optim, '_beta1_power') or not hasattr(optim, '_beta2_power'):
+            raise ValueError('stepsPerRun > 1 only reproduces the updates of ' +
+                             'tf.train.AdamOptimizer, with its beta powers as ' +
+                             '_beta1_power and _beta2_power.')
+
+        pairs = 'Pairs' in self.model
+        axis  = 1 if pairs else 0 #Rows axis
+        half  = int(self.batchSize/2)
+        P     = [self.nPairs] if pairs else []
+
+        Vars = self.variables
+        nV   = len(Vars)
+
+        #Sequences and index tables (nbIters x [nPairs x] half) of each set
+        if not hasattr(self, '_loopVar'):
+            self._loopPh  = {}
+            self._loopVar = {}
+            for name in ['Xtr1', 'Xtr0', 'Xte1', 'Xte0', 'idxTr1', 'idxTr0', 'idxTe1', 'idxTe0']:
+                dtype = 'float32' if name[0] == 'X' else 'int32'
+                self._loopPh[name]  = tf.placeholder(dtype, name = name)
+                self._loopVar[name] = tf.Variable( self._loopPh[name], trainable = False, 
+                                                   collections = [], validate_shape = False, 
+                                                   name = name + 'Loop' )
+
+            self._loopLoad  = tf.group(*[ v.initializer for v in self._loopVar.values() ])
+            self._loopStep0 = tf.placeholder('int32', [], name = 'loopStep0') #First step
+            self._loopN     = tf.placeholder('int32', [], name = 'loopN')     #Number of steps
+
+        def batch(X, idx, step):
+            return tf.gather( self._loopVar[X], tf.gather(self._loopVar[idx], step) )
+
+        #Labels and rows used in the cost (training rows first)
+        sets = [['Xtr1','idxTr1'], ['Xtr0','idxTr0']] + [['Xte1','idxTe1'], ['Xte0','idxTe0']]*detail
+        Y    = np.concatenate([ np.ones(P+[half,1]), np.zeros(P+[half,1]) ]*(1+detail), axis = axis)
+        mask = np.concatenate([ np.ones(P+[2*half,1]), np.zeros(P+[2*half,1]) ][:1+detail], axis = axis)
+        Y    = tf.constant(Y, 'float32')
+        mask = tf.constant(mask, 'float32')
+
+        #Adam parameters and state
+        b1, b2, eps = self._adam['beta1'], self._adam['beta2'], self._adam['epsilon']
+        slots = [ optim.get_slot(v, 'm') for v in Vars ] + [ optim.get_slot(v, 'v') for v in Vars ]
+        beta  = [ optim._beta1_power, optim._beta2_power ]
+
+        #Index of weights and biases in Vars
+        vIdx = {v.name: i for i, v in enumerate(Vars)}
+        wIdx = {k: vIdx[self.weights[k].name] for k in self.weights}
+        bIdx = {k: vIdx[self.biases[k].name]  for k in self.biases }
+
+        #Losses, answers and predictions of each step
+        TA = [ tf.TensorArray('float32', size = self._loopN) for i in range(4*detail) ]
+
+        def body(i, *state):
+            W  = list(state[:nV])
+            M  = list(state[nV:2*nV])
+            V  = list(state[2*nV:3*nV])
+            b1p, b2p = state[3*nV:3*nV+2]
+            ta = list(state[3*nV+2:])
+
+            step = self._loopStep0 + i
+
+            #Batch of each set
+            X = tf.concat(axis, [ batch(x, idx, step) for x, idx in sets ])
+
+            Z2   = self._classiNN( X, {k: W[wIdx[k]] for k in wIdx}, {k: W[bIdx[k]] for k in bIdx} )
+            ngml = tf.nn.sigmoid_cross_entropy_with_logits(Z2, Y)
+
+            #Same cost as _cost 
+            lossTr = tf.reduce_sum(ngml*mask)
+            cost   = (lossTr*self.lossW) / (2*self.batchSize)
+
+            G = tf.gradients(cost, W)
+
+            #Adam update
+            lr   = tf.train.exponential_decay(self.learnRate, step, 200, 0.90, staircase = True)
+            lr_t = lr * tf.sqrt(1 - b2p) / (1 - b1p)
+
+            M = [ b1*m + (1-b1)*g   for m, g in zip(M, G) ]
+            V = [ b2*v + (1-b2)*g*g for v, g in zip(V, G) ]
+            W = [ w - lr_t*m/(tf.sqrt(v) + eps) for w, m, v in zip(W, M, V) ]
+
+            if detail:
+                _Y  = tf.round(tf.nn.sigmoid(Z2))
+                out = [ lossTr, tf.reduce_sum(ngml*(1-mask)), tf.to_float(tf.equal(Y, _Y)), _Y ]
+                ta  = [ t.write(i, o) for t, o in zip(ta, out) ]
+
+            return [i+1] + W + M + V + [b1p*b1, b2p*b2] + ta
+
+        init = [tf.constant(0)] + [ v.value() for v in Vars + slots + beta ] + TA
+        out  = tf.while_loop( lambda i, *state: i < self._loopN, body, init, 
+                              parallel_iterations = 1, back_prop = False )
+
+        #Assigning the final state to the variables
+        update = tf.group(*[ v.assign(o) for v, o in zip(Vars + slots + beta, out[1:3*nV+3]) ])
+
+        return [update] + [ t.pack() for t in out[3*nV+3:] ]
+
+
     def _VNoise(self, variables, learningR = .001, std = .001):
         ''' Adding stochasticity in the tensorflow graph variables at every update
            for a stotastic gradient descent.
@@ -714,9 +966,17 @@ _______
         t = time.time() # Current time
         backupPath = '/tmp/backup.ckpt' # Checkpoint backup path
 
+        #Validation sequences held out of the training set for early stopping
+        if getattr(self, 'stopPatience', 0) > 0:
+            D, self._Dval = self._valSplit(D, getattr(self, 'stopVal', 0.2))
+
         #Which sequence for classification mini batches
 
-        if 'class' in self.model:
+        if 'Pairs' in self.model:
+            trIdx  = [ self._pairIdx(n) for n in D['Ytr'] ]
+            teIdx  = [ self._pairIdx(n) for n in D['Yte'] ]
+
+        elif 'class' in self.model:
             trIdx  = [ randint( 0, len( D['Ytr'][0] ),
                               [int(self.batchSize/2), self.nbIters] ),
                        randint( 0, len( D['Ytr'][1] ),
@@ -730,108 +990,150 @@ _______
             trIdx   = randint( 0, len(D['Ytr']), [self.batchSize, self.nbIters] )
             teIdx   = randint( 0, len(D['Yte']), [self.batchSize, self.nbIters] ) 
 
+        #Drawing new training spontaneous windows every epoch (see spontSampler)
+        redraw = getattr(self, 'spontRedraw', False) and 'spontTr' in D
+        if redraw:
+            D = dict(D, Xtr = list(D['Xtr']))
+            nEpoch = max( 1, int( len(D['Ytr'][1]) // (self.batchSize/2) ) ) #Steps per epoch
+
         #Initialize counters
         stepTr  = 0 #Training steps
         stepBat = 0 #Testing steps
-        accNum  = 0 #To calculate accuracy over time
+        K       = getattr(self, 'stepsPerRun', 1) #Training steps per run
 
         #Initialize holders
         if detail:
             #Storing more information
-            self.pred   = [None]*self.nbIters
-            self.grad   = [None]*self.nbIters
-            self.lossTr = [None]*self.nbIters
-            self.lossTe = []
-            ansTr       = np.round(np.random.rand(500,2))
-            ansTe       = np.round(np.random.rand(500,2))
-            self.acc    = []
+            self.pred    = [None]*self.nbIters
+            self.grad    = [None]*self.nbIters
+            self.lossTr  = [None]*self.nbIters
+            self.lossTe  = []
+            nAns         = self.batchSize*getattr(self, 'nPairs', 1) #Answers per step
+            self._ansTr  = np.round(np.random.rand(500,nAns))
+            self._ansTe  = np.round(np.random.rand(500,nAns))
+            self._accNum = 0 #To calculate accuracy over time
+            self.acc     = []
 
 
-        #Setting configs for minimum threads (small model)
-        config = tf.ConfigProto(device_count={"CPU": 88},
-                          inter_op_parallelism_threads=1,
-                          intra_op_parallelism_threads=1)
+        def makeFeed(step, buf = None):
+            ''' Feed of training step and its testing rows if needed (see 
+                _stackFeed), with the number of training rows. '''
 
+            if redraw and step and not step % nEpoch:
+                D['Xtr'][1] = D['spontTr']( len(D['Ytr'][1]) )
 
-        with tf.Session(graph=self.graph, config = config) as sess:
+            FD_tr = self._feedDict(D['Xtr'], D['Ytr'], step, trIdx, buf and buf['tr'])
+
+            #Test batch evaluated in the same run as the training batch
+            if detail and ('class' in self.model or step % self.dispStep == 0):
+                FD_te = self._feedDict(D['Xte'], D['Yte'], step, teIdx, buf and buf['te'])
+                return self._stackFeed(FD_tr, FD_te, buf and buf['stack'])
+
+            return FD_tr, None
+
+        #Session of the graph, created at the first launch
+        sess = self._session()
+
+        with self.graph.as_default(), sess.as_default():
 
             #Initializing the variables
-            sess.run(tf.initialize_all_variables())
+            self.reset()
 
             if self.sampRate > 0:
                 samp   = 0                           #Sample
                 nbSamp = self.nbIters//self.sampRate #Number of sample
 
-            # Keep training until reach max iterations
-            while stepTr < self.nbIters:
+            if K > 1:
+                #Loading sequences and batch index tables in the graph
+                sess.run(self._loopLoad, feed_dict = self._loopFeed(D, trIdx, teIdx))
+
+            #Early stopping on held-out data (see _stopCheck)
+            stopEvery = getattr(self, 'stopEvery', 100)
+            stopping  = getattr(self, 'stopPatience', 0) > 0
+            if stopping:
+                self._stopInit(sess)
 
-                #Train feed dictionnary 
-                FD_tr = self._feedDict(D['Xtr'], D['Ytr'], stepTr ,trIdx)
+            feeder = None
+            if K == 1 and getattr(self, 'prefetch', 0):
+                #Feeds assembled in background in a ring of buffers
+                feeder = batchFeeder( makeFeed, self.nbIters, self.prefetch, 
+                                      makeBuffer = lambda: {'tr': {}, 'te': {}, 'stack': {}} )
+                feeds  = iter(feeder)
 
-                if detail:
-                    #Test feed dictionnary 
-                    FD_te = self._feedDict(D['Xte'], D['Yte'], stepTr ,teIdx)
-                    if 'class' in self.model:
+            try:
+                # Keep training until reach max iterations
+                while stepTr < self.nbIters:
 
-                           if accNum == 500:
-                                accNum = 0
-                           claTe, _y = sess.run(self._resp, feed_dict = FD_te)
-                           self.pred[stepTr] = [_y,[1,0]]
-                           ansTe[accNum,:] = np.squeeze(claTe)
+                    if K > 1 and redraw and stepTr and not stepTr % nEpoch:
+                        D['Xtr'][1] = D['spontTr']( len(D['Ytr'][1]) )
 
-                           claTr, _ = sess.run(self._resp, feed_dict = FD_tr)
-                           ansTr[accNum,:] = np.squeeze(claTr)
+                        sess.run( self._loopVar['Xtr0'].initializer, 
+                                  feed_dict = {self._loopPh['Xtr0']: D['Xtr'][1]} )
 
-                           accNum += 1
+                    if K > 1:
+                        #Number of steps of the run, new spontaneous windows are drawn between runs
+                        n = min(K, self.nbIters - stepTr)
+                        if redraw:
+                            n = min(n, nEpoch - stepTr % nEpoch)
+                        if stopping:
+                            n = min(n, stopEvery - stepTr % stopEvery)
 
-                    self.lossTr[stepTr] = sess.run(self._ngml, feed_dict = FD_tr)
-                    self.grad[stepTr]   = sess.run(self._grad, feed_dict = FD_tr)
+                        FD = { self._loopStep0: stepTr, self._loopN: n, self._keepProb: self.keepProb }
 
-                                    #Tracking variables in v2track
-                    if self.sampRate > 0 and not stepTr%self.sampRate:
-                        self._trackVar( nbSamp, samp, self.v2track )
-                        samp +=1
+                        #n training steps in a single run
+                        out = sess.run(self._loopOps[detail], feed_dict = FD)
 
-                if detail and stepTr % self.dispStep == 0:
+                        if detail:
+                            #out : update, lossTr, lossTe, answers and predictions of every step
+                            for i in range(n):
+                                self._logStep( stepTr+i, out[3][i], out[4][i], self.batchSize,
+                                               out[1][i], out[2][i], None )
 
-                    #trSpars = sess.run(self._sparsC, feed_dict = FD_tr)
+                        stepTr  += n
+                        stepBat += n
 
-                    #Testing fit with new data
-                    lossTe = sess.run(self._ngml, feed_dict = FD_te) 
-                    self.lossTe.append(lossTe) 
+                        if stopping and not stepTr % stopEvery and self._stopCheck(D, sess, stepTr):
+                            break
 
-                    #Calculating accuraty for classification
-                    if 'class' in self.model:
-                       accTe = (np.sum(ansTe))/(500*self.batchSize)
-                       self.acc.append(accTe)
+                        continue
 
-                       accTr = (np.sum(ansTr))/(500*self.batchSize)
+                    #Feed dictionnary 
+                    FD, nTr = next(feeds) if feeder else makeFeed(stepTr)
 
-                       #Printing progress 
-                       print( " Iter: " + str(stepTr) + "/" + str(self.nbIters)         +  
-                               "   ~  Tr Loss: " + "{:.6f}".format(self.lossTr[stepTr]) +
-                               "   ~  Tr Acc: "  + "{:.2f}".format(accTr*100)           + 
-                               "   |  Te Loss: " + "{:.6f}".format(lossTe)              +
-                               "   ~  Te Acc "   + "{:.2f}".format(accTe*100)     )
+                    if detail:
+                        #Tracking variables in v2track
+                        if self.sampRate > 0 and not stepTr%self.sampRate:
+                            self._trackVar( nbSamp, samp, self.v2track )
+                            samp +=1
+
+                        #Diagnostics, backprop and masks in a single run
+                        _, resp, lossTr, lossTe, grad = sess.run([ self._trainDiag, self._resp, 
+                                                                   self._ngml, self._ngmlTe,
+                                                                   self._grad ], feed_dict = FD)
+
+                        self._logStep(stepTr, resp[0], resp[1], nTr, lossTr, lossTe, grad)
 
                     else:
-                      print( " Iter: " + str(stepTr) + "/" + str(self.nbIters)           +  
-                               "   ~  Tr Loss: " + "{:.6f}".format(self.lossTr[stepTr]) + 
-                               "   |  Te Loss: " + "{:.6f}".format(lossTe)  )
+                        #Running backprop and applying masks
+                        sess.run(self._trainStep, FD)
+
+                    stepTr  += 1
+                    stepBat += 1
 
-   
-                #Running backprop
-                sess.run(self.optimizer, FD_tr)
+                    if stopping and not stepTr % stopEvery and self._stopCheck(D, sess, stepTr):
+                        break
 
-                #Applying masks
-                if self.masks:
-                  sess.run(self.masking, FD_tr)
+            finally:
+                #Stopping the feeder thread, even if training failed
+                if feeder:
+                    feeder.close()
 
-                stepTr  += 1
-                stepBat += 1
+            if stopping:
+                self.stopIter = stepTr
+                self._stopRestore(sess)
 
             #Saving variables final state
-            self.evalVars = {v.name: v.eval() for v in tf.trainable_variables()}
+            self.evalVars = dict(zip([v.name for v in self.variables], sess.run(self.variables)))
             
             if detail:
                 #Final accuracy
@@ -842,8 +1144,8 @@ _______
                 self.saver.save(sess, backupPath)
 
                 if 'class' in self.model:
-                  print('\nFinal training accuracy : {:.2f} '.format(self.AccTr))
-                  print(  'Final testing accuracy  : {:.2f} '.format(self.AccTe))
+                  print('\nFinal training accuracy : {:.2f} '.format(np.mean(self.AccTr)))
+                  print(  'Final testing accuracy  : {:.2f} '.format(np.mean(self.AccTe)))
 
                 print('\nTotal time:  ' + str(datetime.timedelta(seconds = time.time()-t)))
             else:
@@ -853,8 +1155,270 @@ _______
             #Final accuracy
             self._finalAcc(D,sess) #Final accuracy
 
+        if 'Pairs' in self.model:
+            #Accuracy matrix of all pairs (nFolds x nTargets x nDecoders)
+            self.accAll = self._pairAccMat(D, self.AccTe)
+            return self.accAll
+
         return self.AccTe
 
+
+    def _stopInit(self, sess):
+        ''' Will initialize the early stopping state, with one best held-out
+            metric, best weights and patience count per pair classifier. '''
+
+        nP = getattr(self, 'nPairs', 1)
+
+        self._best     = np.zeros(nP) + np.inf
+        self._wait     = np.zeros(nP, dtype = int)
+        self._bestVals = None #Weights of the first evaluation onward
+        self._noVal    = np.zeros(nP, dtype = bool)
+        self.bestIter  = np.zeros(nP, dtype = int)
+        self.stopIter  = self.nbIters
+
+
+    def _stopRestore(self, sess):
+        ''' Will restore the best weights of every pair classifier, if at least
+            one evaluation was done (see _stopCheck). Classifiers without a 
+            finite held-out metric (no validation sequences) keep their final 
+            weights. '''
+
+        if self._bestVals is None:
+            return
+
+        noVal = self._noVal
+        if np.any(noVal):
+            if 'Pairs' not in self.model:
+                return
+
+            vals = sess.run(self.variables)
+            for best, val in zip(self._bestVals, vals):
+                best[noVal] = val[noVal]
+
+            self.bestIter[noVal] = self.stopIter
+
+        sess.run(self._restore, feed_dict = dict(zip(self._restorePh, self._bestVals)))
+
+
+    def _valSplit(self, D, frac):
+        ''' 
+        Will hold out the last frac of the training sequences (of each label
+        and each pair classifier) as a validation set for early stopping, so
+        the testing set is only used by _finalAcc. Returns the training data
+        without the validation sequences, and the validation data {Xte, Yte}.
+        '''
+
+        if 'Pairs' in self.model:
+            Xv = []; Yv = []; Ytr = []
+            for X, n in zip(D['Xtr'], D['Ytr']):
+                #At least one validation and one training sequence per pair
+                v = np.clip(np.int64(n*frac), 1, np.maximum(n-1, 1)) * (n > 1)
+
+                #Last v valid sequences of each pair, zero padded
+                rows  = (n - v).reshape(-1,1) + np.arange(max(v.max(), 1))
+                valid = np.arange(rows.shape[1]) < v.reshape(-1,1)
+
+                Xv.append( X[ np.arange(len(n)).reshape(-1,1), 
+                              np.minimum(rows, X.shape[1]-1) ] * valid[:,:,None] )
+                Yv.append(v); Ytr.append(n - v)
+
+            #Validation sequences stay in Xtr as padding of the pairs
+            return dict(D, Ytr = Ytr), {'Xte': Xv, 'Yte': Yv}
+
+        if 'class' in self.model:
+            #At least one training sequence per label, none held out if only one
+            k = [ min(max(1, int(len(Y)*frac)), len(Y)-1) if len(Y) > 1 else 0 for Y in D['Ytr'] ]
+
+            Dtr = dict( D, Xtr = [ X[:len(X)-v] for X, v in zip(D['Xtr'], k) ],
+                           Ytr = [ Y[:len(Y)-v] for Y, v in zip(D['Ytr'], k) ] )
+            return Dtr, { 'Xte': [ X[len(X)-v:] for X, v in zip(D['Xtr'], k) ],
+                          'Yte': [ Y[len(Y)-v:] for Y, v in zip(D['Ytr'], k) ] }
+
+        #Ordered sequences, the validation set is the end of the training set
+        n = len(D['Ytr']) - max(1, int(len(D['Ytr'])*frac))
+
+        return dict(D, Xtr = D['Xtr'][:n], Ytr = D['Ytr'][:n]), \
+               {'Xte': D['Xtr'][n:], 'Yte': D['Ytr'][n:]}
+
+
+    def _stopCheck(self, D, sess, step):
+        ''' 
+        Will evaluate the held-out metric (stopMetric) on the validation set
+        (see _valSplit), either the mean loss ('loss') or minus the accuracy
+        ('acc', see _finalAcc), and keep the weights of the pair classifiers 
+        that improved by more than stopDelta. Classifiers with a non-finite
+        metric (no validation sequences) are left out. Returns True when no 
+        other classifier improved for stopPatience evaluations, meaning 
+        training can stop.
+        '''
+
+        V = self._Dval #Validation set
+
+        if getattr(self, 'stopMetric', 'loss') == 'acc':
+            self._finalAcc(dict(D, Xtr = V['Xte'], Ytr = V['Yte'], **V), sess)
+            metric = -np.atleast_1d(self.AccTe)
+        else:
+            FD = self._feedDict(V['Xte'], V['Yte'])
+
+            if 'Pairs' in self.model:
+                #Ignoring padded sequences
+                valid = [ np.arange(X.shape[1]) < n.reshape(-1,1) for X, n in zip(V['Xte'], V['Yte']) ]
+                FD[self._lossMask] = np.float32(np.concatenate(valid, axis = 1)[:,:,None])
+
+            metric = np.atleast_1d(sess.run(self._heldLoss, feed_dict = FD))
+
+        #Classifiers without validation sequences (0/0 metric) are left out
+        self._noVal = ~np.isfinite(metric)
+        improved    = (metric < self._best - getattr(self, 'stopDelta', 0)) & ~self._noVal
+
+        if np.any(improved) or self._bestVals is None:
+            #Keeping the weights of improved classifiers (leading dimension for pairs)
+            vals = sess.run(self.variables)
+            if self._bestVals is None:
+                self._bestVals = vals
+            for best, val in zip(self._bestVals, vals):
+                if 'Pairs' in self.model:
+                    best[improved] = val[improved]
+                elif improved[0]:
+                    best[...] = val
+
+            self._best[improved]    = metric[improved]
+            self.bestIter[improved] = step
+
+        self._wait[improved]  = 0
+        self._wait[~improved] += 1
+
+        waiting = self._wait[~self._noVal] >= self.stopPatience
+        return waiting.size > 0 and np.all(waiting)
+
+
+    def _session(self):
+        ''' Session of the graph, kept open so that successive launchGraph
+            calls (e.g. for different cells) don't create a new one. '''
+
+        if self.sess is None:
+            #Setting configs for minimum threads (small model)
+            config = tf.ConfigProto(device_count={"CPU": 88},
+                              inter_op_parallelism_threads=1,
+                              intra_op_parallelism_threads=1)
+
+            self.sess = tf.Session(graph=self.graph, config = config)
+
+        return self.sess
+
+
+    def reset(self):
+        ''' Will re-initialize all the variables and optimizer slots of the 
+            graph with a single op, without creating a new session. '''
+
+        self._session().run(self._initOp)
+
+
+    def close(self):
+        ''' Will close the session of the graph '''
+
+        if self.sess is not None:
+            self.sess.close()
+            self.sess = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        ''' Will close the session when leaving a with block '''
+        self.close()
+
+
+    def _logStep(self, step, resp, pred, nTr, lossTr, lossTe, grad):
+        ''' Will store the diagnostics of a training step, where resp and 
+            pred hold the answers and predictions of the nTr training rows 
+            followed by the testing rows, and print the progress every 
+            dispStep steps.'''
+
+        self.lossTr[step] = lossTr
+        self.grad[step]   = grad
+
+        if 'class' in self.model:
+
+               if self._accNum == 500:
+                    self._accNum = 0
+
+               #Training rows first, then testing rows
+               axis = 1 if 'Pairs' in self.model else 0
+               claTr, claTe = np.split(resp, [nTr], axis = axis)
+               _y           = np.split(pred, [nTr], axis = axis)[1]
+
+               self.pred[step] = [_y,[1,0]]
+               self._ansTe[self._accNum,:] = np.ravel(claTe)
+               self._ansTr[self._accNum,:] = np.ravel(claTr)
+
+               self._accNum += 1
+
+        if step % self.dispStep == 0:
+
+            #Testing fit with new data
+            self.lossTe.append(lossTe) 
+
+            #Calculating accuraty for classification
+            if 'class' in self.model:
+               accTe = np.mean(self._ansTe)
+               self.acc.append(accTe)
+
+               accTr = np.mean(self._ansTr)
+
+               #Printing progress 
+               print( " Iter: " + str(step) + "/" + str(self.nbIters)         +  
+                       "   ~  Tr Loss: " + "{:.6f}".format(self.lossTr[step]) +
+                       "   ~  Tr Acc: "  + "{:.2f}".format(accTr*100)         + 
+                       "   |  Te Loss: " + "{:.6f}".format(lossTe)            +
+                       "   ~  Te Acc "   + "{:.2f}".format(accTe*100)     )
+
+            else:
+              print( " Iter: " + str(step) + "/" + str(self.nbIters)           +  
+                       "   ~  Tr Loss: " + "{:.6f}".format(self.lossTr[step]) + 
+                       "   |  Te Loss: " + "{:.6f}".format(lossTe)  )
+
+
+    def _pairIdx(self, n):
+        ''' Random sequence indexes of every pair classifier for all the 
+            iterations (nPairs x batchSize/2 x nbIters), where pair p 
+            samples between 0 and n[p]. '''
+
+        U = np.random.rand(len(n), int(self.batchSize/2), self.nbIters)
+
+        return np.int32( U * np.reshape(n, [-1,1,1]) )
+
+
+    def _pairAccMat(self, D, acc):
+        ''' Will put the accuracy of every pair classifier in a matrix of 
+            size nFolds x nTargets x nDecoders, where targets and decoders
+            are sorted. Pairs that were not trained are NaN.
+
+            The label-shuffled replicas (see dataPrepClassiPairs), averaged
+            over their folds, are put in self.accNull (nNull x nTargets x 
+            nDecoders) and the p-value of each pair in self.pVal (see 
+            permTest).'''
+
+        targets  = np.unique(D['pairs'][:,0])
+        decoders = np.unique(D['pairs'][:,1])
+
+        accMat = np.zeros([ D['fold'].max()+1, len(targets), len(decoders) ])*np.nan
+
+        accMat[ D['fold'], 
+                np.searchsorted(targets,  D['pairs'][:,0]),
+                np.searchsorted(decoders, D['pairs'][:,1]) ] = acc
+
+        if 'null' in D and D['null'].any():
+            #Replicas are the last folds, nFolds per replica
+            nFolds       = D['fold'][~D['null']].max()+1
+            self.accNull = accMat[nFolds:].reshape((-1, nFolds) + accMat.shape[1:]).mean(axis = 1)
+            self.pVal    = permTest(accMat[:nFolds], self.accNull)
+            accMat       = accMat[:nFolds]
+
+        return accMat
+
     def _classiPred(self):
       # Classification models prediction
 
@@ -870,7 +1434,21 @@ _______
         ''' Will calculate the finnal accuracy on training and
             testing sets.''' 
 
-        if 'class' in self.model:
+        if 'Pairs' in self.model:
+
+          #Creating feeding dictionnaries 
+          finalAccTr_D = self._feedDict(D['Xtr'],D['Ytr'])
+          finalAccTe_D = self._feedDict(D['Xte'],D['Yte'])
+
+          #Calculating the prediction acc
+          AccTr,self.respTr = sess.run(self._resp, feed_dict = finalAccTr_D)
+          AccTe,self.respTe = sess.run(self._resp, feed_dict = finalAccTe_D)
+
+          #Balanced accuracy of each pair, ignoring padded sequences
+          self.AccTr = self._pairAcc(AccTr, D['Xtr'], D['Ytr'])
+          self.AccTe = self._pairAcc(AccTe, D['Xte'], D['Yte'])
+
+        elif 'class' in self.model:
 
           #Creating feeding dictionnaries 
           finalAccTr_D = self._feedDict(D['Xtr'],D['Ytr'])
@@ -918,10 +1496,53 @@ _______
           self.AccTe = np.mean(np.diag(corr2_coeff(D['Yte'],Zte)))
 
 
-    def _feedDict(self, Dx, Dy, stepTr= None, idx = None):
+    def _pairAcc(self, resp, Dx, n):
+        ''' Balanced accuracy (in %) of each pair classifier, where resp 
+            holds the answers of the stim sequences followed by the ones 
+            of the noStim sequences, and n the number of valid sequences.'''
+
+        resp = np.squeeze(resp, axis = 2)
+        nMax = Dx[0].shape[1] #Padded number of stim sequences
+
+        Acc = [ np.sum( resp[:, :nMax] * (np.arange(nMax) < n[0].reshape(-1,1)), axis = 1 ) / n[0],
+                np.sum( resp[:, nMax:] * (np.arange(Dx[1].shape[1]) < n[1].reshape(-1,1)), axis = 1 ) / n[1] ]
+
+        return (Acc[0]+Acc[1])*50
+
 
+    def _feedDict(self, Dx, Dy, stepTr= None, idx = None, buf = None):
+      ''' Feed dictionnary of step stepTr (or of all sequences if None). If 
+          buf is given (see _feedBuffer), the batch is gathered in its 
+          preallocated arrays. '''
 
-      if 'class' in self.model:
+      if buf is not None:
+        return self._feedBuffer(Dx, Dy, stepTr, idx, buf)
+
+      if 'Pairs' in self.model:
+
+        P = self.nPairs
+
+        if not stepTr == None:
+          pIdx = np.arange(P).reshape(-1,1)
+          half = int(self.batchSize/2)
+
+          FD ={ self._X : np.concatenate([ Dx[0][pIdx, idx[0][:,:,stepTr]],
+                                           Dx[1][pIdx, idx[1][:,:,stepTr]] ], axis = 1),
+                self._Y : np.concatenate([ np.ones( [P,half,1]),
+                                           np.zeros([P,half,1]) ], axis = 1),
+                self._batch     : stepTr,
+                self._batchSize : self.batchSize,
+                self._keepProb  : self.keepProb   }
+        else:
+          #For final testing
+          FD ={ self._X : np.concatenate([ Dx[0], Dx[1] ], axis = 1),
+                self._Y : np.concatenate([ np.ones( [P,Dx[0].shape[1],1]),
+                                           np.zeros([P,Dx[1].shape[1],1]) ], axis = 1),
+                self._batch     : 1,
+                self._batchSize : Dx[0].shape[1] + Dx[1].shape[1],
+                self._keepProb  : 1.0  }
+
+      elif 'class' in self.model:
 
         if not stepTr == None:
           idxS  = idx[0]
@@ -946,6 +1567,7 @@ _______
       else:
 
         if not stepTr == None:
+          #Batch gathered from the sequences (or their windows, see dataPrepGenerative)
           FD = { self._X : Dx[ idx[:,stepTr], ... ],
                  self._Y : Dy[ idx[:,stepTr], :   ],
                  self._batch     : stepTr,
@@ -961,6 +1583,129 @@ _______
       return FD
 
 
+    def _feedBuffer(self, Dx, Dy, stepTr, idx, buf):
+        ''' Same feed as _feedDict for step stepTr, with the batch gathered 
+            with np.take in the arrays of buf, a dictionnary holding 'X' and
+            'Y' arrays of the shape of the feeds. Creates the arrays if buf
+            is empty. Labels of classification models don't change. For 
+            __classOptoNNPairs__, each class is gathered in a contiguous
+            [nPairs, half, sL] part of buf['parts'], with the row offsets of
+            the pairs computed once, before being copied in buf['X']. '''
+
+        if not buf:
+            FD = self._feedDict(Dx, Dy, stepTr, idx)
+            buf['X'] = np.empty_like(FD[self._X])
+            buf['Y'] = np.array(FD[self._Y])
+
+            if 'Pairs' in self.model:
+                half         = int(self.batchSize/2)
+                buf['parts'] = np.empty((2, self.nPairs, half) + buf['X'].shape[2:], buf['X'].dtype)
+                buf['rows']  = np.empty((2, self.nPairs, half), np.intp)
+                buf['off']   = [ np.arange(self.nPairs).reshape(-1,1)*D.shape[1] for D in Dx ]
+
+        X = buf['X']
+
+        if 'Pairs' in self.model:
+
+            #Sequence j of pair p is at row p*nMax + j of flattened sequences
+            for k, D in enumerate(Dx):
+                rows = np.add(idx[k][:,:,stepTr], buf['off'][k], out = buf['rows'][k])
+                np.take( D.reshape(-1, D.shape[2]), rows, axis = 0, 
+                         out = buf['parts'][k] )
+
+            half = buf['parts'].shape[2]
+            X[:, :half] = buf['parts'][0]
+            X[:, half:] = buf['parts'][1]
+
+        elif 'class' in self.model:
+            half = int(self.batchSize/2)
+
+            np.take(Dx[0], idx[0][:,stepTr], axis = 0, out = X[:half])
+            np.take(Dx[1], idx[1][:,stepTr], axis = 0, out = X[half:])
+
+        else:
+            np.take(Dx, idx[:,stepTr], axis = 0, out = X)
+            np.take(Dy, idx[:,stepTr], axis = 0, out = buf['Y'])
+
+        FD = { self._X         : X,
+               self._Y         : buf['Y'],
+               self._batch     : stepTr,
+               self._batchSize : self.batchSize }
+
+        if 'class' in self.model:
+            FD[self._keepProb] = self.keepProb
+
+        return FD
+
+
+    def _loopFeed(self, D, trIdx, teIdx):
+        ''' Feed dictionnary loading the sequences and the batch index tables
+            in the graph for _loopSteps. Tables are transposed to have the 
+            step first and, for __classOptoNNPairs__, the sequences of all 
+            pairs are flattened with the indexes offset accordingly.'''
+
+        FD = {}
+        for name, Dx, idx in [ ['tr', D['Xtr'], trIdx], ['te', D['Xte'], teIdx] ]:
+            for lab, X, I in [ ['1', Dx[0], idx[0]], ['0', Dx[1], idx[1]] ]:
+
+                if 'Pairs' in self.model:
+                    #Sequence of pair p, example j is at row p*nMax + j
+                    I = I + np.arange(self.nPairs).reshape(-1,1,1) * X.shape[1]
+                    I = I.transpose(2,0,1)
+                    X = X.reshape(-1, X.shape[2])
+                else:
+                    I = I.T
+
+                FD[self._loopPh['X' + name + lab]]   = X
+                FD[self._loopPh['idx' + name.title() + lab]] = I
+
+        return FD
+
+
+    def _stackFeed(self, FD_tr, FD_te, buf = None):
+        ''' Single feed dictionnary with the training rows followed by the
+            testing rows, where only the training rows are used in the cost
+            (see _lossMask). Returns the feed and the number of training rows.
+            If buf is given, the rows are stacked in its preallocated 'X', 
+            'Y' and 'mask' arrays (created if buf is empty).'''
+
+        axis = 1 if 'Pairs' in self.model else 0 #Rows axis
+
+        Xs = [ FD_tr[self._X], FD_te[self._X] ]
+        Ys = [ FD_tr[self._Y], FD_te[self._Y] ]
+
+        FD = dict(FD_tr)
+        FD[self._batchSize] = FD_tr[self._batchSize] + FD_te[self._batchSize]
+
+        if buf is None or not buf:
+            Ys = [ np.asarray(Y, dtype = np.float32) for Y in Ys ]
+
+        if buf is None:
+            FD[self._X]        = np.concatenate(Xs, axis = axis)
+            FD[self._Y]        = np.concatenate(Ys, axis = axis)
+            FD[self._lossMask] = np.concatenate([ np.ones_like(Ys[0]), np.zeros_like(Ys[1]) ], axis = axis)
+
+            return FD, Ys[0].shape[axis]
+
+        if not buf:
+            buf['X']    = np.concatenate(Xs, axis = axis)
+            buf['Y']    = np.concatenate(Ys, axis = axis)
+            buf['mask'] = np.concatenate([ np.ones_like(Ys[0]), np.zeros_like(Ys[1]) ], axis = axis)
+        else:
+            #Training then testing rows, labels cast to float32 in place
+            rows = (slice(None),)*axis #Leading pairs axis
+            nTr  = np.shape(Ys[0])[axis]
+            for A, parts in [ [buf['X'], Xs], [buf['Y'], Ys] ]:
+                A[rows + (slice(None, nTr),)] = parts[0]
+                A[rows + (slice(nTr, None),)] = parts[1]
+
+        FD[self._X]        = buf['X']
+        FD[self._Y]        = buf['Y']
+        FD[self._lossMask] = buf['mask']
+
+        return FD, np.shape(Ys[0])[axis]
+
+
     def _trackVar(self, nbSamp, samp, v2track):
         ''' 
         Will save the variables overtime at a given sampling rate.
@@ -1119,6 +1864,345 @@ _______
         display.clear_output()
 
 
+class linClassiGraph(object):
+    '''
+    Linear classifiers for the classification models, fitted with numpy 
+    instead of a tensorflow graph. Has the same interface as actConnGraph
+    (launchGraph, AccTr, AccTe, accAll, evalVars), so it can be used in 
+    its place by optoConn.
+
+    ________________________________________________________________________
+
+                                     ARGUMENTS
+    ________________________________________________________________________
+ 
+    
+    featDict: Dictionnary that contains the parameters used. The model 
+              can be
+
+                 '__classLogit__' : Logistic regression with a L2 penalty
+                                    of linReg, fitted with Newton's method 
+                                    (IRLS)
+                 '__classLDA__'   : LDA with the covariance shrunk towards 
+                                    the identity by linReg (0 to 1)
+
+              and the same with 'Pairs' for the dataPrepClassiPairs format.
+              Both classes have the same total weight, as the balanced 
+              batches of actConnGraph. 
+
+    ________________________________________________________________________
+
+    '''
+
+    models = [ '__classLogit__', '__classLDA__', '__classLogitPairs__', '__classLDAPairs__' ]
+
+    def __init__(self, featDict):
+
+        #Assigining attributes from featDict
+        for key, val in featDict.items():
+                setattr(self, key, val)
+
+        #Saving dictionnary
+        self._pDict = featDict
+
+        if not hasattr(self, 'linReg'):
+            self.linReg = 0.01
+
+
+    def launchGraph(self, D, detail = True, savepath = None):
+        ''' Will fit the classifiers on the training set and calculate the 
+            accuracy on both sets (see actConnGraph._finalAcc) '''
+
+        t = time.time() # Current time
+
+        Xtr, Ytr, Str = self._stack(D['Xtr'], D['Ytr'])
+        Xte, Yte, Ste = self._stack(D['Xte'], D['Yte'])
+
+        if 'LDA' in self.model:
+            W, B = self._fitLDA(Xtr, Ytr, Str)
+        else:
+            W, B = self._fitLogit(Xtr, Ytr, Str)
+
+        self.evalVars = {'linW': W, 'linB': B}
+
+        #Answers of each sequence
+        self.respTr = np.einsum('pnd,pd->pn', Xtr, W) + B.reshape(-1,1) > 0
+        self.respTe = np.einsum('pnd,pd->pn', Xte, W) + B.reshape(-1,1) > 0
+
+        self.AccTr = self._balancedAcc(self.respTr, Ytr, Str)
+        self.AccTe = self._balancedAcc(self.respTe, Yte, Ste)
+
+        if not 'Pairs' in self.model:
+            self.AccTr = self.AccTr[0]
+            self.AccTe = self.AccTe[0]
+
+        if detail:
+            print('\nFinal training accuracy : {:.2f} '.format(np.mean(self.AccTr)))
+            print(  'Final testing accuracy  : {:.2f} '.format(np.mean(self.AccTe)))
+            print('\nTotal time:  ' + str(datetime.timedelta(seconds = time.time()-t)))
+
+        if 'Pairs' in self.model:
+            #Accuracy matrix of all pairs (nFolds x nTargets x nDecoders)
+            self.accAll = actConnGraph._pairAccMat(self, D, self.AccTe)
+            return self.accAll
+
+        return self.AccTe
+
+
+    def close(self):
+        ''' No session to close (see actConnGraph.close) '''
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def _stack(self, Dx, Dy):
+        ''' 
+        Sequences of each pair classifier (nPairs x n x seqLen), stim 
+        sequences first, with their labels and weights (nPairs x n). Weights
+        are 0 for padded sequences and sum to 1/2 for each label. 
+        '''
+
+        if 'Pairs' in self.model:
+            X, n = Dx, Dy
+        else:
+            X = [ np.asarray(Dx[0])[None], np.asarray(Dx[1])[None] ]
+            n = [ np.array([len(Dx[0])]), np.array([len(Dx[1])]) ]
+
+        Y = np.concatenate([ np.ones(X[0].shape[:2]), np.zeros(X[1].shape[:2]) ], axis = 1)
+        S = np.concatenate([ (np.arange(X[l].shape[1]) < n[l].reshape(-1,1)) / 
+                             (2.*np.maximum(n[l], 1).reshape(-1,1)) for l in range(2) ], axis = 1)
+
+        return np.concatenate(X, axis = 1).astype(np.float64), Y, S
+
+
+    def _fitLogit(self, X, Y, S, maxIter = 50, tol = 1e-6, ridge = 1e-8):
+        ''' 
+        Weighted logistic regressions of all pairs with Newton's method. The
+        steps are halved until the penalized loss decreases, and a small 
+        ridge on all the coefficients (intercept included) keeps the Hessian
+        invertible and the solution finite, e.g. with linReg = 0 on 
+        separable data. Pairs without training sequences keep null 
+        coefficients.
+        '''
+
+        P, n, d = X.shape
+
+        #Intercept as last input, only penalized by ridge
+        Xa  = np.concatenate([ X, np.ones([P,n,1]) ], axis = 2)
+        pen = np.diag( np.append(np.ones(d)*self.linReg, 0) + ridge )
+
+        def loss(beta):
+            #Penalized loss of each pair, stable for large |z|
+            z = np.einsum('pnd,pd->pn', Xa, beta)
+            return np.sum( S*(np.logaddexp(0, z) - Y*z), axis = 1 ) + \
+                   np.einsum('pd,de,pe->p', beta, pen, beta)/2
+
+        fit  = S.sum(axis = 1) > 0 #Pairs with training sequences
+        beta = np.zeros([P,d+1])
+        f    = loss(beta)
+
+        for it in range(maxIter):
+            prob = ( 1 + np.tanh(np.einsum('pnd,pd->pn', Xa, beta)/2) )/2
+
+            grad = np.einsum('pnd,pn->pd', Xa, S*(prob-Y)) + beta.dot(pen)
+            hess = np.einsum('pnd,pn,pne->pde', Xa, S*prob*(1-prob), Xa) + pen
+
+            step = np.zeros([P,d+1])
+            if fit.any():
+                step[fit] = np.linalg.solve(hess[fit], grad[fit][:,:,None])[:,:,0]
+
+            #Halving the step of the pairs whose loss increases
+            t    = np.ones([P,1])
+            fNew = loss(beta - t*step)
+            for h in range(30):
+                worse = fNew > f
+                if not worse.any():
+                    break
+                t[worse] /= 2
+                fNew = np.where(worse, loss(beta - t*step), fNew)
+
+            #No decrease at all, pair is kept as is
+            worse = fNew > f
+            t[worse] = 0
+            fNew[worse] = f[worse]
+
+            beta -= t*step
+            f     = fNew
+
+            if np.absolute(t*step).max() < tol:
+                break
+
+        return beta[:,:d], beta[:,d]
+
+
+    def _fitLDA(self, X, Y, S):
+        ''' Weighted LDA of all pairs with a shrunk pooled covariance '''
+
+        d = X.shape[2]
+
+        #Weighted mean of each label (weights sum to 1/2 per label)
+        mu1 = np.einsum('pnd,pn->pd', X, S*Y)*2
+        mu0 = np.einsum('pnd,pn->pd', X, S*(1-Y))*2
+
+        #Pooled within label covariance
+        Xc  = X - np.where(Y[:,:,None] > 0, mu1[:,None], mu0[:,None])
+        cov = np.einsum('pnd,pn,pne->pde', Xc, S, Xc)
+
+        #Shrinkage towards identity with the same trace
+        g   = self.linReg
+        tr  = np.trace(cov, axis1 = 1, axis2 = 2).reshape(-1,1,1) / d
+        cov = (1-g)*cov + g*tr*np.eye(d) + 1e-12*np.eye(d)
+
+        W = np.linalg.solve(cov, (mu1-mu0)[:,:,None])[:,:,0]
+        B = -np.sum(W*(mu1+mu0), axis = 1)/2
+
+        return W, B
+
+
+    def _balancedAcc(self, resp, Y, S):
+        ''' Balanced accuracy (in %) of each pair classifier '''
+
+        #Weights sum to 1/2 per label
+        return np.sum( S * (resp == (Y > 0)), axis = 1 ) * 100
+
+
+class narRidgeGraph(object):
+    '''
+    Linear NAR model (the linear variant of __NAR__) fitted as a ridge 
+    regression with the normal equations instead of a tensorflow graph. 
+    The lagged Gram matrices are accumulated over chunks of consecutive 
+    sequences, and the fit is exact in a single pass. The design matrix is
+    only never built when the sequences are the sliding window view of the
+    recording (window = True, which optoConn sets for this model), where a
+    chunk of sequences is a chunk of time of the recording. With copied 
+    sequences (window = False), the data is already materialized.
+    Has the same interface as actConnGraph (launchGraph, AccTr, AccTe, 
+    evalVars), so it can be used in its place by optoConn.
+
+    ________________________________________________________________________
+
+                                     ARGUMENTS
+    ________________________________________________________________________
+ 
+    
+    featDict: Dictionnary that contains the parameters used. The model 
+              can be
+
+                 '__NARridge__' : Activity at t+YDist predicted linearly 
+                                  from the activity at t, with a L2 penalty
+                                  of linReg (per sequence) on NAR_W
+
+    ________________________________________________________________________
+
+    '''
+
+    models = [ '__NARridge__' ]
+
+    def __init__(self, featDict, chunk = 10000):
+
+        #Assigining attributes from featDict
+        for key, val in featDict.items():
+                setattr(self, key, val)
+
+        #Saving dictionnary
+        self._pDict = featDict
+        self._chunk = chunk #Number of sequences read at once
+
+        if not hasattr(self, 'linReg'):
+            self.linReg = 0.01
+
+
+    def launchGraph(self, D, detail = True, savepath = None):
+        ''' Will fit NAR_W and NAR_B on the training set and calculate the 
+            accuracy on both sets (see actConnGraph._finalAcc) '''
+
+        t = time.time() # Current time
+
+        G, C, n = self._lagGram(D['Xtr'], D['Ytr'])
+
+        #Ridge solution, intercept (last input) not penalized
+        d    = G.shape[0] - 1
+        pen  = self.linReg * np.diag(np.append(np.ones(d), 0))
+        beta = np.linalg.solve(G/n + pen, C/n)
+
+        W, B = beta[:d], beta[d]
+
+        self.evalVars = {'NAR_W:0': np.float32(W), 'NAR_B:0': np.float32(B)}
+
+        self.AccTr = self._predCorr(D['Xtr'], D['Ytr'], W, B)
+        self.AccTe = self._predCorr(D['Xte'], D['Yte'], W, B)
+
+        if detail:
+            print('\nFinal training accuracy : {:.4f} '.format(self.AccTr))
+            print(  'Final testing accuracy  : {:.4f} '.format(self.AccTe))
+            print('\nTotal time:  ' + str(datetime.timedelta(seconds = time.time()-t)))
+
+        return self.AccTe
+
+
+    def close(self):
+        ''' No session to close (see actConnGraph.close) '''
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def _lagGram(self, X, Y):
+        ''' 
+        Gram matrix of the inputs (last time point of each sequence, plus an 
+        intercept) and their cross products with the outputs, summed over 
+        chunks of consecutive sequences, i.e. chunks of time of the data if X
+        is a sliding window view (see dataPrepGenerative with window). Only 
+        the chunk being summed is read and converted to float64. Returns G
+        ((d+1) x (d+1)), C ((d+1) x nOut) and the number of sequences.
+        '''
+
+        d = X.shape[2]
+        G = np.zeros([d+1, d+1])
+        C = np.zeros([d+1, Y.shape[1]])
+
+        for i in range(0, len(Y), self._chunk):
+            x = np.float64(X[i:i+self._chunk, -1, :])
+            y = np.float64(Y[i:i+self._chunk])
+
+            sx = x.sum(axis = 0)
+
+            G[:d,:d] += x.T.dot(x); G[:d,d] += sx; G[d,:d] += sx
+            G[d,d]   += len(x)
+            C[:d]    += x.T.dot(y); C[d]    += y.sum(axis = 0)
+
+        return G, C, len(Y)
+
+
+    def _predCorr(self, X, Y, W, B):
+        ''' Mean correlation between the prediction and the real values of 
+            each sequence (see actConnGraph._finalAcc), by chunks '''
+
+        corr = 0.
+        for i in range(0, len(Y), self._chunk):
+            y = np.float64(Y[i:i+self._chunk])
+            z = np.float64(X[i:i+self._chunk, -1, :]).dot(W) + B
+
+            y = y - y.mean(axis = 1, keepdims = True)
+            z = z - z.mean(axis = 1, keepdims = True)
+
+            corr += np.sum( np.sum(y*z, axis = 1) / 
+                            np.sqrt(np.sum(y**2, axis = 1)*np.sum(z**2, axis = 1)) )
+
+        return corr / len(Y)
+
+
 def plotfit(paramFile, argDict= None, idx = range(1000), ckpt='/tmp/backup.ckpt'):
     ''' 
     Will plot the real values and the fit of the model on top of it
@@ -9,10 +9,11 @@
 
 
 
-from optoConn.optoConnSet import optoConn
+from optoConn.optoConnSet import optoConn, optoEpochs
 from scipy.io             import loadmat
 from optoConn.tools       import *
 
+import os
 import h5py 
 import tensorflow as tf
 
@@ -33,11 +34,26 @@ import tensorflow as tf
     _mPath   : Path containing data, ckpt folder and main files
 
     dataset  : Dataset name to load
+                 ~> For simulations, a directory of .npy arrays with the 
+                    same name without '.npy' is used when it exists
+                    (memory-mapped, see rawFormating_simul.py). Older
+                    pickled files can be converted with npyDict2Dir.
 
     saveName : Name of checkpoint to be saved
                  ~> Will be saved in '_mPath/checkpoints/saveName'  
                  ~> A checkpoint will be saved '/tmp/backup.ckpt'
 
+    cache    : If True, the preprocessed data is stored in '_mPath/cache/'
+               and memory-mapped by the next runs with the same dataset, 
+               nInput and prepMethod (see loadDataPrep).
+
+    cacheSize: Maximum size of the cache in bytes. Least recently used 
+               datasets are removed above it.
+
+    lazy     : If True (and not cache), the sessions of optoV1 recordings
+               are not loaded in memory, only the frames needed are read
+               from the HDF5 file (see h5Sessions).
+
 
     ALGORITHM
     -----------
@@ -57,6 +73,36 @@ import tensorflow as tf
 
     sampRate  : Rate at which variables sampling is done
 
+    stepsPerRun : Number of training steps run in the graph per session
+                  run (__classOptoNN__ and __classOptoNNPairs__ only). 
+                  Gradients and tracked variables are not stored when > 1.
+
+    stopPatience : If > 0, training stops when the held-out metric (on 
+                   a validation set, see stopVal) did not improve for 
+                   stopPatience evaluations, and the best weights are 
+                   restored. For __classOptoNNPairs__, each pair keeps its
+                   own best weights and training stops when all pairs 
+                   stopped. Pairs without validation sequences keep their
+                   final weights, as do all models if training ended 
+                   before the first evaluation.
+                   The stop and best iterations are stored in stopIter
+                   and bestIter.
+
+    stopDelta    : Minimum decrease of the metric to be an improvement
+
+    stopEvery    : Number of iterations between evaluations
+
+    stopMetric   : 'loss' (mean held-out loss) or 'acc' (accuracy)
+
+    stopVal      : Fraction of the training sequences held out as the 
+                   validation set of early stopping (the last ones of each
+                   label and pair). The testing set is only used for the
+                   final accuracy.
+
+    prefetch  : Number of feeds assembled in advance on a background 
+                thread, in preallocated buffers (see batchFeeder). 
+                0 to assemble them when needed.
+
     v2track   : List of name of variables to track (sample)
                  ~> If set to 0, no sampling will be performed
 
@@ -73,10 +119,16 @@ import tensorflow as tf
     actfct     : Model's activation function for NN 
     model      : Model name to use. List of models ;
                   ~> __classOptoNN__ 
+                  ~> __classOptoNNPairs__
+                  ~> __classLogit__, __classLDA__ (and ...Pairs__)
                   ~> __classOptoRNN__
                   ~> __NAR__      
+                  ~> __NARridge__
 
                  (see graph.py for more information)
+
+    linReg     : L2 penalty of __classLogit__ and __NARridge__ or covariance
+                 shrinkage (0 to 1) of __classLDA__
     
     nhidGlob * : Number of hidden units in global  dynamic cell
 
@@ -99,12 +151,31 @@ import tensorflow as tf
                1st cell is the stimulated cell.
                2nd cell is the decoding cell.
 
+    pairs : List of [cells[0], cells[1]] pairs to classify together 
+            with __classOptoNNPairs__. If None, all the stimulated cells
+            are paired with all the units.
+
+    nFolds: Number of cross-validation folds trained per pair with 
+            __classOptoNNPairs__.
+
+    nNull : Number of label-shuffled replicas trained per pair along the
+            folds (linear Pairs models), each with its own nFolds folds. 
+            Their accuracies averaged over folds are the permutation null
+            of each pair (graph.accNull) and give graph.pVal. 
+            All replicas are in the same graph, so its variables and 
+            activations (and the data) are (1 + nNull) times larger. For 
+            that reason, __classOptoNNPairs__ does not accept nNull > 0.
+
     ctrl  : What data set to use as a control for classification
 
                Can be either ;
                    ~> noStim     will use stimulation of other cells
                    ~> spont      will use spontaneous activity 
 
+    spontRedraw : If True (and ctrl is spont), new training windows of
+                  spontaneous activity are drawn at every epoch instead
+                  of using a fixed set (class models, see spontSampler).
+
     prepMethod : Data preparation method (#) on whole dataset
 
                    1: standardization
@@ -115,6 +186,11 @@ import tensorflow as tf
 
     null     : If True, the labels will be shuffled. 
 
+    window   : If True, the sequences of the activity prediction models 
+               are sliding window views of the data instead of copies,
+               and batches are gathered when fed to the graph. Use for 
+               long recordings.
+
     seqRange : Range of sequence to use for the models.
 
                 For classification models :
@@ -133,7 +209,7 @@ import tensorflow as tf
 
 '''
 
-def simul(argDict = None, run = True, graph = None):
+def simul(argDict = None, run = True, graph = None, epochs = None, epochsOnly = False):
     ''' 
     Parameter file for simulation.
     
@@ -144,6 +220,12 @@ def simul(argDict = None, run = True, graph = None):
 
     argDict : Overwriting certain paramers. Has to be of type dict
     run     : If running the simulation or not
+    graph   : Graph of a previous call to reuse
+    epochs  : Stimulation epochs (epochData) of a previous call to 
+              reuse instead of loading the dataset (e.g. graph.epochs)
+    epochsOnly : If True, only the stimulation epochs (epochData) of the 
+                 dataset are built and returned, without a graph (see 
+                 optoEpochs)
 
     _______________________________________________________________
 
@@ -164,6 +246,8 @@ def simul(argDict = None, run = True, graph = None):
     dataset  = 'stblock_30Hz_30ms_25obs_20spar_y97.npy'
     #_mPath   = '/home/phabc/Main/research/janelia/turaga/Shotgun/'
     saveName = 'block.ckpt'
+    cache     = False
+    cacheSize = 20e9
 
     # algorithm parameters
     detail    = True
@@ -214,7 +298,8 @@ def simul(argDict = None, run = True, graph = None):
             'nOut'      : nOut   ,    'sampRate': sampRate, 'v2track'   : v2track,
             'sparsW'    : sparsW,     'lossW'   : lossW,    'nhidclassi': nhidclassi,
             'cells'     : cells,      'ctrl'    : ctrl,     'detail'    : detail,
-            'keepProb'  : keepProb,   'null'    : null,
+            'keepProb'  : keepProb,   'null'    : null,     'cache'     : cache,
+            'cacheSize' : cacheSize,
                  }
 
     #Overwrite any parameters with extra arguments
@@ -228,23 +313,32 @@ def simul(argDict = None, run = True, graph = None):
     else:
         paramDict['seqLen'] = paramDict['seqRange'][0]
 
-    #Loading data 
-    dataD = loadDataRand('simul', _mPath, paramDict['dataset'])
-    
-    if 'class' in paramDict['model']:
-        dataD['stimIdx'] = dataD['stimIdx']
+    #Loading data, unless graph already holds the stimulation epochs of this dataset
+    if epochs is None:
+        epochs = getattr(graph, 'epochs', None)
+
+    if epochs is not None and epochs.key == epochKey(paramDict):
+        dataD = epochs
+    elif paramDict['cache']:
+        dataD = loadDataPrep('simul', _mPath, paramDict)
+    else:
+        dataD = loadDataRand('simul', _mPath, paramDict['dataset'])
     
+    if epochsOnly:
+        return optoEpochs(paramDict, dataD)
   
     graph, dataDict, Acc = optoConn(paramDict, dataD, run= run, graph= graph)
 
     return graph, dataDict, optoConn
 
 
-def optoV1(argDict = None, run = True, graph= None):
+def optoV1(argDict = None, run = True, graph= None, epochs = None, epochsOnly = False):
     ''' parameter file for simulation.keepProb  = 0.5
         keepProb  = 0.5
         run     : If running the simulation or not
         argDict : Overwriting certain paramers. Has to be of type dict
+        epochs  : Stimulation epochs (epochData) to reuse, see simul
+        epochsOnly : Only returns the stimulation epochs, see simul
          '''
 
     # General Parameters ---------------------------------------------------------------
@@ -254,6 +348,9 @@ def optoV1(argDict = None, run = True, graph= None):
     dataset  = 'optogenExp.h5'
     #_mPath   = '/home/phabc/Main/research/janelia/turaga/Shotgun/'
     saveName = 'opto.ckpt'
+    cache     = False
+    cacheSize = 20e9
+    lazy      = False
 
     # algorithm parameters
     detail    = False
@@ -301,7 +398,8 @@ def optoV1(argDict = None, run = True, graph= None):
             'nOut'      : nOut   ,    'sampRate': sampRate, 'v2track'   : v2track,
             'sparsW'    : sparsW,     'lossW'   : lossW,    'nhidclassi': nhidclassi,
             'cells'     : cells,      'ctrl'    : ctrl,     'detail'    : detail,
-            'keepProb'  : keepProb,   'null'    : null,
+            'keepProb'  : keepProb,   'null'    : null,     'cache'     : cache,
+            'cacheSize' : cacheSize,  'lazy'    : lazy,
                  }
 
     #Overwrite any parameters with extra arguments
@@ -315,93 +413,232 @@ def optoV1(argDict = None, run = True, graph= None):
     else:
         paramDict['seqLen'] = paramDict['seqRange'][0]
 
-    # Loading data 
+    # Loading data, unless graph already holds the stimulation epochs of this dataset
     #print('Loading Data      ...')
-    dataD = loadDataRand('optoV1', _mPath, dataset)
-    dataD.update(loadDataSpont('optoV1', _mPath, paramDict['dataset']))
+    if epochs is None:
+        epochs = getattr(graph, 'epochs', None)
+
+    if epochs is not None and epochs.key == epochKey(paramDict):
+        dataD = epochs
+    elif paramDict['cache']:
+        dataD = loadDataPrep('optoV1', _mPath, paramDict)
+    else:
+        dataD = loadDataRand('optoV1', _mPath, dataset, lazy = paramDict['lazy'])
+        dataD.update(loadDataSpont('optoV1', _mPath, paramDict['dataset'], lazy = paramDict['lazy']))
+
+    if epochsOnly:
+        return optoEpochs(paramDict, dataD)
 
     graph, dataDict, Acc = optoConn(paramDict, dataD, run= run, graph= graph)
 
     return graph, dataDict, Acc
 
 
-def loadDataRand(mainName, mPath, dataset):
+def screenPairs(argDict, main = simul, stat = 't', threshold = 3., 
+                model = '__classOptoNNPairs__'):
+    ''' 
+    Two-stage connectivity inference. All the (stimulated cell, decoding 
+    cell) pairs are first screened with cheap statistics computed at once 
+    from the stimulation epochs (see pairScreen), and only the pairs with 
+    enough evidence of a connection are escalated to the batched pair 
+    classifiers. Pruned pairs are given the chance accuracy (50%).
+
+    _______________________________________________________________
+
+                            ARGUMENTS
+    _______________________________________________________________
+
+    argDict   : Parameters of main (dataset, seqRange, nFolds, etc.)
+    main      : Parameter file loading the data (simul or optoV1)
+    stat      : Screening statistic, 't', 'effect' or 'auc'
+    threshold : Pairs with |stat| > threshold are escalated 
+                (|auc - 0.5| > threshold for 'auc')
+    model     : Pair classifiers of the escalated pairs
+
+    _______________________________________________________________
+
+                             RETURNS
+    _______________________________________________________________
+
+    screen : { map       : Accuracy of every pair, of size
+                           nFolds x nTargets x nN,
+               escalated : Pairs sent to the classifiers (nPairs x 2),
+               stats     : Screening statistics (see pairScreen) }
+
+    _______________________________________________________________
+
+    '''
+
+    #Extracting the stimulation epochs once, without a graph
+    ED = main(argDict, epochsOnly = True)
+
+    #Screening all pairs
+    stats    = pairScreen(ED, argDict.get('targets'))
+    evidence = np.abs( stats[stat] - 0.5 ) if stat == 'auc' else np.abs(stats[stat])
+    evidence[np.isnan(evidence)] = 0
+
+    tIdx, dIdx = np.nonzero(evidence > threshold)
+    escalated  = np.stack( [stats['targets'][tIdx], dIdx + 1], axis = 1 )
+
+    nFolds  = argDict.get('nFolds', 1)
+    connMap = np.ones([ nFolds, len(stats['targets']), ED.nN ]) * 50
+
+    print( 'Escalated pairs : {} / {}'.format(len(escalated), evidence.size) )
+
+    if len(escalated):
+        #Classifying the escalated pairs in a single batched graph
+        G,D,_ = main( dict(argDict, model = model, pairs = escalated.tolist()),
+                      run = True, epochs = ED )
+        G.close()
+
+        #Accuracy of the escalated pairs in the whole map
+        targets  = np.unique(D['pairs'][:,0])
+        decoders = np.unique(D['pairs'][:,1])
+        accAll   = G.accAll[ :, np.searchsorted(targets,  escalated[:,0]),
+                                np.searchsorted(decoders, escalated[:,1]) ]
+
+        connMap[:, tIdx, dIdx] = accAll
+
+    return {'map': connMap, 'escalated': escalated, 'stats': stats}
+
+
+def loadDataPrep(mainName, mPath, paramDict, dsNoList = ['02','05','06','07'], 
+                                              dsNoSpont = ['07']):
+    ''' Will load the data of loadDataRand (and loadDataSpont for optoV1) with 
+        the dataset already truncated to paramDict['nInput'] units and 
+        preprocessed with paramDict['prepMethod'] (see prepDataset). 
+
+        The result is cached in mPath/cache/ under a hash of the dataset file
+        (or of its directory, see saveNpyDir), dsNoList, nInput and 
+        prepMethod. The next calls with the same arguments only open the 
+        memory-mapped arrays, and the least recently used entries are 
+        removed above paramDict['cacheSize'] bytes.'''
+
+    cacheDir   = mPath + 'cache/'
+    dPath      = mPath + 'data/' + paramDict['dataset'] # Dataset path
+    nInput     = paramDict['nInput']
+    prepMethod = paramDict['prepMethod']
+
+    #Directory format of the dataset (see loadDataRand)
+    dDir = dPath.rsplit('.npy',1)[0]
+    if os.path.isdir(dDir):
+        dPath = dDir
+
+    key  = cacheKey(dPath, mainName, dsNoList, dsNoSpont, nInput, prepMethod)
+    data = cacheLoad(cacheDir, key)
+
+    if data is None:
+        data = loadDataRand(mainName, mPath, paramDict['dataset'], dsNoList)
+        if mainName == 'optoV1':
+            data.update(loadDataSpont(mainName, mPath, paramDict['dataset'], dsNoSpont))
+
+        #Keeping nInput units
+        data['dataset']  = data['dataset'][:nInput,:]
+        data['baseline'] = data['baseline'][:nInput,:]
+
+        #Preprocessing 
+        data['dataset']  = np.float32(prepDataset(data, prepMethod))
+        data['prepDone'] = np.array(prepMethod)
+
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        cacheSave(cacheDir, key, data, paramDict['cacheSize'])
+
+    return data
+
+
+def loadDataRand(mainName, mPath, dataset, dsNoList = ['02','05','06','07'], lazy = False):
     ''' Will load the data for different
-        main file of random stim condition'''
+        main file of random stim condition
+
+        If lazy, the sessions of dataset and baseline are not read, but 
+        concatenated virtually (see h5Sessions).'''
 
     if mainName == 'optoV1':
-        dsNoList = ['02','05','06','07']
         #dsNoList =['08','09','10'] #list of datasets to load
 
         #Loading data (baseline removed)
         dPath = mPath + 'data/' + dataset  # Dataset path
-        dat   = h5py.File(dPath)
-
-        #Taking only elements related to dataset selected and renaming
-        dat = { key: dat[key] for No in dsNoList for key in dat if No in key}
-
-        #Number of frames per dataset (have to be identical shape)
-        if '10' in dsNoList:
-            T = dat['dataset10'].shape[1]
-        else :
-            T = 1
+        dat   = h5py.File(dPath, 'r')
 
         #Initializing data dictionnary
         data = {'dataset':[], 'baseline':[], 'stimFrame':[],'stimIdx':[]}
 
-        frameSet= 0 #To count frame datasets
-        for key in sorted(dat):
-            if   'base' in key:
-                data['baseline'].append(dat[key][:])
-            elif 'data' in key:
-                data['dataset'].append(dat[key][:])
-            elif 'stimF' in key:
-                data['stimFrame'].append(dat[key][:]+T*frameSet)
-                frameSet +=1 #Correcting for the stacking
-            elif 'Idx' in key:
-                data['stimIdx'].append(dat[key][:].T)
+        T = 0 #First frame of current session in the stacked sessions
+        for No in sorted(dsNoList):
+            #Taking only elements related to session selected
+            keys = sorted([key for key in dat if No in key])
+
+            #Sessions without frames are skipped (no offset to add)
+            if not any('data' in key for key in keys):
+                continue
+
+            for key in keys:
+                if   'base' in key:
+                    data['baseline'].append(dat[key] if lazy else dat[key][:])
+                elif 'data' in key:
+                    data['dataset'].append(dat[key] if lazy else dat[key][:])
+                    nT = dat[key].shape[1] #Number of frames of session
+                elif 'stimF' in key:
+                    data['stimFrame'].append(dat[key][:] + T)
+                elif 'Idx' in key:
+                    data['stimIdx'].append(dat[key][:].T)
+
+            T += nT #Correcting for the stacking
 
         #Stacking database
-        data = {key: np.hstack(data[key]) for key in data}
+        for key in data:
+            if lazy and key in ['dataset', 'baseline']:
+                data[key] = h5Sessions(data[key])
+            else:
+                data[key] = np.hstack(data[key])
+
         #Transposing stimIdx
         data['stimIdx'] = data['stimIdx'].T
 
     elif mainName == 'simul':
 
         dPath = mPath + 'data/' + dataset
-        data   = np.load(dPath).all()
+        dDir  = dPath.rsplit('.npy',1)[0] # Directory format (see saveNpyDir)
+
+        if os.path.isdir(dDir):
+            #Memory-mapped arrays, shared by all processes through page cache
+            data = loadNpyDir(dDir)
+        else:
+            #Legacy pickled dictionnary (convert with npyDict2Dir)
+            data = np.load(dPath, allow_pickle = True).item()
 
     return data
 
 
-def loadDataSpont(mainName, mPath, dataset):
+def loadDataSpont(mainName, mPath, dataset, dsNoList = ['07'], lazy = False):
     ''' Will load the data for different
-        main file '''
+        main file 
 
-    if mainName == 'optoV1':
+        If lazy, the sessions are concatenated virtually (see h5Sessions).'''
 
-        dsNoList =['07'] #list of datasets to load
+    if mainName == 'optoV1':
 
         #Loading data (baseline removed)
         dPath = mPath + 'data/' + dataset  # Dataset path
-        dat   = h5py.File(dPath)
+        dat   = h5py.File(dPath, 'r')
 
         #Taking only elements related to dataset selected and renaming
         dat = { key: dat[key] for No in dsNoList for key in dat if No in key}
 
-        #Number of frames per dataset (have to be identical shape)
-
         #Initializing data dictionnary
         data = {'datasetSpont':[], 'baselineSpont':[] }
 
-        frameSet= 0 #To count frame datasets
         for key in sorted(dat):
             if   'base' in key:
-                data['baselineSpont'].append(dat[key][:])
+                data['baselineSpont'].append(dat[key] if lazy else dat[key][:])
             elif 'data' in key:
-                data['datasetSpont'].append(dat[key][:])
+                data['datasetSpont'].append(dat[key] if lazy else dat[key][:])
 
         #Stacking database
-        data = {key: np.hstack(data[key]) for key in data}
+        if lazy:
+            data = {key: h5Sessions(data[key]) for key in data}
+        else:
+            data = {key: np.hstack(data[key]) for key in data}
 
     return data
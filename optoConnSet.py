@@ -28,7 +28,10 @@ def optoConn(paramDict, data, run = True, graph= None):
     paramDict: Contains all the parameters passed into graph,
                which will be unpacked and added to class attributes
     data     : Data matrix of size (nb_input_units x time)
-    run      : Will run the model or not
+    run      : Will run the model or not. The session of a graph built
+               here is closed after the run, the one of a given graph is
+               kept open for the next runs (see actConnGraph.close)
+    graph    : Graph of a previous call to run again
     _______________________________________________________________
 
 
@@ -39,7 +42,11 @@ def optoConn(paramDict, data, run = True, graph= None):
                'dataset':'FR_RNN.mat', '_mPath': expanduser("~") + '/.optoConn/',
                'saveName': 'ckpt.ckpt', 'learnRate': 0.0001, 'nbIters':10000,
                'batchSize': 50, 'dispStep':200, 'model': '__NGCmodel__', 'detail':True,
-               'actfct':tf.tanh,'prepMethod':1, 'YDist':1 , 'sampRate':0             
+               'actfct':tf.tanh,'prepMethod':1, 'YDist':1 , 'sampRate':0,
+               'pairs': None, 'nFolds': 1, 'window': False, 'spontRedraw': False,
+               'stepsPerRun': 1, 'prefetch': 0, 'stopPatience': 0, 'stopDelta': 0,
+               'stopEvery': 100, 'stopMetric': 'loss', 'stopVal': 0.2, 'linReg': 0.01,
+               'nNull': 0
              }       
 
     #Updatating pDict with input dictionnary
@@ -50,36 +57,83 @@ def optoConn(paramDict, data, run = True, graph= None):
 
 
     #Formatting data
-    if type(data) is dict:
+    epochs = None #Stimulation epochs that can be reused by graph
+
+    if pDict['model'] in narRidgeGraph.models:
+        pDict['window'] = True #Sequences are only read by chunks, no copy needed
+
+    #Each replica adds nPairs classifiers to the graph, only cheap for linear ones
+    if pDict['nNull'] and 'Pairs' in pDict['model'] and pDict['model'] not in linClassiGraph.models:
+        raise ValueError('Label-shuffled replicas (nNull = {}) '.format(pDict['nNull']) +
+                         'are only trained with the linear Pairs models' +
+                         ' (__classLogitPairs__, __classLDAPairs__).')
+
+    if isinstance(data, epochData):
+        #Stimulation epochs already extracted (see epochData)
+        epochs = data
+
+        pDict['nInput']    = 1
+        pDict['batchSize'] = pDict['batchSize']*2
+
+        if 'Pairs' in pDict['model']:
+            dataDict = dataPrepClassiPairs( epochs,
+                                            pairs  = pDict['pairs'],
+                                            nFolds = pDict['nFolds'],
+                                            nNull  = pDict['nNull'],
+                                            ctrl   = pDict['ctrl'],
+                                            null   = pDict['null']  )
+            pDict['nPairs'] = len(dataDict['fold'])
+        else:
+            dataDict = epochs.pairData( pDict['cells'],
+                                        ctrl = pDict['ctrl'],
+                                        null = pDict['null']  )
+        dataDict.update(epochs.data)
+
+    elif type(data) is dict:
         if data['dataset'].shape[0] != pDict['nInput']:
            data['dataset'] = data['dataset'][:pDict['nInput'],:]
            data['baseline'] = data['baseline'][:pDict['nInput'],:]
 
-        if 'class' in pDict['model']:
+        if 'Pairs' in pDict['model']:
             pDict['nInput']    = 1
             pDict['batchSize'] = pDict['batchSize']*2
-            dataDict = dataPrepClassi( data,
-                                       ctrl       = pDict['ctrl'],
-                                       cells      = pDict['cells'],
-                                       null       = pDict['null'] ,
-                                       seqRange   = pDict['seqRange'], 
-                                       prepMethod = pDict['prepMethod']  )
+            dataDict = dataPrepClassiPairs( data,
+                                            pairs      = pDict['pairs'],
+                                            nFolds     = pDict['nFolds'],
+                                            nNull      = pDict['nNull'],
+                                            ctrl       = pDict['ctrl'],
+                                            null       = pDict['null'] ,
+                                            seqRange   = pDict['seqRange'], 
+                                            prepMethod = pDict['prepMethod']  )
+            pDict['nPairs'] = len(dataDict['fold'])
+
+        elif 'class' in pDict['model']:
+            #Extracting the stimulation epochs of all units once
+            epochs   = optoEpochs(pDict, data)
+
+            pDict['nInput']    = 1
+            pDict['batchSize'] = pDict['batchSize']*2
+            dataDict = epochs.pairData( pDict['cells'],
+                                        ctrl = pDict['ctrl'],
+                                        null = pDict['null']  )
         else:
             dataDict = dataPrepGenerative( data, 
                                            seqRange   = pDict['seqRange'],
                                            prepMethod = pDict['prepMethod'],
-                                           null       = pDict['null'] )
+                                           null       = pDict['null'],
+                                           window     = pDict['window'] )
 
         tempD = {key: data[key] for key in data if key not in 'dataset'}
         dataDict.update(tempD)
     else:
         dataDict = dataPrepGenerative( data, 
                                        seqRange     = pDict['seqRange'],
-                                       prepMethod   = pDict['prepMethod'] 
+                                       prepMethod   = pDict['prepMethod'],
+                                       window       = pDict['window'] 
                                        )
 
     #InputSize warming
-    if type(data) is not dict:
+    if type(data) is not dict and epochs is None:
         nInput = dataDict['Xtr'].shape[2]
         if nInput != pDict['nInput']:
             raise ValueError('Number of input units in'       +
@@ -90,15 +144,51 @@ def optoConn(paramDict, data, run = True, graph= None):
 
     #Build graph
     #print('Building Graph    ...')
-    if not graph:
+    newGraph = not graph #Session of a graph built here is closed after the run
+
+    if not graph and pDict['model'] in linClassiGraph.models:
+      #Linear classifiers fitted with numpy
+      graph = linClassiGraph(pDict)
+    elif not graph and pDict['model'] in narRidgeGraph.models:
+      #Linear NAR fitted with numpy
+      graph = narRidgeGraph(pDict)
+    elif not graph:
       graph = actConnGraph(pDict)
 
+    #Keeping epochs in graph for the next runs on the same data
+    if epochs is not None:
+      graph.epochs = epochs
+
     #Launch Graph
     if run:
         #print('Launching Session ...')
         Acc = graph.launchGraph( dataDict, detail = pDict['detail'], savepath = savepath )
+
+        if newGraph:
+            graph.close()
     else:
         Acc = None
 
     return graph, dataDict, Acc
 
+
+
+def optoEpochs(pDict, data):
+    '''
+    Stimulation epochs (epochData) of all units of data, built the same way
+    optoConn does for the classification models (identified by epochKey),
+    but without building a graph. data can be a data dictionnary (truncated
+    to pDict['nInput'] units) or an epochData, which is returned as is.
+    '''
+
+    if isinstance(data, epochData):
+        return data
+
+    if data['dataset'].shape[0] != pDict['nInput']:
+       data['dataset'] = data['dataset'][:pDict['nInput'],:]
+       data['baseline'] = data['baseline'][:pDict['nInput'],:]
+
+    return epochData( data,
+                      seqRange   = pDict['seqRange'], 
+                      prepMethod = pDict['prepMethod'],
+                      key        = epochKey(pDict)  )
@@ -4,7 +4,7 @@ import collections
 import numpy as np
 
 from scipy.io import loadmat 
-from activeConn.tools import *
+from optoConn.tools import *
 ''' Will remove baseline of all the dataset in h5py file
 	and store them in a new h5py file '''
 
@@ -38,4 +38,5 @@ dat = {
         'W'        : sim['W'][0][0]
        }
 
-np.save(_mPath+'data/'+saveName, dat)
+#Directory of .npy arrays, memory-mapped when loaded (see loadNpyDir)
+saveNpyDir(_mPath+'data/'+saveName, dat)
@@ -0,0 +1,423 @@
+import numpy      as np
+import pytest
+import tensorflow as tf
+
+from optoConn.graphs      import actConnGraph, linClassiGraph
+from optoConn.optoConnSet import optoConn
+from optoConn.tools       import permTest
+
+
+N  = 4   #Number of units
+
+def classData(seed = 0):
+    ''' Random recording with every unit stimulated in turn, where unit 2
+        responds to the stimulations of unit 1 '''
+
+    rng = np.random.RandomState(seed)
+    F   = np.arange(50, 1950, 10)
+    I   = np.arange(len(F)) % N + 1
+
+    D = rng.randn(N, 2000)
+    D[1, F[I == 1] + 1] += 3
+
+    return { 'dataset'  : D,
+             'baseline' : np.ones([N, 2000]),
+             'stimFrame': F.reshape(-1,1),
+             'stimIdx'  : I.reshape(-1,1) }
+
+
+def graphParams(**kw):
+    ''' Small classifier, without dropout '''
+
+    pDict = { 'model': '__classOptoNN__', 'nInput': N, 'cells': [1,2], 'ctrl': 'noStim',
+              'null': False, 'seqRange': [[-2,0],[0,4]], 'seqLen': 6, 'detail': False,
+              'batchSize': 4, 'nbIters': 20, 'learnRate': 0.01, 'keepProb': 1.,
+              'nhidclassi': 8, 'multiLayer': 1, 'sparsW': 0., 'lossW': 1,
+              'actfct': tf.nn.relu, 'v2track': [''], 'nhidGlob': 2, 'nhidNetw': N,
+              'nOut': N, 'dispStep': 5 }
+    pDict.update(kw)
+    return pDict
+
+
+def fixedInit(G, init = None):
+    ''' Every launch of G starts from the same weights (init if given) '''
+
+    sess = G._session()
+    sess.run(G._initOp)
+    if init is None:
+        init = sess.run(G.variables)
+
+    def reset():
+        sess.run(G._initOp)
+        sess.run(G._restore, feed_dict = dict(zip(G._restorePh, init)))
+
+    G.reset = reset
+    return init
+
+
+def launch(G, D, seed = 0, **kw):
+    ''' Final weights of a launch of G with the batches drawn from seed '''
+
+    for key, val in kw.items():
+        setattr(G, key, val)
+
+    np.random.seed(seed)
+    G.launchGraph(D, detail = False)
+
+    return [ G.evalVars[v.name] for v in G.variables ]
+
+
+@pytest.mark.parametrize('model', ['__classOptoNN__', '__classOptoNNPairs__'])
+def test_loopStepsMatchSingleSteps(model):
+    pairs = {'pairs': [[1,2],[3,2]], 'nFolds': 2} if 'Pairs' in model else {}
+
+    np.random.seed(0)
+    G, D, _ = optoConn(graphParams(model = model, stepsPerRun = 6, **pairs), classData(), run = False)
+    fixedInit(G)
+
+    #nbIters is not a multiple of stepsPerRun, the last run is shorter
+    loop   = launch(G, D, stepsPerRun = 6)
+    single = launch(G, D, stepsPerRun = 1)
+
+    for wL, wS in zip(loop, single):
+        assert np.allclose(wL, wS, atol = 1e-5)
+
+    G.close()
+
+
+def test_maskedStepMatchesSeparateMasks(monkeypatch):
+    model = actConnGraph.__classOptoNN__
+
+    def masked(self, _Z1):
+        #Constant mask and mask of the updated weights
+        Z2 = model(self, _Z1)
+        self.masks = { '2inW' : np.float32(np.arange(self.seqLen*self.nhidclassi) % 2).reshape(self.seqLen, -1),
+                       '0outW': lambda W: tf.clip_by_value(W['out'], -0.005, 0.005) }
+        return Z2
+
+    monkeypatch.setattr(actConnGraph, '__classOptoNN__', masked)
+
+    np.random.seed(0)
+    G, D, _ = optoConn(graphParams(learnRate = 0.1), classData(), run = False)
+    init = fixedInit(G)
+    sess = G._session()
+
+    #Masks run after the update, as launchGraph did before they were fused
+    with G.graph.as_default():
+        separate = G._masking()
+
+    idx = [ np.random.randint(0, len(Y), [2, G.nbIters]) for Y in D['Ytr'] ]
+    FD  = G._feedDict(D['Xtr'], D['Ytr'], 0, idx)
+
+    G.reset()
+    sess.run(G._trainStep, FD)
+    fused = sess.run(G.variables)
+
+    G.reset()
+    sess.run(G.optimizer, FD)
+    sess.run(separate)
+
+    for wF, wS, w0, v in zip(fused, sess.run(G.variables), init, G.variables):
+        assert np.allclose(wF, wS)
+        if v.name == 'inW:0':
+            assert np.all(wF[:, ::2] == 0) and np.any(wF != w0)
+        if v.name == 'outW:0':
+            assert np.all(np.abs(wF) <= 0.005)
+
+    G.close()
+
+
+def pairSlice(D, p):
+    ''' Data of pair classifier p of D alone (see dataPrepClassiPairs) '''
+
+    return dict( D, Xtr = [X[p:p+1] for X in D['Xtr']], Ytr = [n[p:p+1] for n in D['Ytr']],
+                    Xte = [X[p:p+1] for X in D['Xte']], Yte = [n[p:p+1] for n in D['Yte']],
+                    pairs = D['pairs'][p:p+1], fold = np.zeros(1, dtype = int), 
+                    null  = np.zeros(1, dtype = bool) )
+
+
+def test_pairsMatchSinglePairRuns():
+    pairs = [[1,2],[3,2],[1,4]]
+
+    np.random.seed(0)
+    G, D, _ = optoConn( graphParams(model = '__classOptoNNPairs__', pairs = pairs, nFolds = 2),
+                        classData(), run = False )
+    init = fixedInit(G)
+
+    #Batch index tables of the batched run, handed out pair by pair after
+    tables = []
+    pairIdx = G._pairIdx
+    def record(n):
+        tables.append(pairIdx(n))
+        return tables[-1]
+    G._pairIdx = record
+
+    launch(G, D)
+    accAll = G.accAll
+    assert accAll.shape == (2, 2, 2) #nFolds x targets (1,3) x decoders (2,4)
+
+    for p, (target, decode) in enumerate(D['pairs']):
+        S = actConnGraph(dict(G._pDict, nPairs = 1))
+        fixedInit(S, [v[p:p+1] for v in init])
+
+        calls = iter(range(len(tables)))
+        S._pairIdx = lambda n: tables[next(calls)][p:p+1]
+
+        launch(S, pairSlice(D, p))
+
+        #Same classifier, same place in the accuracy matrix
+        assert np.isclose(G.AccTe[p], S.AccTe[0])
+        assert np.isclose(accAll[ D['fold'][p], [1,3].index(target), [2,4].index(decode) ], S.AccTe[0])
+        S.close()
+
+    #Pair (3,4) was not trained
+    assert np.all(np.isnan(accAll[:, 1, 1]))
+
+    G.close()
+
+
+def test_pairsMatchClassOptoNN(monkeypatch):
+    import optoConn.graphs as graphs
+
+    np.random.seed(0)
+    G, D, _ = optoConn( graphParams(model = '__classOptoNNPairs__', pairs = [[1,2],[3,4]]),
+                        classData(), run = False )
+    init = fixedInit(G)
+
+    tables  = []
+    pairIdx = G._pairIdx
+    def record(n):
+        tables.append(pairIdx(n))
+        return tables[-1]
+    G._pairIdx = record
+
+    batched = launch(G, D)
+
+    for p in range(len(D['pairs'])):
+        #Baseline classifier of the pair, on its valid sequences
+        Dp = {}
+        for s in ['tr', 'te']:
+            n = [ n[p] for n in D['Y'+s] ]
+            Dp['X'+s] = [ X[p, :k] for X, k in zip(D['X'+s], n) ]
+            Dp['Y'+s] = [ np.ones(n[0]), np.zeros(n[1]) ]
+
+        S = actConnGraph(dict(G._pDict, model = '__classOptoNN__'))
+        fixedInit(S, [ v[p].reshape(w.get_shape().as_list()) for v, w in zip(init, S.variables) ])
+
+        #Same batches, drawn with randint by the baseline
+        calls = iter(tables)
+        monkeypatch.setattr(graphs, 'randint', lambda low, high, size: next(calls)[p])
+
+        single = launch(S, Dp)
+
+        for wP, wS in zip(batched, single):
+            assert np.allclose(wP[p].reshape(wS.shape), wS, atol = 1e-5)
+        assert np.isclose(G.AccTe[p], S.AccTe)
+        S.close()
+
+    G.close()
+
+
+def test_earlyStopRestoresBestPairWeights():
+    np.random.seed(0)
+    G, D, _ = optoConn( graphParams(model = '__classOptoNNPairs__', pairs = [[1,2],[3,2],[1,4]],
+                                    nbIters = 80, learnRate = 0.05, stopPatience = 3, stopEvery = 5,
+                                    stopVal = 0.3), classData(), run = False )
+
+    #Validation loss and weights of every pair at each check
+    checks    = []
+    stopCheck = G._stopCheck
+    def record(D, sess, step):
+        V     = G._Dval
+        FD    = G._feedDict(V['Xte'], V['Yte'])
+        valid = [ np.arange(X.shape[1]) < n.reshape(-1,1) for X, n in zip(V['Xte'], V['Yte']) ]
+        FD[G._lossMask] = np.float32(np.concatenate(valid, axis = 1)[:,:,None])
+
+        checks.append([step, sess.run(G._heldLoss, feed_dict = FD), sess.run(G.variables)])
+        return stopCheck(D, sess, step)
+    G._stopCheck = record
+
+    final = launch(G, D)
+    assert len(checks) and checks[-1][0] == G.stopIter
+
+    #Validation sequences of each pair and label held out of its training sequences
+    for n, nV in zip(D['Ytr'], G._Dval['Yte']):
+        assert np.all(nV >= 1) and np.all(nV < n)
+
+    loss = np.array([c[1] for c in checks])
+    for p in range(len(D['pairs'])):
+        best = np.argmin(loss[:, p]) #First check with the lowest loss
+
+        assert G.bestIter[p] == checks[best][0]
+        for w, wBest in zip(final, checks[best][2]):
+            assert np.array_equal(w[p], wBest[p])
+
+    G.close()
+
+
+def test_pairsNullReplicasLayout():
+    pairs = [[1,2],[3,2]]
+
+    np.random.seed(0)
+    G, D, _ = optoConn( graphParams(model = '__classLDAPairs__', pairs = pairs, nFolds = 2, nNull = 3),
+                        classData(), run = False )
+    accAll = G.launchGraph(D, detail = False)
+
+    #Pair classifiers ordered by fold, pairs within folds, replicas last
+    assert len(D['fold']) == len(pairs)*2*(1+3)
+    assert np.array_equal(D['fold'], np.repeat(np.arange(2*(1+3)), len(pairs)))
+    assert np.array_equal(D['null'], D['fold'] >= 2)
+
+    acc = np.zeros([2*(1+3), len(pairs)])
+    for p in range(len(D['fold'])):
+        S = linClassiGraph(G._pDict)
+        acc[D['fold'][p], p % len(pairs)] = S.launchGraph(pairSlice(D, p), detail = False)[0,0,0]
+
+    #Folds of the pairs, replicas averaged over their nFolds folds
+    assert np.allclose(accAll[:,:,0], acc[:2])
+    assert np.allclose(G.accNull[:,:,0], acc[2:].reshape(3, 2, len(pairs)).mean(axis = 1))
+    assert np.allclose(G.pVal, permTest(accAll, G.accNull))
+
+
+def logitData(P = 3, n = 40, d = 2, seed = 0, sep = 1.):
+    ''' Two overlapping gaussian labels per pair, in the _stack format '''
+
+    rng = np.random.RandomState(seed)
+    X   = [ rng.randn(P, n, d) + sep, rng.randn(P, n, d) - sep ]
+    n   = [ np.array([n]*P), np.array([n]*P) ]
+
+    return linClassiGraph({'model': '__classLogitPairs__', 'linReg': 0.01})._stack(X, n)
+
+
+def test_fitLogitMatchesReference():
+    from scipy.optimize import minimize
+
+    G       = linClassiGraph({'model': '__classLogitPairs__', 'linReg': 0.05})
+    X, Y, S = logitData()
+    W, B    = G._fitLogit(X, Y, S)
+
+    for p in range(X.shape[0]):
+        def loss(b):
+            z = X[p].dot(b[:-1]) + b[-1]
+            return np.sum( S[p]*(np.logaddexp(0, z) - Y[p]*z) ) + 0.05*np.sum(b[:-1]**2)/2
+
+        ref = minimize(loss, np.zeros(3), method = 'BFGS', options = {'gtol': 1e-10}).x
+
+        assert np.allclose(W[p], ref[:-1], atol = 1e-4)
+        assert np.isclose(B[p], ref[-1], atol = 1e-4)
+
+
+def test_fitLogitSeparableAndEmpty():
+    G       = linClassiGraph({'model': '__classLogitPairs__', 'linReg': 0.})
+    X, Y, S = logitData(sep = 10.)
+
+    #Last pair has no training sequence
+    S[-1] = 0
+
+    W, B = G._fitLogit(X, Y, S)
+
+    assert np.all(np.isfinite(W)) and np.all(np.isfinite(B))
+    assert np.all(W[-1] == 0) and B[-1] == 0
+
+    #Separable pairs are classified perfectly
+    resp = np.einsum('pnd,pd->pn', X, W) + B.reshape(-1,1) > 0
+    assert np.array_equal(resp[:-1], Y[:-1] > 0)
+
+
+@pytest.mark.parametrize('linReg', [0., 0.1])
+@pytest.mark.parametrize('window', [False, True])
+def test_NARridgeMatchesLstsq(linReg, window):
+    from optoConn.graphs import narRidgeGraph
+    from optoConn.tools  import dataPrepGenerative
+
+    rng  = np.random.RandomState(0)
+    data = np.cumsum(rng.randn(N, 503), axis = 1)*.1 + rng.randn(N, 503)
+    D    = dataPrepGenerative(data, seqRange = [3,1], prepMethod = 0, window = window)
+
+    G = narRidgeGraph({'model': '__NARridge__', 'linReg': linReg}, chunk = 7)
+    G.launchGraph(D, detail = False)
+
+    #Design matrix of the training sequences, with the intercept
+    X = np.float64(D['Xtr'][:, -1, :])
+    A = np.hstack([ X, np.ones([len(X), 1]) ])
+    Y = np.float64(D['Ytr'])
+    n = len(Y)
+
+    #Ridge as least squares with sqrt(n*linReg) rows on the weights only
+    A = np.vstack([ A, np.hstack([ np.sqrt(n*linReg)*np.eye(N), np.zeros([N,1]) ]) ])
+    Y = np.vstack([ Y, np.zeros([N, N]) ])
+    beta = np.linalg.lstsq(A, Y)[0]
+
+    assert np.allclose(G.evalVars['NAR_W:0'], beta[:N], atol = 1e-5)
+    assert np.allclose(G.evalVars['NAR_B:0'], beta[N],  atol = 1e-5)
+
+    #Gram matrices summed by chunks equal the ones of the design matrix
+    Gram, C, nSeq = G._lagGram(D['Xtr'], D['Ytr'])
+    assert nSeq == n
+    assert np.allclose(Gram, A[:n].T.dot(A[:n])) and np.allclose(C, A[:n].T.dot(Y[:n]))
+
+
+@pytest.mark.parametrize('model', ['__classOptoNN__', '__classOptoNNPairs__'])
+def test_feedBufferMatchesFeedDict(model):
+    pairs = {'pairs': [[1,2],[3,2]], 'nFolds': 2} if 'Pairs' in model else {}
+
+    np.random.seed(0)
+    G, D, _ = optoConn(graphParams(model = model, **pairs), classData(), run = False)
+
+    half = int(G.batchSize/2)
+    if 'Pairs' in model:
+        idx = [ G._pairIdx(n) for n in D['Ytr'] ]
+    else:
+        idx = [ np.random.randint(0, len(Y), [half, G.nbIters]) for Y in D['Ytr'] ]
+
+    buf = {}
+    for step in range(G.nbIters):
+        FB = G._feedDict(D['Xtr'], D['Ytr'], step, idx, buf)
+        FD = G._feedDict(D['Xtr'], D['Ytr'], step, idx)
+
+        assert set(FB) == set(FD)
+        for key in FD:
+            assert np.array_equal(np.reshape(FB[key], np.shape(FD[key])), FD[key])
+
+    #Indexes out of range are not clamped to the last sequence
+    idx[0][0, 0] = D['Xtr'][0].size
+    with pytest.raises(IndexError):
+        G._feedDict(D['Xtr'], D['Ytr'], 0, idx, buf)
+
+    G.close()
+
+
+def test_sessionClosedAfterRun():
+    np.random.seed(0)
+    G, _, _ = optoConn(graphParams(), classData())
+
+    #Graph built by optoConn, its session is closed after the run
+    assert G.sess is None
+
+    #Given graph, its session is kept for the next runs
+    G, _, _ = optoConn(graphParams(cells = [3,2]), classData(), graph = G)
+    sess = G.sess
+    assert sess is not None
+
+    with G:
+        optoConn(graphParams(cells = [1,4]), classData(), graph = G)
+        assert G.sess is sess
+
+    assert G.sess is None
+
+
+def test_pairsNullPValues():
+    np.random.seed(0)
+    G, D, _ = optoConn( graphParams(model = '__classLDAPairs__', pairs = [[1,2],[3,2]], nNull = 19),
+                        classData(), run = False )
+    G.launchGraph(D, detail = False)
+
+    #Unit 2 responds to the stimulations of unit 1, no replica reaches the pair
+    assert G.pVal.shape == (2, 1)
+    assert np.isclose(G.pVal[0,0], 1./20)
+    assert np.all(G.accNull[:,0,0] < G.accAll[:,0,0].mean())
+
+    #Shuffled replicas keep the number of stimulations of each target
+    for r in range(1, 20):
+        rows = D['fold'] == r
+        assert np.array_equal(D['Ytr'][0][rows] + D['Yte'][0][rows], D['Ytr'][0][:2] + D['Yte'][0][:2])
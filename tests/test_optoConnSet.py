@@ -0,0 +1,80 @@
+import h5py
+import numpy  as np
+import pytest
+
+from optoConn.optoConnSet import optoConn
+
+
+N  = 4   #Number of units
+sL = 6   #Sequence lenght of seqRange
+
+def classData(spont = None):
+    ''' Random recording with every unit stimulated in turn '''
+
+    rng = np.random.RandomState(0)
+    F   = np.arange(50, 1950, 20).reshape(-1,1)
+
+    data = { 'dataset'  : rng.randn(N, 2000),
+             'baseline' : np.ones([N, 2000]),
+             'stimFrame': F,
+             'stimIdx'  : (np.arange(len(F)) % N + 1).reshape(-1,1) }
+
+    if spont is not None:
+        data['datasetSpont'] = spont
+
+    return data
+
+
+def classParams(**kw):
+    pDict = { 'model': '__classLDA__', 'nInput': N, 'cells': [1,2], 'ctrl': 'noStim',
+              'null': False, 'seqRange': [[-2,0],[0,4]], 'detail': False, 'batchSize': 10 }
+    pDict.update(kw)
+    return pDict
+
+
+def spontRecording():
+    ''' Spontaneous activity that is negative for unit 1 only '''
+
+    S = np.abs(np.random.RandomState(1).randn(N, 500)) + 0.1
+    S[0] *= -1
+    return S
+
+
+@pytest.mark.parametrize('onDisk', [False, True])
+def test_spontCtrlFromDecodingCell(tmp_path, onDisk):
+    S = spontRecording()
+
+    if onDisk:
+        f = h5py.File(str(tmp_path / 'spont.h5'), 'w')
+        f['spont'] = S
+        S = f['spont']
+
+    for decode, sign in [(1, -1), (2, 1)]:
+        _, D, _ = optoConn( classParams(ctrl = 'spont', cells = [3, decode]),
+                            classData(S), run = False )
+
+        nTr0 = len(D['Ytr'][1])
+        assert D['Xtr'][1].shape == (nTr0, sL)
+        assert D['Xte'][1].shape == (len(D['Yte'][1]), sL)
+
+        #Normalized windows of the spontaneous activity of the decoding cell
+        assert np.all(np.sign(D['Xtr'][1]) == sign)
+        assert np.allclose(np.abs(D['Xtr'][1]).max(axis = 1), 1)
+
+        #Stimulated sequences still come from the stimulations of cells[0]
+        assert np.all(D['Ytr'][0] == 1) and np.all(D['Ytr'][1] == 0)
+
+
+def test_spontCtrlWithoutRecording():
+    with pytest.raises(ValueError):
+        optoConn(classParams(ctrl = 'spont'), classData(), run = False)
+
+
+def test_nullShufflesLabels():
+    np.random.seed(0)
+    _, D, _ = optoConn(classParams(cells = [3,2]), classData(), run = False)
+    _, Dn, _ = optoConn(classParams(cells = [3,2], null = True), classData(), run = False)
+
+    #Same number of stimulations of cells[0], not the same ones
+    assert D['Yall'].sum() == Dn['Yall'].sum()
+    assert np.any(D['Yall'] != Dn['Yall'])
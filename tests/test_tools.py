@@ -0,0 +1,610 @@
+import os
+import bisect
+
+import numpy  as np
+import pytest
+
+from scipy.stats import rankdata, ttest_ind
+
+from optoConn.tools import remBaseline, remBaselineChunks, _rollPercentile, stimEpochs, dataPrepClassi, \
+                           saveNpyDir, loadNpyDir, npyDict2Dir, epochData, pairScreen, _rowRanks, \
+                           stimIndex, cachedStimIndex, stimResponse, \
+                           stim_nstim_split, batchFeeder, dataPrepGenerative, \
+                           cacheKey, cacheLoad, cacheSave, h5Sessions, preProcess, permTest, \
+                           grangerPairs, lagCorr, meanSTA, staAccumulator, prepPipeline
+
+
+def rollPercentileLoop(x, percentile, w):
+    ''' Previous per-frame rolling percentile (sorted window updated as it slides) '''
+
+    p    = percentile/100.*(w-1)
+    lo   = int(np.floor(p))
+    hi   = min(lo+1, w-1)
+    frac = p - lo
+
+    x    = x.tolist()
+    win  = sorted(x[:w])
+    base = [ win[lo] + frac*(win[hi]-win[lo]) ]
+    for t in range(w, len(x)):
+        del win[bisect.bisect_left(win, x[t-w])]
+        bisect.insort(win, x[t])
+        base.append( win[lo] + frac*(win[hi]-win[lo]) )
+
+    return np.array(base)
+
+
+@pytest.mark.parametrize('w',          [1, 2, 7, 50, 51])
+@pytest.mark.parametrize('percentile', [0, 10, 37.5, 50, 100])
+def test_rollPercentileMatchesLoop(w, percentile):
+    rng = np.random.RandomState(w)
+    X   = rng.randn(3, 400)
+    X[1] = np.round(X[1])  #Repeated values
+
+    base = _rollPercentile(X, percentile, w)
+
+    assert base.shape == (3, 400-w+1)
+    for x, b in zip(X, base):
+        assert np.allclose(b, rollPercentileLoop(x, percentile, w))
+        assert np.allclose(b, np.percentile(np.lib.stride_tricks.as_strided(x,
+                              shape = (len(x)-w+1, w), strides = x.strides*2), percentile, axis = 1))
+
+
+@pytest.mark.parametrize('fast', [False, True])
+def test_rollPercentileLargeWindow(monkeypatch, fast):
+    import optoConn.tools as tools
+    monkeypatch.setattr(tools, '_rankFilter1D', fast and tools._rankFilter1D)
+
+    x = np.random.RandomState(0).randn(20000)
+    w = 1001
+
+    base    = _rollPercentile(x.reshape(1,-1), 8, w)[0]
+    windows = np.lib.stride_tricks.as_strided(x, shape = (len(x)-w+1, w), strides = x.strides*2)
+
+    assert base.shape == (len(x)-w+1,)
+    assert np.allclose(base[::97], np.percentile(windows[::97], 8, axis = 1))
+    assert np.allclose(base[-1], np.percentile(windows[-1], 8))
+
+
+def test_remBaselineChunksMatchesWhole():
+    X = np.cumsum(np.random.RandomState(0).randn(4, 3000), axis = 1)
+
+    dataBL, baseline = remBaseline(X, percentile = 10, binsize = 200)
+
+    for t0, t1, dBL, base in remBaselineChunks(X, percentile = 10, binsize = 200, chunk = 700):
+        assert np.allclose(base, baseline[:,t0:t1])
+        assert np.allclose(dBL,  dataBL[:,t0:t1])
+
+
+def stimEpochsLoop(D, F, seqRange):
+    ''' Previous per-stimulation extraction of dataPrepClassi (seqLen x nS x N) '''
+
+    D     = D.T
+    Dstim = np.zeros([len(np.arange(*seqRange[0])) + len(np.arange(*seqRange[1])), len(F), D.shape[1]])
+    for s in range(len(F)):
+        Dstim[:,s,:] = np.vstack([ D[ F[s] + seqRange[0][0]: F[s] + seqRange[0][1] ],
+                                   D[ F[s] + seqRange[1][0]: F[s] + seqRange[1][1] ] ])
+    return np.float32(Dstim)
+
+
+@pytest.mark.parametrize('seqRange', [ [[-5,-2],[1,4]], [[-3,0],[0,6]], [[0,0],[2,5]] ])
+def test_stimEpochsMatchesLoop(seqRange):
+    D = np.random.RandomState(0).randn(5, 300)
+    F = np.array([5, 17, 40, 41, 200, 290])
+
+    E = stimEpochs(D, F, seqRange)
+
+    assert E.dtype == np.float32
+    assert np.array_equal(E.transpose(2,1,0), stimEpochsLoop(D, F, seqRange))
+
+
+def test_stimEpochsOutside():
+    with pytest.raises(ValueError):
+        stimEpochs(np.zeros([2, 50]), [2], [[-5,-2],[1,4]])
+
+
+def test_dataPrepClassiFormat():
+    rng  = np.random.RandomState(0)
+    F    = np.arange(20, 980, 15)
+    data = { 'dataset': rng.randn(3, 1000), 'baseline': np.ones([3, 1000]),
+             'stimFrame': F.reshape(-1,1), 'stimIdx': (np.arange(len(F)) % 3 + 1).reshape(-1,1) }
+
+    seqRange = [[-5,-2],[1,4]]
+    D = dataPrepClassi(data, cells = [2,3], seqRange = seqRange, prepMethod = 0)
+
+    nStim = np.sum(data['stimIdx'] == 2)
+    assert len(D['Ytr'][0]) + len(D['Yte'][0]) == nStim
+    assert len(D['Ytr'][1]) + len(D['Yte'][1]) == len(F) - nStim
+    assert np.all(D['Ytr'][0] == 1) and np.all(D['Ytr'][1] == 0)
+    assert D['Xtr'][0].shape == (len(D['Ytr'][0]), 6)
+
+    #Epochs of all units, and each sequence normalized by its max absolute value
+    assert np.allclose(D['Xall'], stimEpochsLoop(data['dataset'], F, seqRange))
+    assert np.allclose(np.abs(D['Xtr'][0]).max(axis = 1), 1)
+    assert np.array_equal(D['Yall'], np.float64(data['stimIdx'][:,0] == 2))
+
+
+def test_npyDirRoundTrip(tmp_path):
+    data = { 'dataset'  : np.random.RandomState(0).randn(3, 50),
+             'stimFrame': np.arange(5, 45, 10),
+             'stimIdx'  : np.arange(1, 5).reshape(-1,1) }
+
+    saveNpyDir(str(tmp_path / 'simul'), data)
+
+    D = loadNpyDir(str(tmp_path / 'simul'))
+    assert sorted(D) == sorted(data)
+    for key in data:
+        assert isinstance(D[key], np.memmap)
+        assert not D[key].flags.writeable
+        assert np.array_equal(D[key], data[key])
+
+    D = loadNpyDir(str(tmp_path / 'simul'), mmap = False)
+    assert not isinstance(D['dataset'], np.memmap)
+
+
+def test_cacheHitAndEviction(tmp_path):
+    cache = str(tmp_path / 'cache')
+    os.makedirs(cache)
+
+    #Keys change with the arguments and with the content of files
+    src = tmp_path / 'data.npy'
+    np.save(str(src), np.zeros(3))
+    key = cacheKey(str(src), 4, 1)
+    assert key == cacheKey(str(src), 4, 1) and key != cacheKey(str(src), 4, 2)
+
+    np.save(str(src), np.zeros(5))
+    assert key != cacheKey(str(src), 4, 1)
+
+    #Miss, then hit on memory-mapped arrays
+    data = {'dataset': np.random.RandomState(0).randn(10, 100)}
+    assert cacheLoad(cache, 'a') is None
+
+    cacheSave(cache, 'a', data)
+    D = cacheLoad(cache, 'a')
+    assert isinstance(D['dataset'], np.memmap)
+    assert np.array_equal(D['dataset'], data['dataset'])
+
+    #Room for two entries, 'a' is used after 'b' was stored
+    size = sum([ os.path.getsize(os.path.join(cache, 'a', f)) for f in os.listdir(os.path.join(cache, 'a')) ])
+    cacheSave(cache, 'b', data, cacheSize = 2.5*size)
+    os.utime(os.path.join(cache, 'a'), (100, 100))
+    os.utime(os.path.join(cache, 'b'), (200, 200))
+    cacheLoad(cache, 'a')
+
+    cacheSave(cache, 'c', data, cacheSize = 2.5*size)
+    assert sorted(os.listdir(cache)) == ['a', 'c']
+
+
+def test_npyDict2Dir(tmp_path):
+    data = { 'dataset': np.arange(12.).reshape(3,4), 'W': np.eye(3) }
+    np.save(str(tmp_path / 'simul.npy'), data)
+
+    path = npyDict2Dir(str(tmp_path / 'simul.npy'))
+
+    assert path == str(tmp_path / 'simul')
+    D = loadNpyDir(path)
+    assert np.array_equal(D['dataset'], data['dataset']) and np.array_equal(D['W'], data['W'])
+
+
+def stimData(N = 4, T = 2000, seed = 0):
+    ''' Random recording with every unit stimulated in turn, unit 2 
+        responding to the stimulations of unit 1 '''
+
+    rng = np.random.RandomState(seed)
+    F   = np.arange(20, T-20, 15)
+    I   = np.arange(len(F)) % N + 1
+
+    D = rng.randn(N, T)
+    D[1, F[I == 1] + 1] += 4
+
+    return { 'dataset': D, 'baseline': np.ones([N, T]),
+             'stimFrame': F.reshape(-1,1), 'stimIdx': I.reshape(-1,1) }
+
+
+def test_rowRanksMatchesRankdata():
+    X = np.round(np.random.RandomState(0).randn(5, 40), 1)  #With ties
+
+    assert np.array_equal(_rowRanks(X), np.vstack([rankdata(x) for x in X]))
+
+
+def test_pairScreenMatchesPerPair():
+    data = stimData()
+    ED   = epochData(data, seqRange = [[-3,0],[0,3]], prepMethod = 0)
+
+    stats = pairScreen(ED)
+
+    assert list(stats['targets']) == [1, 2, 3, 4]
+
+    I = data['stimIdx'][:,0]
+    for t, target in enumerate(stats['targets']):
+        for d in range(ED.nN):
+            #Mean activity after minus before each stimulation
+            E    = np.float64(ED.epochs[d])
+            resp = E[:,3:].mean(axis = 1) - E[:,:3].mean(axis = 1)
+            r1, r0 = resp[I == target], resp[I != target]
+
+            assert np.isclose(stats['effect'][t,d], r1.mean() - r0.mean())
+            assert np.isclose(stats['t'][t,d], ttest_ind(r1, r0, equal_var = False)[0])
+            assert np.isclose(stats['auc'][t,d], np.mean(r1.reshape(-1,1) > r0) + 
+                                                 np.mean(r1.reshape(-1,1) == r0)/2)
+
+    #Connection 1 -> 2 has the largest effect
+    assert np.argmax(np.abs(stats['t'])) == np.ravel_multi_index((0,1), stats['t'].shape)
+
+
+def test_stimIndexMatchesMembership():
+    I = np.array([[1,3], [2,0], [3,3], [4,1], [2,2]])
+
+    index = stimIndex(I)
+
+    assert list(index.cells) == [1, 2, 3, 4]
+    for cell in range(0, 6):
+        member = np.array([cell in row and cell > 0 for row in I])
+        assert np.array_equal(index.trials(cell), np.flatnonzero(member))
+        assert np.array_equal(index.labels(cell), member)
+
+
+def test_cachedStimIndexShared():
+    I = (np.arange(30) % 5 + 1).reshape(-1,1)
+
+    index = cachedStimIndex(I)
+    assert cachedStimIndex(I.copy()) is index
+    assert cachedStimIndex(I[::-1]) is not index
+
+    #Cached labels and trials can't be changed by a caller
+    label = index.labels(2)
+    with pytest.raises(ValueError):
+        label[0] = True
+    with pytest.raises(ValueError):
+        index.trials(2)[0] = 0
+    assert np.array_equal(cachedStimIndex(I).labels(2), I[:,0] == 2)
+
+    #Oldest index evicted
+    for k in range(8):
+        cachedStimIndex(I + k + 1)
+    assert cachedStimIndex(I) is not index
+
+
+def stimResponseLoop(data, frames, cells, nf, nfb):
+    ''' Responses of each stimulation computed one by one (see stimResponse) '''
+
+    nfb   = nfb - 1
+    order = np.argsort(cells, kind = 'mergesort')
+    W     = [ data[:, f-nfb:f+nf] for f in frames[order] ]
+
+    trig = np.array([ w[c-1] for w, c in zip(W, cells[order]) ])
+    ctrl = np.array([ np.mean([ w[c-1] for w, o in zip(W, cells[order]) if o != c ], axis = 0)
+                      for c in np.unique(cells) ])
+    allS = np.vstack(W)
+
+    return trig, ctrl, allS
+
+
+def test_stimResponseMatchesLoop():
+    rng    = np.random.RandomState(0)
+    data   = rng.randn(5, 600)
+    frames = np.arange(10, 580, 19)
+    cells  = rng.randint(1, 4, len(frames))
+
+    trig, ctrl, allS = stimResponse(data, frames, cells, nf = 6, nfb = 3, norm = False)
+
+    for X, R in zip([trig, ctrl, allS], stimResponseLoop(data, frames, cells, 6, 3)):
+        assert np.allclose(X, R)
+
+
+@pytest.mark.parametrize('norm', [False, True])
+@pytest.mark.parametrize('nAll', [None, 7])
+def test_stimResponseChunked(tmp_path, norm, nAll):
+    rng    = np.random.RandomState(1)
+    data   = rng.randn(5, 600)
+    frames = np.arange(10, 580, 19)
+    cells  = rng.randint(1, 4, len(frames))
+
+    whole = stimResponse(data, frames, cells, nf = 6, nfb = 3, nAll = nAll, norm = norm)
+
+    for chunk in [1, 4, 7, 100]:
+        chunked = stimResponse(data, frames, cells, nf = 6, nfb = 3, nAll = nAll, norm = norm, chunk = chunk)
+        for X, R in zip(chunked, whole):
+            assert np.allclose(X, R)
+
+    #allS written in a memory-mapped output
+    out  = np.lib.format.open_memmap(str(tmp_path / 'allS.npy'), mode = 'w+', 
+                                     shape = whole[2].shape, dtype = whole[2].dtype)
+    allS = stimResponse(data, frames, cells, nf = 6, nfb = 3, nAll = nAll, norm = norm, 
+                        chunk = 4, out = out)[2]
+    assert allS is out and np.allclose(out, whole[2])
+
+
+def stimSplitLoop(data, frameSet):
+    ''' Previous stim_nstim_split, concatenating the slices one by one '''
+
+    N = data.shape[0]
+    data_nstim = np.zeros([N,0])
+    data_stim  = np.zeros([N,0])
+
+    for i in range(len(frameSet)):
+        frames = [f[0] for f in frameSet[i:i+2][:]]
+
+        if i != len(frameSet)-1:
+            data_nstim = np.hstack( [data_nstim, data[:,frames[0]+2:frames[1]-1]] )
+        else:
+            data_nstim = np.hstack( [data_nstim, data[:,frames[0]+2:frames[0]+15]] )
+
+        data_stim = np.hstack( [data_stim, data[:,frames[0]-1:frames[0]+2]] )
+
+    return data_nstim, data_stim
+
+
+@pytest.mark.parametrize('frames', [ [5, 20, 24, 60], [0, 30, 98], [1, 2, 50, 99], 
+                                     [0, 1, 3, 90], [40, 95] ])
+def test_stimSplitMatchesLoop(frames):
+    data     = np.random.RandomState(0).randn(3, 100)
+    frameSet = [[f] for f in frames]
+
+    nstim, stim = stim_nstim_split(data, frameSet)
+    rNstim, rStim = stimSplitLoop(data, frameSet)
+
+    assert np.array_equal(nstim, rNstim) and np.array_equal(stim, rStim)
+
+    #Same segments, one stimulation at a time
+    segs = list(stim_nstim_split(data, frameSet, generator = True))
+    assert np.array_equal(np.hstack([a for a, b in segs]), rNstim)
+    assert np.array_equal(np.hstack([b for a, b in segs]), rStim)
+
+
+def test_batchFeederOrderAndErrors():
+    def fill(step, buf):
+        buf['step'] = step
+        return step, buf
+
+    feeder = batchFeeder(fill, 10, prefetch = 2, makeBuffer = dict)
+    seen   = []
+    for step, buf in feeder:
+        #The buffer of a step is not refilled before the next step is requested
+        assert buf['step'] == step
+        seen.append(id(buf))
+    feeder.close()
+
+    assert len(set(seen)) == 4 and seen[:4] == seen[4:8]
+
+    def failing(step, buf):
+        if step == 3:
+            raise KeyError(step)
+        return step
+
+    feeder = batchFeeder(failing, 10)
+    with pytest.raises(KeyError):
+        list(feeder)
+    feeder.close()
+
+
+@pytest.mark.parametrize('seqRange', [[5,1], [4,3]])
+@pytest.mark.parametrize('prepMethod', [0, 1])
+def test_dataPrepGenerativeWindow(seqRange, prepMethod):
+    D = np.random.RandomState(0).randn(3, 300)
+
+    copied = dataPrepGenerative(D, seqRange, prepMethod)
+    window = dataPrepGenerative(D, seqRange, prepMethod, window = True)
+
+    for key in ['Xtr', 'Ytr', 'Xte', 'Yte', 'FitX', 'FitY']:
+        assert window[key].shape == copied[key].shape
+        assert np.array_equal(window[key], copied[key])
+
+    #Windows are read only views of a single copy of the data
+    assert not window['FitX'].flags.writeable
+    assert np.shares_memory(window['Xtr'], window['Xte'])
+    assert np.shares_memory(window['FitX'], window['FitY'])
+
+
+def test_h5SessionsMatchesConcatenation(tmp_path):
+    import h5py
+
+    rng  = np.random.RandomState(0)
+    S    = [ rng.rand(4, T) + 1 for T in [30, 1, 45] ]
+    base = np.hstack(S)*.5 + 1
+
+    f = h5py.File(str(tmp_path / 'sessions.h5'), 'w')
+    for i, s in enumerate(S):
+        f['s{}'.format(i)] = s
+
+    H = h5Sessions([ f['s{}'.format(i)] for i in range(len(S)) ])
+    D = np.hstack(S)
+
+    assert np.array_equal(H.offsets, [0, 30, 31, 76])
+    assert H.shape == D.shape
+    assert np.array_equal(np.asarray(H), D)
+
+    #Frames unsorted, repeated and across sessions
+    frames = np.array([75, 0, 29, 30, 31, 30, 5, 75, 44])
+    assert np.array_equal(H.take(frames), D[:, frames])
+    assert np.array_equal(H[1:3, 28:33], D[1:3, 28:33])
+
+    with pytest.raises(IndexError):
+        H.take([76])
+
+    #Selected units stay lazy
+    assert isinstance(H[:2], h5Sessions)
+    assert np.array_equal(np.asarray(H[:2]), D[:2])
+
+    #Preprocessing applied when frames are read
+    for prepMethod in [0, 1, 2, 3, 4, 5]:
+        P = preProcess(H[:3], prepMethod, base = base[:3])
+        assert np.allclose(np.asarray(P), preProcess(D[:3], prepMethod, base = base[:3]))
+
+
+def test_permTestMatchesPerPair():
+    rng     = np.random.RandomState(0)
+    acc     = rng.rand(3, 2, 4)*100
+    accNull = rng.rand(50, 2, 4)*100
+    accNull[:5, 0, 0] = acc[:, 0, 0].mean() #Ties count as reaching the accuracy
+    acc[:, 1, 3]      = np.nan              #Pair not trained
+
+    pVal = permTest(acc, accNull)
+
+    for t in range(2):
+        for d in range(4):
+            obs = np.mean(acc[:, t, d])
+            if np.isnan(obs):
+                assert np.isnan(pVal[t, d])
+            else:
+                nGeq = len([ a for a in accNull[:, t, d] if a >= obs ])
+                assert np.isclose(pVal[t, d], (1. + nGeq)/51)
+
+    assert pVal[0, 0] >= 6./51
+
+
+def test_grangerPairsMatchesRestrictedFits():
+    from scipy.stats import f as fDist
+
+    #Unit 1 is driven by the previous frame of unit 0
+    rng = np.random.RandomState(0)
+    X   = rng.randn(3, 600)
+    X[1, 1:] += 0.8*X[0, :-1]
+
+    L = 3
+    F, pVal = grangerPairs(X, seqRange = [L,1], prepMethod = 0, chunk = 70)
+
+    D = dataPrepGenerative(X, seqRange = [L,1], prepMethod = 0)
+    A = np.float64(D['FitX']).reshape(len(D['FitY']), -1)
+    A = np.hstack([ A, np.ones([len(A), 1]) ])
+    Y = np.float64(D['FitY'])
+
+    def rss(A, y):
+        return np.sum( (y - A.dot(np.linalg.lstsq(A, y)[0]))**2 )
+
+    dof = A.shape[0] - A.shape[1]
+    for target in range(3):
+        full = rss(A, Y[:,target])
+        for source in range(3):
+            #Restricted model without the lags of source (columns lag*N + source)
+            keep = [ c for c in range(A.shape[1]) if c == A.shape[1]-1 or c % 3 != source ]
+            ref  = ( (rss(A[:,keep], Y[:,target]) - full)/L ) / (full/dof)
+
+            assert np.isclose(F[source, target], ref)
+            assert np.isclose(pVal[source, target], fDist.sf(ref, L, dof))
+
+    assert pVal[0,1] < 1e-6
+
+    Fp, _ = grangerPairs(X, seqRange = [L,1], prepMethod = 0, nJobs = 2)
+    assert np.allclose(Fp, F)
+
+
+def lagCorrLoop(epochs, maxLag):
+    ''' Lagged correlation of each pair, one epoch, pair and lag at a time '''
+
+    N, nE, W = epochs.shape
+    z = (epochs - epochs.mean(axis = (1,2), keepdims = True)) / epochs.std(axis = (1,2), keepdims = True)
+
+    C = np.zeros([N, N, 2*maxLag+1])
+    for i in range(N):
+        for j in range(N):
+            for lag in range(-maxLag, maxLag+1):
+                t = np.arange(max(0, -lag), min(W, W-lag))
+                C[i, j, maxLag+lag] = np.mean( z[i][:, t] * z[j][:, t+lag] )
+
+    return C
+
+
+@pytest.mark.parametrize('memory', [1e9, 1.])
+def test_lagCorrMatchesLoop(memory):
+    rng = np.random.RandomState(0)
+    X   = rng.randn(5, 400)
+    X[3, 2:] += X[1, :-2] #Unit 3 follows unit 1 two frames later
+
+    C = lagCorr(X, maxLag = 4, memory = memory)
+    assert np.allclose(C, lagCorrLoop(X.reshape(5, 1, 400), 4), atol = 1e-5)
+    assert np.argmax(C[1, 3]) == 4 + 2
+
+    #Epochs after the stimulation frames, lags staying inside each epoch
+    frames = np.array([10, 90, 200, 330])
+    C = lagCorr(X, maxLag = 3, frames = frames, seqRange = [2, 20], memory = memory)
+    epochs = np.stack([ X[:, f+2:f+20] for f in frames ], axis = 1)
+    assert np.allclose(C, lagCorrLoop(epochs, 3), atol = 1e-5)
+
+
+def meanSTALoop(data, frames, nstim, nf):
+    ''' Stimuli in cycles, summed one event at a time '''
+
+    shift  = int(np.floor(nf/4))
+    sumSTA = np.zeros([nstim, data.shape[0], nf])
+    for e, f in enumerate(frames):
+        sumSTA[e % nstim] += data[:, f+1-shift:f+1+nf-shift]
+
+    meanSTA = sumSTA/(len(frames)/nstim)
+    return meanSTA, np.sum(meanSTA[:,:,shift:-shift], axis = 2)
+
+
+def test_meanSTAMatchesLoop():
+    rng    = np.random.RandomState(0)
+    data   = rng.randn(3, 2000)
+    frames = np.arange(30, 1900, 45)[:40]
+
+    sta, resp = meanSTA(data, frames, nstim = 8, nf = 21)
+    staL, respL = meanSTALoop(data, frames, 8, 21)
+
+    assert np.allclose(sta, staL) and np.allclose(resp, respL)
+
+
+def test_staAccumulatorMergeMatchesOneShot():
+    rng    = np.random.RandomState(0)
+    data   = rng.randn(3, 3000)
+    frames = np.sort(rng.choice(np.arange(20, 2950), 60, replace = False))
+    labels = rng.choice(['b', 'a', 'cc', 'd'], 60)
+    labels[:3] = 'zz' #Stimulus of the first batch only
+
+    one = staAccumulator(3, 20).update(data, frames, labels)
+
+    #Events of each half of the recording, passed with their part of the data
+    acc = staAccumulator(3, 20)
+    for half in [frames < 1500, frames >= 1500]:
+        t0, t1 = frames[half].min() - 10, frames[half].max() + 20
+        acc.update(data[:, t0:t1], frames[half], labels[half], offset = t0, chunk = 7)
+
+    assert list(acc.labels) == sorted(set(labels))
+    assert np.array_equal(acc.count, one.count)
+    assert np.allclose(acc.mean, one.mean) and np.allclose(acc.var, one.var)
+
+    #Mean and variance of the windows of each stimulus
+    for s, label in enumerate(acc.labels):
+        W = np.stack([ data[:, f+1-5:f+1+20-5] for f in frames[labels == label] ])
+        assert np.allclose(acc.mean[s], W.mean(axis = 0))
+        assert np.allclose(acc.var[s], W.var(axis = 0, ddof = 1) if len(W) > 1 else 0)
+
+
+def preProcessLoop(D, prepMethod, base):
+    ''' Single method applied to the whole array, as preProcess did '''
+
+    if prepMethod in [1, 4]:
+        D = (D - D.mean(axis = 1, keepdims = True)) / D.std(axis = 1, keepdims = True)
+    if prepMethod in [2, 4]:
+        D = D/np.absolute(D).max(axis = 1).reshape(-1,1)
+    if prepMethod == 3:
+        D = D + abs(D.min())
+        D = D/D.max(axis = 1).reshape(-1,1)
+    if prepMethod == 5:
+        D = D/base
+
+    return D
+
+
+def test_prepPipelineMatchesChainedPreProcess():
+    rng  = np.random.RandomState(0)
+    D    = rng.randn(4, 1000)*[[1],[3],[.5],[10]] + [[0],[2],[-1],[5]]
+    base = rng.rand(4, 1000) + 1
+
+    for prepMethod in [0, 1, 2, 3, 4, 5]:
+        assert np.allclose(preProcess(D, prepMethod, base = base), preProcessLoop(D, prepMethod, base))
+
+    #Chain compiled into one pass, statistics read again only after method 5
+    chain = [1, 3, 5, 4, 2]
+    ref   = D
+    for prepMethod in chain:
+        ref = preProcessLoop(ref, prepMethod, base)
+
+    P = prepPipeline(D, chain, base = base, chunk = 37)
+    assert P.dtype == np.float32
+    assert np.allclose(P, ref, atol = 1e-5)
+
+    #In place
+    X = D.copy()
+    assert prepPipeline(X, chain, base = base, chunk = 37, out = X) is X
+    assert np.allclose(X, ref)
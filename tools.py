@@ -1,14 +1,114 @@
 import matplotlib.pyplot as plt
 
+import os
 import math
 import h5py
-import collections
-
-import numpy      as np
-import tensorflow as tf
+import scipy
+import bisect
+import shutil
+import queue
+import hashlib
+import threading
+
+import numpy        as np
+import scipy.sparse as sparse
+import tensorflow   as tf
+
+from joblib        import Parallel, delayed
+from scipy.stats   import f as fDist
+from scipy.ndimage import rank_filter
+from scipy.fftpack import next_fast_len
 
 pi = math.pi
 
+#scipy.ndimage.rank_filter runs in O(T log w) on 1D inputs from SciPy 1.14,
+#in O(T*w) before (see _rollPercentileRow)
+_rankFilter1D = tuple(int(v) for v in scipy.__version__.split('.')[:2]) >= (1, 14)
+
+
+class batchFeeder(object):
+    ''' 
+    Will assemble the feeds of the next training steps on a background 
+    thread while the current step runs. At most prefetch feeds are waiting
+    in a bounded queue, and each one is built in a buffer of a ring of 
+    prefetch+2 preallocated buffers, so that no arrays are allocated per 
+    step. A buffer is reused only once the step using it is done (when 
+    the next feed is requested).
+
+    ________________________________________________________________________
+
+                                   ARGUMENTS
+    ________________________________________________________________________
+
+
+    fill       : Function fill(step, buf) returning the feed of step, 
+                 built in buffer buf
+    nSteps     : Number of steps
+    prefetch   : Number of feeds assembled in advance
+    makeBuffer : Function returning a new buffer (None if not used)
+
+    ________________________________________________________________________
+
+    '''
+
+    def __init__(self, fill, nSteps, prefetch = 2, makeBuffer = None):
+
+        self.fill    = fill
+        self.nSteps  = nSteps
+        self.buffers = [ makeBuffer() if makeBuffer else None for i in range(prefetch+2) ]
+
+        self._queue = queue.Queue(maxsize = prefetch)
+        self._stop  = threading.Event()
+
+        self._thread = threading.Thread(target = self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def _run(self):
+        ''' Producer, putting (feed, error) in the queue '''
+
+        try:
+            for step in range(self.nSteps):
+                feed = self.fill(step, self.buffers[step % len(self.buffers)])
+
+                if not self._put((feed, None)):
+                    return
+
+        except Exception as error:
+            self._put((None, error))
+
+
+    def _put(self, item):
+        ''' Will wait for a free spot in the queue to put item, unless closed.
+            Returns False if closed. '''
+
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+
+    def __iter__(self):
+        for step in range(self.nSteps):
+            feed, error = self._queue.get()
+
+            if error is not None:
+                raise error
+
+            yield feed
+
+
+    def close(self):
+        ''' Will stop the background thread '''
+
+        self._stop.set()
+        self._thread.join()
+
 def calcResponse(data, stimFrames, stimOrder, nf = 12, nfb = 1):
     ''' 
     Calcium response when multiple cells are stimulated at the same
@@ -41,11 +141,6 @@ def calcResponse(data, stimFrames, stimOrder, nf = 12, nfb = 1):
  
 
     '''
-    nfb = nfb - 1 #correct for python indexing
-    tnf = nf+nfb  #total number of frames
-
-    N = data.shape[0]
-    nStimCell = len(np.unique(stimOrder))  # Number of cells that are stimulated
 
     #If multiple neurons at once
     if type(stimOrder) is np.ndarray:
@@ -55,71 +150,22 @@ def calcResponse(data, stimFrames, stimOrder, nf = 12, nfb = 1):
         #Replicating frames 
         repSF = np.tile(stimFrames,[nNeur,1])
         repSF = sorted(repSF)
-        repSF = [int(idx[0])for idx in repSF]
-
-        nStim = len(repSF) #Number of stimulations
+        frames = [int(idx[0])for idx in repSF]
 
         # Putting all neurons stimulatead in a single array
-        repSIdx = np.hstack(stimOrder.T)
-
-        listStim = np.vstack([np.arange(nStim),repSIdx])
+        cells = np.hstack(stimOrder.T)
     else:
-        #Stimulation cell indexes
-        nStim     = len(stimFrames)            # Total number of stimulations
-        nReps     = nStim/nStimCell            # Number of time each cell is stimulated
-
         #Duplicated for repeating stim cycle
-        listStim  = np.vstack([np.arange(nStim),np.tile(stimOrder, [1,2])[0]]) 
-
-    cellList  = np.arange(nStimCell) # List of cell idx
-
-    #Ordering stimulation frames based on neuron number 
-    ordStim  = listStim[1,:].argsort()
-
-    #Reordering allS based on neuron number
-    listAll = np.vstack([np.arange(N*nStim), np.tile(np.arange(N),[1,nStim])[0]])
-    ordAll  = listAll[1,:].argsort()
-
-    #Initialization
-    trig   = np.zeros([nStim,tnf])     # Average activity when stimulated
-    ctrl   = np.zeros([nStimCell,tnf]) # Average activity when other cells are stimulated
-
-    # Taking 1 frame before, 1 frame during and nf frames after the stimulation for each stim
-    idx = 0
-    for f in ordStim:
-        
-        frame = stimFrames[f][0] #Stimulation frame
-        cell  = listStim[1,f]-1  #Stimulated cell
+        frames = [f[0] for f in stimFrames]
+        cells  = np.tile(stimOrder, [1,2])[0]
 
-        if idx == 0: 
-            allS = data[:, frame-nfb:frame+nf]
-        else:
-            allS = np.vstack([allS,data[:, frame-nfb:frame+nf]])
-        
-        #Index of cells for control except currently stimulated
-        mask = np.hstack([cellList!=cell,np.array([False]*(N-nStimCell))])
-        
-        trig[idx,:]               = data[cell, frame-nfb:frame+nf]
-        ctrl[mask[:nStimCell],:] += data[mask, frame-nfb:frame+nf]
-        
-        idx  += 1
-        
-    #Taking the mean
-    ctrl = ctrl/(nStim-nReps)
+    trig, ctrl, allS = stimResponse(data, frames, cells, nf, nfb, norm = False)
 
     #Difference between direction stimulation and control activity
     diff = trig - np.tile(ctrl,[2,1])
 
     #Normalizing for each trial
-    mTrig = np.tile( np.mean(abs(trig), axis=1), [tnf,1] ).T
-    mCtrl = np.tile( np.mean(abs(ctrl), axis=1), [tnf,1] ).T
-    mDiff = np.tile( np.mean(abs(diff), axis=1), [tnf,1] ).T
-    mAllS = np.tile( np.mean(abs(allS), axis=1), [tnf,1] ).T
-
-    trig = np.divide(trig,mTrig)
-    ctrl = np.divide(ctrl,mCtrl)
-    diff = np.divide(diff,mDiff) 
-    allS = np.divide(allS,mAllS) 
+    trig, ctrl, diff, allS = [ _rowNorm(X) for X in [trig, ctrl, diff, allS] ]
 
     return trig, diff, allS, ctrl
 
@@ -158,12 +204,6 @@ def calcResponseMulti(data, stimFrames, stimOrder, nf = 12, nfb = 1):
  
 
     '''
-    nfb = nfb - 1 #correct for python indexing
-    tnf = nf+nfb  #total number of frames
-
-    N = data.shape[0]
-    nStimCell = len(np.unique(stimOrder))  # Number of cells that are stimulated
-
     #If multiple neurons at once
     if type(stimOrder) is np.ndarray:
         #Will look at each time each neuron is stimulated directly
@@ -174,77 +214,14 @@ def calcResponseMulti(data, stimFrames, stimOrder, nf = 12, nfb = 1):
         stimFrames = sorted(stimFrames)
         stimFrames = [int(idx[0])for idx in stimFrames]
 
-        nStim = len(stimFrames) #Number of stimulations
-        
         # Putting all neurons stimulatead in a single array
         stimOrder = np.hstack(stimOrder)
-        
-        # List of stimuli
-        listStim = np.vstack([np.arange(nStim),stimOrder])
-
-        
-        # Number of time each neuron is stimulated
-        stimCount  = collections.Counter(stimOrder)
-        lstimCount = np.array([stimCount[i] for i in range(1,nStimCell+1)])
-
     else:
-        #Stimulation cell indexes
-        nStim     = len(stimFrames)            # Total number of stimulations
-        nReps     = nStim/nStimCell            # Number of time each cell is stimulated
-
         #Duplicated for repeating stim cycle
-        listStim  = np.vstack([np.arange(nStim),np.tile(stimOrder, [1,2])[0]]) 
-
-
-    cellList = np.arange(nStimCell) # List of cell idx
-
-    #Ordering stimulation frames based on neuron number 
-    ordStim  = listStim[1,:].argsort()
-
-    #Reordering allS based on neuron number
-    listAll = np.vstack([np.arange(N*nStim), np.tile(np.arange(N),[1,nStim])[0]])
-    ordAll  = listAll[1,:].argsort()
-
-    #Initialization
-    trig   = np.zeros([nStim,tnf])     # Average activity when stimulated
-    ctrl   = np.zeros([nStimCell,tnf]) # Average activity when other cells are stimulated
-
-    # Taking 1 frame before, 1 frame during and nf frames after the stimulation for each stim
-    idx = 0
-    for f in ordStim:
-        
-        frame = stimFrames[f] #Stimulation frame
-        cell  = listStim[1,f]-1  #Stimulated cell
-
-        if idx == 0: 
-            allS = data[:, frame-nfb:frame+nf]
-        #else:
-        #    allS = np.vstack([allS,data[:, frame-nfb:frame+nf]])
-        
-        #Index of cells for control except currently stimulated
-        mask = np.hstack([cellList!=cell,np.array([False]*(N-nStimCell))])
-        
-        trig[idx,:]               = data[cell, frame-nfb:frame+nf]
-        ctrl[mask[:nStimCell],:] += data[mask, frame-nfb:frame+nf]
-        
-        idx  += 1
-        
-    #Taking the mean
-    ctrl = (ctrl.T/(nStim-lstimCount)).T
-
-    #Difference between direction stimulation and control activity
-    #diff = trig - np.tile(ctrl,[2,1])
-
-    #Normalizing for each trial
-    mTrig = np.tile( np.mean(abs(trig), axis=1), [tnf,1] ).T
-    mCtrl = np.tile( np.mean(abs(ctrl), axis=1), [tnf,1] ).T
-    #mDiff = np.tile( np.mean(abs(diff), axis=1), [tnf,1] ).T
-    mAllS = np.tile( np.mean(abs(allS), axis=1), [tnf,1] ).T
+        stimOrder = np.tile(stimOrder, [1,2])[0]
 
-    trig = np.divide(trig,mTrig)
-    ctrl = np.divide(ctrl,mCtrl)
-    #diff = np.divide(diff,mDiff) 
-    allS = np.divide(allS,mAllS) 
+    #Only the response to the first stimulation is kept in allS
+    trig, ctrl, allS = stimResponse(data, stimFrames, stimOrder, nf, nfb, nAll = 1)
 
     return trig, allS, ctrl #diff
 
@@ -284,12 +261,6 @@ def cellRespMulti(data, stimFrames, stimOrder, nf = 30, nfb = 1):
  
 
     '''
-    nfb = nfb - 1 #correct for python indexing
-    tnf = nf+nfb  #total number of frames
-
-    N = data.shape[0]
-    nStimCell = len(np.unique(stimOrder))  # Number of cells that are stimulated
-
     #If multiple neurons at once
     if type(stimOrder) is np.ndarray:
         #Will look at each time each neuron is stimulated directly
@@ -300,79 +271,116 @@ def cellRespMulti(data, stimFrames, stimOrder, nf = 30, nfb = 1):
         stimFrames = sorted(stimFrames)
         stimFrames = [int(idx[0])for idx in stimFrames]
 
-        nStim = len(stimFrames) #Number of stimulations
-        
         # Putting all neurons stimulatead in a single array
         stimOrder = np.hstack(stimOrder.T)
-        
-        # List of stimuli
-        listStim = np.vstack([np.arange(nStim),stimOrder])
+    else:
+        #Duplicated for repeating stim cycle
+        stimOrder = np.tile(stimOrder, [1,2])[0]
 
-        
-        # Number of time each neuron is stimulated
-        stimCount  = collections.Counter(stimOrder)
-        lstimCount = np.array([stimCount[i] for i in range(1,nStimCell+1)])
+    trig, ctrl, allS = stimResponse(data, stimFrames, stimOrder, nf, nfb)
 
-    else:
-        #Stimulation cell indexes
-        nStim     = len(stimFrames)            # Total number of stimulations
-        nReps     = nStim/nStimCell            # Number of time each cell is stimulated
+    return trig, allS, ctrl #diff
 
-        #Duplicated for repeating stim cycle
-        listStim  = np.vstack([np.arange(nStim),np.tile(stimOrder, [1,2])[0]]) 
 
+def cacheKey(*args):
+    ''' 
+    Hash identifying a cache entry. Files in args (existing paths) are 
+    identified by their path, size and modification time, so that an entry
+    is not reused once the file changes. Directories are identified by all
+    the files they contain.
+    '''
 
-    cellList  = np.arange(nStimCell) # List of cell idx
+    def fileId(path):
+        stat = os.stat(path)
+        return [os.path.realpath(path), stat.st_size, stat.st_mtime]
 
-    #Ordering stimulation frames based on neuron number 
-    ordStim  = listStim[1,:].argsort()
+    ident = []
+    for arg in args:
+        if isinstance(arg, str) and os.path.isfile(arg):
+            arg = fileId(arg)
+        elif isinstance(arg, str) and os.path.isdir(arg):
+            #Dataset directory (see saveNpyDir)
+            arg = [fileId(os.path.join(arg, f)) for f in sorted(os.listdir(arg))]
+        ident.append(arg)
 
-    #Reordering allS based on neuron number
-    listAll = np.vstack([np.arange(N*nStim), np.tile(np.arange(N),[1,nStim])[0]])
-    ordAll  = listAll[1,:].argsort()
+    return hashlib.sha1(repr(ident).encode()).hexdigest()
 
-    #Initialization
-    trig   = np.zeros([nStim,tnf])     # Average activity when stimulated
-    ctrl   = np.zeros([nStimCell,tnf]) # Average activity when other cells are stimulated
 
-    # Taking 1 frame before, 1 frame during and nf frames after the stimulation for each stim
-    idx = 0
-    for f in ordStim:
-        
-        frame = stimFrames[f] #Stimulation frame
-        cell  = listStim[1,f]-1  #Stimulated cell
+def cacheLoad(cacheDir, key):
+    ''' 
+    Will return the arrays of the cache entry key as a dictionnary of 
+    read-only memory-mapped arrays, or None if the entry is not cached.
+    '''
 
-        if idx == 0: 
-            allS = data[:, frame-nfb:frame+nf]
-        else:
-            allS = np.vstack([allS,data[:, frame-nfb:frame+nf]])
-        
-        #Index of cells for control except currently stimulated
-        mask = np.hstack([cellList!=cell,np.array([False]*(N-nStimCell))])
-        
-        trig[idx,:]               = data[cell, frame-nfb:frame+nf]
-        ctrl[mask[:nStimCell],:] += data[mask, frame-nfb:frame+nf]
-        
-        idx  += 1
-        
-    #Taking the mean
-    ctrl = (ctrl.T/(nStim-lstimCount)).T
+    path = os.path.join(cacheDir, key)
 
-    #Difference between direction stimulation and control activity
-    #diff = trig - np.tile(ctrl,[2,1])
+    if not os.path.isdir(path):
+        return None
 
-    #Normalizing for each trial
-    mTrig = np.tile( np.mean(abs(trig), axis=1), [tnf,1] ).T
-    mCtrl = np.tile( np.mean(abs(ctrl), axis=1), [tnf,1] ).T
-    #mDiff = np.tile( np.mean(abs(diff), axis=1), [tnf,1] ).T
-    mAllS = np.tile( np.mean(abs(allS), axis=1), [tnf,1] ).T
+    #Marking entry as recently used
+    os.utime(path, None)
 
-    trig = np.divide(trig,mTrig)
-    ctrl = np.divide(ctrl,mCtrl)
-    #diff = np.divide(diff,mDiff) 
-    allS = np.divide(allS,mAllS) 
+    return loadNpyDir(path)
 
-    return trig, allS, ctrl #diff
+
+def cacheSave(cacheDir, key, data, cacheSize = 20e9):
+    ''' 
+    Will store the arrays in data as the cache entry key, then evict the 
+    least recently used entries until the cache is under cacheSize bytes.
+    The entry is written in a temporary directory and then renamed, so
+    that concurrent processes never read an entry being written.
+    '''
+
+    path = os.path.join(cacheDir, key)
+    tmp  = path + '.tmp{}'.format(os.getpid())
+
+    saveNpyDir(tmp, data)
+
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        #Already stored by another process
+        shutil.rmtree(tmp, ignore_errors = True)
+
+    #Size and last use of each entry
+    entries = []
+    for e in os.listdir(cacheDir):
+        ePath = os.path.join(cacheDir, e)
+        if os.path.isdir(ePath) and '.tmp' not in e:
+            size = sum([ os.path.getsize(os.path.join(ePath, f)) for f in os.listdir(ePath) ])
+            entries.append([os.path.getmtime(ePath), size, ePath])
+
+    #Evicting least recently used entries, except the new one
+    entries.sort()
+    total = sum([e[1] for e in entries])
+    for mtime, size, ePath in entries:
+        if total <= cacheSize:
+            break
+        if ePath != path:
+            shutil.rmtree(ePath, ignore_errors = True)
+            total -= size
+
+
+_stimIndexCache = {} #Indexes built by cachedStimIndex
+
+def cachedStimIndex(stimIdx, cacheSize = 8):
+    ''' 
+    Stimulation index of stimIdx (see stimIndex), built once per content of
+    stimIdx and kept in memory for the next calls, so that successive 
+    analyses of the same stimulations (e.g. epochData, stimResponse) share
+    it. The cacheSize most recent indexes are kept.
+    '''
+
+    I   = np.ascontiguousarray(stimIdx)
+    key = (I.shape, I.dtype.str, hashlib.sha1(I.tobytes()).hexdigest())
+
+    if key not in _stimIndexCache:
+        if len(_stimIndexCache) >= cacheSize:
+            #Evicting the oldest index
+            del _stimIndexCache[next(iter(_stimIndexCache))]
+        _stimIndexCache[key] = stimIndex(I)
+
+    return _stimIndexCache[key]
 
 
 def corr2_coeff(A,B):
@@ -393,7 +401,10 @@ def dataPrepClassi(dataDict, ctrl= 'noStim', cells= [217,217], null = False, seq
 
 
     ''' Putting the data in the right format for training for 
-        classification
+        classification. The stimulation epochs of all units are extracted
+        with a single gather (see stimEpochs) by epochData, and the pair
+        is handed out by epochData.pairData. To classify several pairs of 
+        the same data, build the epochData once instead.
 
     ________________________________________________________________________
 
@@ -406,8 +417,7 @@ def dataPrepClassi(dataDict, ctrl= 'noStim', cells= [217,217], null = False, seq
         seqRange[0] : Range of time points before stimulation to consider ( [t-u, t-v[ )
         seqRange[1] : Range of time points after  stimulation to consider ( [t+x, t+y[ )
 
-        NEED TO ADJUST THE SPONT STIM BECAUSE OF SEQUENCE BREAKING CAUSED BY NEW SEQRANGE
-
+        ctrl : Label 0 sequences, 'noStim' or 'spont' (see epochData.pairData)
         null : Whether the output values are shuffled or not
 
         prepMethod : 0 : No transformation
@@ -428,157 +438,138 @@ def dataPrepClassi(dataDict, ctrl= 'noStim', cells= [217,217], null = False, seq
                     Xall: All sequences,       Yall: All labels }
 
                 Format:
-                        Xtr, Xte : seqLen x nSequences x nInputs
-                        Ytr, Yte : nSquences
+                        Xtr, Xte : [Stim, noStim] of nSequences x seqLen
+                        Ytr, Yte : [Stim, noStim] of nSquences
+                        Xall     : seqLen x nS x nN
 
     ________________________________________________________________________
 
     '''
 
-    cellLabel = cells[1] - 1  #Correction for index in python
-
-    F  = dataDict['stimFrame'] #Frame of stimulation
-    I  = dataDict['stimIdx']   #Index of neuron stimulated
-    B  = dataDict['baseline']
-    D  = dataDict['dataset']   #Dataset
-
-
-    nS = len(F)     #Number of stimulations
-    nN = D.shape[0] #Number of units
-    sL = seqRange[0][1]-seqRange[0][0]+\
-         seqRange[1][1]-seqRange[1][0] #Sequence lenght
-
-    #Preprocessing data 
-    if type(prepMethod) is int:
-        D = preProcess(D, prepMethod = prepMethod, base = B)
-    else:
-        #If a list, executes in order multiple methods
-        for meth in prepMethod:
-            D = preProcess(D, prepMethod = meth, base = B)
-
-    D = D.T #Transposing for final shape
-
-    #Extracting post-stim sequences
-    # Will take 'sL' time points around (defined by stimulation frame
-    Dstim = np.zeros([sL,nS,nN])
-    label = np.zeros(nS)
-
-    for s in range(nS):
-        Dstim[:,s,:] = np.vstack([
-                       D[ F[s] + seqRange[0][0]: F[s] + seqRange[0][1] ],
-                       D[ F[s] + seqRange[1][0]: F[s] + seqRange[1][1] ]  ])
-            
-        #cells[0] cell label
-        if cells[0] in I[s]:
-            label[s] = 1
-        else:
-            label[s] = 0
-
-    Dstim = np.zeros([sL,nS,nN])
-    label = np.zeros(nS)
-
-    for s in range(nS):
-        Dstim[:,s,:] = np.vstack([
-                       D[ F[s] + seqRange[0][0]: F[s] + seqRange[0][1] ],
-                       D[ F[s] + seqRange[1][0]: F[s] + seqRange[1][1] ]  ])
-            
-        #cells[0] cell label
-        if cells[0] in I[s]:
-            label[s] = 1
-        else:
-            label[s] = 0
-
-    Dstim = np.float32(Dstim) #For tensorflow
-
-    #Shuffle labels if null 
-    if null:
-        perm  = np.random.permutation(len(label))
-        label = label[perm]
-
-    #Label counts
-    labIdx1 = np.where(label == 1)[0] #Idx of cells[0] stimulation
-    labIdx0 = np.where(label == 0)[0] #Idx of non-cells[0] stimulation
-
-    n1 = len(labIdx1) #Number of cells[0] stimulation
-    n0 = len(labIdx0) #Number of non-cells[0] stimulation
-
-    #Number of trianing examples
-    nTrain1 = int(n1*4/5)
-    nTrain0 = int(n0*4/5)
-
+    ED = epochData(dataDict, seqRange = seqRange, prepMethod = prepMethod)
 
-    #Random permutations of sequences
-    perms1 = np.random.permutation(n1) #Idx for stimulation
-    perms0 = np.random.permutation(n0) #Idx for noStim
+    return ED.pairData(cells, ctrl = ctrl, null = null)
 
-    trainIdx1 = perms1[:nTrain1]
-    trainIdx0 = perms0[:nTrain0]
 
-    testIdx1 = perms1[nTrain1:]
-    testIdx0 = perms0[nTrain0:]
+def dataPrepClassiPairs(dataDict, pairs = None, nFolds = 1, ctrl = 'noStim', null = False,
+                        seqRange = [[-2,-1],[0,1]], prepMethod = 1, nNull = 0):
+    ''' Putting the data in the right format for the batched pair classifier
+        (__classOptoNNPairs__). Every (stimulated cell, decoding cell) pair is
+        prepared the same way epochData.pairData would, but all the pairs are
+        handed out from the same epochs.
 
-    if ctrl == 'spont':
-        #Will use spontaneous activity for no-stim label data
-        #print('Using spontaneous data for label 0.\n')
-
-        #Spontaneous datasets
-        DS = dataDict['datasetSpont'] #Spontaneous activity dataset
-        BS = dataDict['baselineSpont']
+    ________________________________________________________________________
 
-        DS = DS.T; BS = BS.T
+                                   ARGUMENTS
+    ________________________________________________________________________
 
-        #Training inputs
-        spontIdxTr = np.random.randint(0,np.shape(DS)[0]-sL,nTrain0)
-        SPTr = np.dstack([DS[idx:idx+sL,:] for idx 
-                          in spontIdxTr]).transpose(0,2,1)
+        pairs  : List of [cells[0], cells[1]] pairs (see epochData.pairData).
+                 If None, all stimulated cells x all units are used.
+        nFolds : Number of cross-validation folds per pair. Each fold is
+                 an independent random train/test split of the pair and
+                 is trained as a separate classifier.
+        nNull  : Number of label-shuffled replicas per pair, trained as
+                 extra folds to build a permutation null (see permTest).
+                 Each replica shuffles the labels once and has its own 
+                 nFolds splits, so its accuracy averaged over its folds is 
+                 the same statistic as the one of the pair.
 
-        #Stacking both label sequences [ Stim, noStim(spont) ]
-        trInput = [ Dstim[:,labIdx1[trainIdx1],:], SPTr ]
+        ctrl, null  : See epochData.pairData
+        seqRange and prepMethod : See epochData
 
-        #Testing input
-        spontIdxTe = np.random.randint(0,np.shape(DS)[0]-sL,n0-nTrain0)
-        SPTe = np.dstack([DS[idx:idx+sL,:] for idx 
-                          in spontIdxTe]).transpose(0,2,1)
+        dataDict can also be an epochData object, in which case seqRange 
+        and prepMethod are the ones used to build it.
 
-        #Stacking both label sequences [ Stim, noStim(spont) ]
-        teInput = [ Dstim[:,labIdx1[testIdx1],:], SPTe ]
+    ________________________________________________________________________
 
+                                     RETURNS
+    ________________________________________________________________________
 
-    elif ctrl == 'noStim':
-        #Training set
-        #print('Using random data for label 0.\n')
-        trInput = [ Dstim[:,labIdx1[trainIdx1],  :],  #Stim data
-                    Dstim[:,labIdx0[trainIdx0], :] ] #No stim data
 
-        #Testing set
-        teInput  = [ Dstim[:,labIdx1[testIdx1],  :],
-                     Dstim[:,labIdx0[testIdx0], :] ]
+        dataDict: { Xtr : [Stim, noStim] training sequences,  Ytr : [n1, n0]
+                    Xte : [Stim, noStim] testing  sequences,  Yte : [n1, n0]
+                    pairs : Pair of each classifier,  fold : Fold of each classifier,
+                    null  : Whether each classifier is a shuffled replica }
 
-    #Taking  only decoding cell
-    trInput = [ lab[:,:,cellLabel].T for lab in trInput ] 
-    teInput = [ lab[:,:,cellLabel].T for lab in teInput ]
+                Format:
+                        Xtr, Xte : nPairs x nSequences x seqLen (zero padded)
+                        Ytr, Yte : nPairs (number of valid sequences)
+                        pairs    : nPairs x 2
+                        fold     : nPairs
+                        null     : nPairs
 
-    #Standardizing within each examples
-    trInput = [preProcess(lab,  prepMethod = 2 ) for lab in trInput]
-    teInput = [preProcess(lab,  prepMethod = 2 ) for lab in teInput]
+                where nPairs = len(pairs)*nFolds*(1 + nNull)
 
-    #Stacking label (stim, nostim)
-    trLabel = [ label[labIdx1[trainIdx1]], label[labIdx0[trainIdx0]] ]
-    teLabel = [ label[labIdx1[testIdx1]],  label[labIdx0[testIdx0]]  ]
+    ________________________________________________________________________
 
-    print( 'Stimulated cell : {}\n'.format(cells[0])  +
-           'Decoding cell   : {}\n'.format(cellLabel+1)  )
+    '''
 
+    #Stimulation epochs of all units
+    if isinstance(dataDict, epochData):
+        ED = dataDict
+    else:
+        ED = epochData(dataDict, seqRange = seqRange, prepMethod = prepMethod)
 
-    dataDict = { 'Xtr' : trInput , 'Ytr' : trLabel,
-                 'Xte' : teInput , 'Yte' : teLabel,
-                 'Xall': Dstim,    'Yall': label    }
+    if pairs is None:
+        targets = [c for c in ED.index.cells if c <= ED.nN]
+        pairs   = [[t, d] for t in targets for d in range(1, ED.nN+1)]
+    else:
+        pairs   = [list(p) for p in pairs]
+
+    trInput = [[],[]]; teInput = [[],[]]
+    nTr     = [[],[]]; nTe     = [[],[]]
+    fold    = []
+
+    labels = [None]*len(pairs) #Shuffled labels of the current replica
+
+    for f in range(nFolds*(1 + nNull)):
+        for p, (target, decode) in enumerate(pairs):
+
+            if f < nFolds:
+                label = ED.labels(target, null = null)
+            else:
+                #Labels of a replica are shuffled once for all its folds
+                if f % nFolds == 0:
+                    labels[p] = ED.labels(target, null = True)
+                label = labels[p]
+
+            #Train and test stimulations of the pair
+            tr1, te1, tr0, te0 = ED.split(label)
+
+            trInput[0].append(ED.sequences(decode, tr1))
+            teInput[0].append(ED.sequences(decode, te1))
+
+            if ctrl == 'spont':
+                #Will use spontaneous activity for no-stim label data
+                trInput[1].append(ED.spontSequences(decode, len(tr0)))
+                teInput[1].append(ED.spontSequences(decode, len(te0)))
+            else:
+                trInput[1].append(ED.sequences(decode, tr0))
+                teInput[1].append(ED.sequences(decode, te0))
+
+            nTr[0].append(len(tr1)); nTe[0].append(len(te1))
+            nTr[1].append(len(tr0)); nTe[1].append(len(te0))
+            fold.append(f)
+
+    def stackPad(seqs):
+        #Stacking sequences of each pair in a zero padded array
+        nMax = max([len(s) for s in seqs])
+        X    = np.zeros([len(seqs), nMax, ED.sL], dtype = 'float32')
+        for p, s in enumerate(seqs):
+            X[p, :len(s), :] = s
+        return X
+
+    print( 'Number of pair classifiers : {}'.format(len(fold)) )
+
+    dataDict = { 'Xtr'  : [stackPad(X) for X in trInput], 'Ytr'  : [np.array(n) for n in nTr],
+                 'Xte'  : [stackPad(X) for X in teInput], 'Yte'  : [np.array(n) for n in nTe],
+                 'pairs': np.array(pairs*nFolds*(1+nNull)), 'fold' : np.array(fold),
+                 'null' : np.array(fold) >= nFolds  }
 
     return dataDict
 
-    
 
-def dataPrepGenerative(dataD, seqRange= [10,1], prepMethod= 1, null = False): 
+def dataPrepGenerative(dataD, seqRange= [10,1], prepMethod= 1, null = False, window = False): 
     ''' Putting the data in the right format for training for 
         generative models
 
@@ -598,6 +589,11 @@ def dataPrepGenerative(dataD, seqRange= [10,1], prepMethod= 1, null = False):
                    4 = standardization + normalization
                    5 = Dividing by baseline
         null     : Whether the output values are shuffled or not
+        window   : If True, the sequences are not copied. Xtr, Xte and FitX
+                   are sliding window views (read only) of a single float32
+                   copy of the preprocessed data, and batches are gathered 
+                   from them when fed to the graph. Memory then grows as 
+                   T x nInputs instead of seqLen x T x nInputs. 
 
     ________________________________________________________________________
 
@@ -640,12 +636,34 @@ def dataPrepGenerative(dataD, seqRange= [10,1], prepMethod= 1, null = False):
     numSeq    = data_num - (seqLen + YDist + 1) # Number of sequences   
 
     #Preprocessing
-    if type(prepMethod) is int:
-        D = preProcess(D, prepMethod = prepMethod, base = B)
-    else:
-        #If a list, executes in order multiple methods
-        for meth in prepMethod:
-            D = preProcess(D, prepMethod = meth, base = B)
+    D = prepDataset(dataD if type(dataD) is dict else {'dataset': D, 'baseline': B}, prepMethod)
+    D = np.asarray(D) #Reading lazy datasets (see h5Sessions)
+
+    # Five fold cross-validation
+    training_num = int(numSeq*4/5) # 80% of the data for training
+
+    if window:
+        #Single copy of the data ( T x nInputs )
+        DT = np.ascontiguousarray(D.T, dtype = np.float32)
+
+        # Label vectors (Ytr)
+        alOutput = DT[seqLen+YDist:-1] # Take the seqLen+1 vector as output
+
+        if null:
+            #Shuffle labels
+            alOutput = np.random.permutation(alOutput)
+
+        #Input sequences as sliding windows (numSeq x seqLen x nInputs), no copy
+        alInput = np.lib.stride_tricks.as_strided(DT, shape   = (numSeq, seqLen, data_size),
+                                                      strides = (DT.strides[0],) + DT.strides)
+        alInput.flags.writeable = False
+
+        #Ordered sequences, so training and testing sets are ranges of windows
+        dataDict = { 'Xtr'  : alInput[:training_num], 'Ytr' : alOutput[:training_num],
+                     'Xte'  : alInput[training_num:], 'Yte' : alOutput[training_num:],
+                     'FitX' : alInput,                'FitY': alOutput  }
+
+        return dataDict
 
     # Label vectors (Ytr)
     alOutput  = D[:,seqLen+YDist:-1] # Take the seqLen+1 vector as output
@@ -664,9 +682,6 @@ def dataPrepGenerative(dataD, seqRange= [10,1], prepMethod= 1, null = False):
     alInput  = np.float32(alInput)
     alOutput = np.float32(alOutput)
 
-    # Five fold cross-validation
-    training_num = int(numSeq*4/5) # 80% of the data for training
-
     #Random permutations of sequencesa
     perms    = np.random.permutation(numSeq)
 
@@ -694,13 +709,13 @@ def dataPrepGenerative(dataD, seqRange= [10,1], prepMethod= 1, null = False):
 
 
 
-def loadHDF5Dataset(path,field,dataset):
-    ''' Will return the values associated with the field of 
-        the specified dataset. See the README.md file of the 
-        dataset for a description of each dataset and field.
-
-        This function is specific to optogenetic data in V1
-        from Haüsser lab.
+class epochData(object):
+    ''' 
+    Stimulation epochs of all the units of a dataset, extracted once for a 
+    given (dataset, seqRange, prepMethod). The train and test sets of any 
+    (stimulated cell, decoding cell) pair are then handed out from the same 
+    epochs without preprocessing or cutting the dataset again, which makes 
+    it possible to reuse it across all the decoding cells of a sweep.
 
     ________________________________________________________________________
 
@@ -708,172 +723,1159 @@ def loadHDF5Dataset(path,field,dataset):
     ________________________________________________________________________
 
 
-    path    : Path to the dataset
-    field   : Name of the field in the dataset to load
-    dataset : Number of dataset to load
+    dataDict   : Data dictionnary (dataset, baseline, stimFrame, stimIdx and
+                 optionally datasetSpont)
+    seqRange   : seqRange[0] : Range of time points before stimulation to consider ( [t-u, t-v[ )
+                 seqRange[1] : Range of time points after  stimulation to consider ( [t+x, t+y[ )
+    prepMethod : 0 : No transformation
+                 1 : standardization
+                 2 : normalization
+                 3 : normalization with value shifted to positive
+                 4 : standardization + normalization
+                 5 : Baseline division
+    key        : Identifier of the data and parameters used, to know when 
+                 the epochs can be reused (see epochKey)
 
     ________________________________________________________________________
- 
-
-    '''
-    
-    #To adjust for python indexing
-    dataset = dataset - 1
-    
-    #Open h5py file
-    hf = h5py.File(path,'r')
-    
-    #List of fields and their elements  
-    hg = hf['AOS']
-    
-    #Getting the values of fields inside groups
-    vals = [vals for vals in hg.values()]
-    
-    #List of fields in str
-    fields = [f for f in hg.keys()]
-    idx    = fields.index(field)
-    
-    data = hf[vals[idx][dataset][0]]
-    
-    return data
-
-
-def meanSTA(data, frames, nstim=8, nf= 241):
-    ''' Calculate the calcium triggered average
-        
 
-    Assumes repetitive cycles through each stimuli
-    in an ordered fashion.
-    
-    Returns mean STA for each stimuli & neuron
+                                   ATTRIBUTES
     ________________________________________________________________________
 
-                                   ARGUMENTS
-    ________________________________________________________________________
 
+    epochs : Epochs of each unit            (nN x nS x seqLen, float32)
+    scale  : Normalization of each epoch    (nN x nS)
+    Xall   : Epochs of all units            (seqLen x nS x nN, view)
+    data   : Remaining elements of dataDict (stimFrame, stimIdx, etc.)
 
-    nstim : Number of stimuli presented
-    nf    : Number of frames to save after stimuli
-        
     ________________________________________________________________________
- 
 
     '''
-    
-    N     = data.shape[0]       # Number of neurons
-    occur = len(frames)/nstim   # Number of occurences for each stim
-    
-    #Initialization
-    sumSTA  = np.zeros([nstim,N,nf]) # Will hold the sum of each elements
-    shift   = int(np.floor(nf/4))    # Shifting of window
-    #stimDat = []
-
-    #Calculate sum STA
-    stim = 0
-    for f in frames:
-        sumSTA[stim,:] += data[:,f+1-shift:f+1+nf-shift]
-        #stimDat = np.hstack([stimDat,data[:,f+1-shift:f+1+nf-shift]])
-        
-        #Increment stim index
-        if stim != nstim-1:
-            stim += 1
-        else:
-            stim = 0
 
-    meanSTA = sumSTA/occur
+    def __init__(self, dataDict, seqRange = [[-2,-1],[0,1]], prepMethod = 1, key = None):
 
-    cellResp = np.zeros([8,N])
-    for stim in range(8):
-        #Integrating overtime
-        cellResp[stim,:] = np.sum(meanSTA[stim,:,shift:-shift],axis=1)
-        
+        F  = np.int64(np.ravel(dataDict['stimFrame'])) #Frame of stimulation
+        D  = dataDict['dataset']   #Dataset
 
-    return meanSTA, cellResp #, stimDat
+        self.key      = key
+        self.seqRange = seqRange
+        self.nS       = len(F)     #Number of stimulations
+        self.nN       = D.shape[0] #Number of units
+        self.stimIdx  = np.reshape(dataDict['stimIdx'], [self.nS,-1]) #Index of neuron stimulated
+        self.index    = cachedStimIndex(self.stimIdx)                  #Stimulations of each neuron
 
+        #Preprocessing data 
+        D = prepDataset(dataDict, prepMethod)
 
-def remBaseline(data, percentile = 10, binsize = 1000):
-    ''' 
-    Will iterate through a time serie, bin it, calculate the 
-    specified percentile and substract this value from the bin.
-    This should remove the slower trend not task specific. 
+        #Epochs of all units (nN x nS x sL)
+        self.epochs = stimEpochs(D, F, seqRange)
+        self.sL     = self.epochs.shape[2] #Sequence lenght
 
-    ________________________________________________________________________
+        #Normalization within each example (as preProcess(.., prepMethod = 2))
+        self.scale = 1/np.absolute(self.epochs).max(axis = 2)
 
-                                   ARGUMENTS
-    ________________________________________________________________________
- 
+        #Epochs with time first (see pairData) 
+        self.Xall = self.epochs.transpose(2,1,0)
 
-    Data       : Has to be size [N x T], where N is number of units 
-                        and T is time of serie
-    percentile : Percentile value that will be used to substract the bin
-    binsize    : Bins size that will be used to correct for drifts
+        #Spontaneous activity
+        if 'datasetSpont' in dataDict:
+            self.spont = spontSampler(dataDict['datasetSpont'], self.sL)
 
-    ________________________________________________________________________
- 
-    '''
+        #Other elements of the data 
+        self.data   = {key: dataDict[key] for key in dataDict if key != 'dataset'}
 
-    #Variables
-    N    = data.shape[0] #Number of neurons
-    T    = data.shape[1] #Number of frames
-    half = int(binsize/2)-1 # Number of points on right and left of bin center
 
-    #Data remove baseline
-    dataBL = data.copy()                
-    
-    #Init
-    baseline = np.zeros([N,T])
+    def labels(self, target, null = False):
+        ''' 
+        Whether target was stimulated (True) or not (False) for each 
+        stimulation. If null, the labels are shuffled.
+        '''
 
-    for t in range(half,T-half):
+        label = self.index.labels(target)
 
-        #Time points in current bin
-        points = range(t-half,t+half+1)
+        #Shuffle labels if null 
+        if null:
+            label = label[np.random.permutation(self.nS)]
 
-        #Calculating percentile 
-        baseline[:,t] = np.percentile(dataBL[:,points], percentile, axis = 1)
+        return label
 
-    #Filling boundaries baseline
-    baseline[:,:half]   = np.tile(baseline[:,  half  ],[half,1]).T 
-    baseline[:,T-half:] = np.tile(baseline[:,T-half-1],[half,1]).T
+
+    def split(self, label):
+        ''' 
+        Random train (80%) and test (20%) stimulations, stratified by label.
+
+        Returns the indexes of train stim, test stim, train noStim and test 
+        noStim stimulations. 
+        '''
+
+        labIdx1 = np.where(label)[0]  #Idx of cells[0] stimulation
+        labIdx0 = np.where(~label)[0] #Idx of non-cells[0] stimulation
+
+        #Number of training examples
+        nTrain1 = int(len(labIdx1)*4/5)
+        nTrain0 = int(len(labIdx0)*4/5)
+
+        #Random permutations of sequences
+        perms1 = labIdx1[np.random.permutation(len(labIdx1))]
+        perms0 = labIdx0[np.random.permutation(len(labIdx0))]
+
+        return perms1[:nTrain1], perms1[nTrain1:], perms0[:nTrain0], perms0[nTrain0:]
+
+
+    def sequences(self, decode, idx):
+        ''' Normalized epochs idx of decoding cell decode (len(idx) x seqLen) '''
+
+        cellLabel = decode - 1 #Correction for index in python
+
+        #Epochs of the decoding cell are a view, only idx are copied
+        E = self.epochs[cellLabel]
+
+        return E[idx] * self.scale[cellLabel, idx].reshape(-1,1)
+
+
+    def spontSequences(self, decode, n):
+        ''' n normalized random windows of spontaneous activity of decode '''
+
+        if not hasattr(self, 'spont'):
+            raise ValueError("ctrl = 'spont' needs the spontaneous activity " +
+                             "(datasetSpont) in the data dictionnary.")
+
+        cellLabel = decode - 1 #Correction for index in python
+
+        spont = np.float32(self.spont.sample(n, cellLabel))
+
+        return spont / np.absolute(spont).max(axis = 1, keepdims = True)
+
+
+    def pairData(self, cells, ctrl = 'noStim', null = False):
+        ''' 
+        Putting the epochs in the right format for training for 
+        classification.
+
+        cells[0] : Cell to predict if was stimulated
+        cells[1] : Cell to use for predicting if cells[0] was stimulated
+        ctrl     : Label 0 sequences, either the epochs of the other 
+                   stimulations ('noStim') or random windows of spontaneous
+                   activity ('spont', needs datasetSpont)
+        null     : Whether the labels are shuffled or not
+
+        Returns { Xtr : [Stim, noStim] training sequences, Ytr : Training labels
+                  Xte : [Stim, noStim] testing  sequences, Yte : Testing labels
+                  Xall: All epochs,                        Yall: All labels }
+        '''
+
+        label = self.labels(cells[0], null = null)
+
+        tr1, te1, tr0, te0 = self.split(label)
+
+        trInput = [ self.sequences(cells[1], tr1) ]
+        teInput = [ self.sequences(cells[1], te1) ]
+
+        if ctrl == 'spont':
+            #Will use spontaneous activity for no-stim label data
+            trInput.append( self.spontSequences(cells[1], len(tr0)) )
+            teInput.append( self.spontSequences(cells[1], len(te0)) )
+
+        elif ctrl == 'noStim':
+            trInput.append( self.sequences(cells[1], tr0) )
+            teInput.append( self.sequences(cells[1], te0) )
+
+        #Stacking label (stim, nostim)
+        trLabel = [ np.ones(len(tr1)), np.zeros(len(tr0)) ]
+        teLabel = [ np.ones(len(te1)), np.zeros(len(te0)) ]
+
+        print( 'Stimulated cell : {}\n'.format(cells[0])  +
+               'Decoding cell   : {}\n'.format(cells[1])  )
+
+        dataDict = { 'Xtr' : trInput , 'Ytr' : trLabel,
+                     'Xte' : teInput , 'Yte' : teLabel,
+                     'Xall': self.Xall,  'Yall': np.float64(label) }
+
+        if ctrl == 'spont':
+            #To draw new training spontaneous windows (see launchGraph)
+            dataDict['spontTr'] = lambda n: self.spontSequences(cells[1], n)
+
+        return dataDict
+
+
+def epochKey(pDict):
+    ''' Identifier of the data and parameters an epochData is built from '''
+
+    return str([ pDict['_mPath'], pDict['dataset'], pDict['nInput'], 
+                 pDict['seqRange'], pDict['prepMethod'] ])
+
+
+def grangerPairs(dataD, seqRange = [10,1], prepMethod = 1, chunk = 10000, nJobs = 1):
+    ''' 
+    Granger causality F statistic of every (source, target) pair, with the 
+    lag structure of dataPrepGenerative : the activity of each target at 
+    t+YDist is regressed on the seqLen last time points of all the units 
+    (full model), and the restricted model of a source removes its seqLen 
+    lags. 
+
+    All the targets share the same design, so its Gram matrix is summed 
+    over chunks of sequences and inverted once. The residual sum of 
+    squares (RSS) lost by removing source i from any full model is then 
+    b_i' inv(Ginv_ii) b_i, where b_i are the full model weights of the lags 
+    of i and Ginv_ii the matching block of the inverse Gram, without 
+    refitting any restricted model. This per-source block inverse replaces
+    rank-one downdates of the inverse: it gives the same RSS for all the 
+    targets at once, with one small L x L inverse per source.
+
+    Only this last step is parallel: the Gram matrix, its inverse and the 
+    full models are computed once in the calling process, and nJobs 
+    processes then each evaluate the RSS increases of a share of the 
+    targets (a single einsum, see _grangerDRSS).
+
+    ________________________________________________________________________
+
+                                   ARGUMENTS
+    ________________________________________________________________________
+
+
+    dataD      : Dataset, see dataPrepGenerative
+    seqRange   : [seqLen, YDist], see dataPrepGenerative
+    prepMethod : See prepDataset
+    chunk      : Number of sequences read at once
+    nJobs      : Number of processes of the RSS increases (targets split)
+
+    ________________________________________________________________________
+
+                                    RETURNS
+    ________________________________________________________________________
+
+
+    F    : F statistic of each pair (source x target)
+    pVal : P-value of each pair (F distribution with seqLen and 
+           nSequences - nInputs*seqLen - 1 degrees of freedom)
+
+    ________________________________________________________________________
+
+    '''
+
+    D = dataPrepGenerative(dataD, seqRange = seqRange, prepMethod = prepMethod, window = True)
+    X = D['FitX']; Y = D['FitY'] #Sequences (nSeq x seqLen x N) and outputs
+
+    n, L, N = X.shape
+    d       = L*N + 1 #Number of parameters of a full model (with intercept)
+
+    #Gram matrix of the lags (lag major, intercept last) and cross products
+    G = np.zeros([d, d]); C = np.zeros([d, N]); yy = np.zeros(N)
+    for i in range(0, n, chunk):
+        x = np.float64(X[i:i+chunk]).reshape(-1, L*N)
+        x = np.concatenate([ x, np.ones([len(x),1]) ], axis = 1)
+        y = np.float64(Y[i:i+chunk])
+
+        G += x.T.dot(x); C += x.T.dot(y); yy += np.sum(y**2, axis = 0)
+
+    #Full models of all targets
+    Ginv = np.linalg.inv(G)
+    beta = Ginv.dot(C)
+    RSS  = yy - np.sum(C*beta, axis = 0)
+
+    #Inverse of the lag block of each source ( N x L x L )
+    lags = np.arange(L).reshape(1,-1)*N + np.arange(N).reshape(-1,1)
+    H    = np.linalg.inv( Ginv[lags[:,:,None], lags[:,None,:]] )
+
+    #RSS increase of each (source, target) restricted model
+    cols = np.array_split(np.arange(N), nJobs)
+    dRSS = Parallel(n_jobs = nJobs)( delayed(_grangerDRSS)(beta[:,c], H, lags) 
+                                     for c in cols if len(c) )
+    dRSS = np.hstack(dRSS)
+
+    dof  = n - d
+    F    = (dRSS/L) / (RSS/dof)
+    pVal = fDist.sf(F, L, dof)
+
+    return F, pVal
+
+
+def _grangerDRSS(beta, H, lags):
+    ''' RSS increase when removing the lags of each source (see grangerPairs) '''
+
+    b = beta[lags] #Weights of the lags of each source ( N x L x nTargets )
+
+    return np.einsum('slt,slm,smt->st', b, H, b)
+
+
+class h5Sessions(object):
+    ''' 
+    Virtual concatenation (along time) of the sessions of a recording, 
+    without reading them. Behaves as a read-only [N x sum(T)] array where 
+    the frames of each session follow those of the previous ones. Only the 
+    frames that are indexed are read from the sessions (e.g. h5py datasets),
+    so that extracting stimulation epochs (see stimEpochs) never needs the
+    whole recording in memory.
+
+    ________________________________________________________________________
+
+                                   ARGUMENTS
+    ________________________________________________________________________
+
+
+    sessions : List of [N x T_i] arrays of each session (h5py datasets, 
+               memory-mapped arrays, etc.)
+    rows     : Units kept (slice)
+    ops      : Preprocessing applied to the frames read (see prep)
+
+    ________________________________________________________________________
+
+                                   ATTRIBUTES
+    ________________________________________________________________________
+
+
+    offsets : Global index of the first frame of each session (and the 
+              total number of frames as last element)
+    shape   : (N, sum(T))
+
+    ________________________________________________________________________
+
+    '''
+
+    def __init__(self, sessions, rows = slice(None), ops = []):
+
+        self.sessions = sessions
+        self.rows     = rows
+        self.ops      = ops
+
+        lengths      = [ s.shape[1] for s in sessions ] #Number of frames of each session
+        self.offsets = np.int64(np.hstack([0, np.cumsum(lengths)]))
+
+        self.shape = ( len(range(sessions[0].shape[0])[rows]), int(self.offsets[-1]) )
+        self.ndim  = 2
+        self.dtype = np.dtype(np.float64) if ops else np.dtype(sessions[0].dtype)
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __array__(self, dtype = None, copy = None):
+        ''' Reads all the sessions '''
+
+        X = self.take(np.arange(self.shape[1]))
+
+        return X if dtype is None else X.astype(dtype, copy = False)
+
+
+    def __getitem__(self, key):
+        ''' 
+        Selecting only units (D[:n] or D[:n,:]) returns a lazy h5Sessions. 
+        Otherwise, the frames are read and the units are then selected 
+        (rows and columns are indexed separately).
+        '''
+
+        rows, cols = key if type(key) is tuple else (key, slice(None))
+
+        if isinstance(rows, slice) and isinstance(cols, slice) and cols == slice(None):
+            r = range(self.sessions[0].shape[0])[self.rows][rows]
+            r = slice(r.start, r.stop if r.stop >= 0 else None, r.step)
+
+            ops = [ (op[0],) + tuple(o[rows] for o in op[1:]) for op in self.ops ]
+
+            return h5Sessions(self.sessions, r, ops)
+
+        cIdx = np.arange(self.shape[1])[cols]
+        X    = self.take(cIdx).reshape((self.shape[0],) + np.shape(cIdx))
+
+        return X[rows]
+
+
+    def take(self, frames):
+        ''' 
+        Array [N x len(frames)] of the given global frames. Each range of 
+        consecutive frames inside a session is read at once. 
+        '''
+
+        frames = np.int64(np.ravel(frames))
+
+        if len(frames) and ( frames.min() < 0 or frames.max() >= self.shape[1] ):
+            raise IndexError('Frames need to be inside the {} frames of the '.format(self.shape[1]) +
+                             'sessions.')
+
+        uniq, inv = np.unique(frames, return_inverse = True)
+        sess      = np.searchsorted(self.offsets, uniq, side = 'right') - 1 #Session of frames
+
+        X = np.empty((self.shape[0], len(uniq)), dtype = self.sessions[0].dtype)
+
+        #Ranges of consecutive frames of a same session
+        brk    = np.where( (np.diff(uniq) != 1) | (np.diff(sess) != 0) )[0] + 1
+        starts = np.hstack([0, brk])         if len(uniq) else []
+        stops  = np.hstack([brk, len(uniq)]) if len(uniq) else []
+
+        for a, b in zip(starts, stops):
+            t0 = int(uniq[a] - self.offsets[sess[a]]) #First frame in session
+            X[:, a:b] = self.sessions[sess[a]][self.rows, t0:t0+b-a]
+
+        #Preprocessing
+        for op in self.ops:
+            if op[0] == 'base':
+                X = X / op[1][:, uniq]
+            elif op[0] == 'affine':
+                X = X * op[1].reshape(-1,1) + op[2].reshape(-1,1)
+
+        return X[:, np.ravel(inv)]
+
+
+    def chunks(self, size = 100000):
+        ''' Iterates over the frames, size at a time (t0, t1, frames) '''
+
+        size = int(size)
+
+        for t0 in range(0, self.shape[1], size):
+            t1 = min(t0 + size, self.shape[1])
+            yield t0, t1, self.take(np.arange(t0, t1))
+
+
+    def rowStats(self, chunk = 100000):
+        ''' Mean, std, min and max of each unit, reading chunk frames at a time '''
+
+        n = 0; mean = 0; M2 = 0; mn = np.inf; mx = -np.inf
+
+        for t0, t1, X in self.chunks(chunk):
+            #Merging the statistics of the chunk
+            k     = t1 - t0
+            meanC = X.mean(axis = 1)
+            delta = meanC - mean
+
+            M2   = M2 + ((X - meanC.reshape(-1,1))**2).sum(axis = 1) + delta**2*n*k/(n+k)
+            mean = mean + delta*k/(n+k)
+            n    = n + k
+
+            mn = np.minimum(mn, X.min(axis = 1))
+            mx = np.maximum(mx, X.max(axis = 1))
+
+        return mean, np.sqrt(M2/n), mn, mx
+
+
+    def prep(self, prepMethod, base = None, chunk = 100000):
+        ''' 
+        Lazy version of preProcess. Every method is an affine transformation
+        of each unit (or a division by the baseline), which is applied when
+        the frames are read. The statistics of methods 1 to 4 are computed 
+        by reading the sessions chunk frames at a time. 
+        '''
+
+        if prepMethod == 5:
+            #Delta f over F
+            return h5Sessions(self.sessions, self.rows, self.ops + [('base', base)])
+
+        if prepMethod not in [1,2,3,4]:
+            return self
+
+        a, b = _prepAffine(prepMethod, *self.rowStats(chunk))
+
+        return h5Sessions(self.sessions, self.rows, self.ops + [('affine', a, b)])
+
+
+def npyDict2Dir(path, newPath = None):
+    ''' 
+    Will convert a dataset saved as a pickled dictionnary with np.save 
+    (previous rawFormating_simul.py format) to a directory of .npy arrays 
+    that can be memory-mapped (see saveNpyDir). By default, the directory 
+    has the same name as the file without '.npy'. Returns the new path.
+    '''
+
+    if newPath is None:
+        newPath = path.rsplit('.npy',1)[0]
+
+    saveNpyDir(newPath, np.load(path, allow_pickle = True).item())
+
+    return newPath
+
+
+def lagCorr(data, maxLag = 10, frames = None, seqRange = [0,30], memory = 1e9, out = None):
+    ''' 
+    Lagged cross-correlation of all pairs of units, for lags of -maxLag to 
+    maxLag, computed with FFTs. Units are processed by tiles of units whose
+    size keeps the memory of the epochs, spectra and cross spectra of two 
+    tiles under memory (at least one unit per tile), so any number of units
+    and epochs can be used. The epochs of each tile are extracted when the
+    tile is processed. Each unit is z-scored over the time points used.
+
+    ________________________________________________________________________
+
+                                   ARGUMENTS
+    ________________________________________________________________________
+
+
+    data     : Data of size [N x T] (array, memory-mapped array or h5Sessions)
+    maxLag   : Largest lag (in frames)
+    frames   : If given, only the post-stimulation epochs of these 
+               stimulation frames are used, lags staying inside each epoch
+    seqRange : Range of the epochs after the stimulation ( [t+x, t+y[ )
+    memory   : Memory budget (in bytes) of the epochs, spectra and cross 
+               spectra of two tiles
+    out      : Output array (e.g. memory-mapped) of size N x N x (2*maxLag+1)
+
+    ________________________________________________________________________
+
+                                    RETURNS
+    ________________________________________________________________________
+
+
+    C : Correlation of unit i at t with unit j at t+lag, where 
+        C[i,j,maxLag+lag] for lag in [-maxLag, maxLag] (float32)
+
+    ________________________________________________________________________
+
+    '''
+
+    N = data.shape[0]
+
+    if frames is None:
+        nE = 1                      #Single epoch of all the time points
+        W  = data.shape[1]
+    else:
+        nE = len(np.ravel(frames))  #Epochs are extracted per tile (see spectra)
+        W  = seqRange[1] - seqRange[0]
+
+    if maxLag >= W:
+        raise ValueError('maxLag ({}) needs to be smaller than the'.format(maxLag) +
+                         ' length of the epochs ({}).'.format(W))
+
+    nFFT = next_fast_len(W + maxLag)
+    nF   = nFFT//2 + 1
+    lags = np.arange(-maxLag, maxLag+1)
+
+    #Number of products summed at each lag
+    nProd = (W - np.abs(lags)) * nE
+
+    #Tile size under the memory budget, solving a*tile**2 + b*tile = memory with
+    #the cross spectra and correlations of two tiles (a), and the spectra 
+    #(complex128) and epochs (float32 and float64) of two tiles (b)
+    a     = 16.*nF + 8.*nFFT
+    b     = 2*nE*(16.*nF + 12.*W)
+    tile  = int(max(1, min(N, (np.sqrt(b**2 + 4*a*memory) - b) / (2*a))))
+    tiles = [np.arange(i, min(i+tile, N)) for i in range(0, N, tile)]
+
+    def spectra(r):
+        #FFT of the z-scored epochs of units r ( nF x len(r) x nEpochs )
+        if frames is None:
+            x = np.float64(data[r[0]:r[-1]+1])
+        else:
+            x = np.float64(stimEpochs(data[r[0]:r[-1]+1], frames, [[0,0], seqRange]))
+
+        x = x.reshape(len(r), -1, W)
+        x = x - x.mean(axis = (1,2), keepdims = True)
+        x = x / np.maximum(x.std(axis = (1,2), keepdims = True), 1e-12)
+
+        return np.fft.rfft(x, nFFT, axis = 2).transpose(2,0,1)
+
+    if out is None:
+        out = np.zeros([N, N, len(lags)], dtype = np.float32)
+
+    for a, ra in enumerate(tiles):
+        Fa = spectra(ra).conj()
+
+        for rb in tiles[a:]:
+            Fb = Fa.conj() if rb is ra else spectra(rb)
+
+            #Cross spectra summed over epochs, back to lags ( na x nb x nFFT )
+            S = np.matmul(Fa, Fb.transpose(0,2,1))
+            c = np.fft.irfft(S.transpose(1,2,0), nFFT, axis = 2)[:,:,lags] / nProd
+
+            out[ra[0]:ra[-1]+1, rb[0]:rb[-1]+1] = c
+
+            if rb is not ra:
+                #Correlation of j with i is at the opposite lag
+                out[rb[0]:rb[-1]+1, ra[0]:ra[-1]+1] = c.transpose(1,0,2)[:,:,::-1]
+
+    return out
+
+
+def loadNpyDir(path, mmap = True):
+    ''' 
+    Will load a directory of .npy arrays (see saveNpyDir) as a dictionnary
+    where each key is a file name. If mmap, arrays are opened read-only 
+    memory-mapped, so only the parts used are read from disk and the pages
+    are shared by all the processes reading the same files.
+    '''
+
+    mode = 'r' if mmap else None
+
+    return { f[:-4]: np.load(os.path.join(path, f), mmap_mode = mode)
+             for f in os.listdir(path) if f.endswith('.npy') }
+
+
+def loadHDF5Dataset(path,field,dataset):
+    ''' Will return the values associated with the field of 
+        the specified dataset. See the README.md file of the 
+        dataset for a description of each dataset and field.
+
+        This function is specific to optogenetic data in V1
+        from Haüsser lab.
+
+    ________________________________________________________________________
+
+                                   ARGUMENTS
+    ________________________________________________________________________
+
+
+    path    : Path to the dataset
+    field   : Name of the field in the dataset to load
+    dataset : Number of dataset to load
+
+    ________________________________________________________________________
+ 
+
+    '''
+    
+    #To adjust for python indexing
+    dataset = dataset - 1
+    
+    #Open h5py file
+    hf = h5py.File(path,'r')
+    
+    #List of fields and their elements  
+    hg = hf['AOS']
+    
+    #Getting the values of fields inside groups
+    vals = [vals for vals in hg.values()]
+    
+    #List of fields in str
+    fields = [f for f in hg.keys()]
+    idx    = fields.index(field)
+    
+    data = hf[vals[idx][dataset][0]]
+    
+    return data
+
+
+def meanSTA(data, frames, nstim=8, nf= 241):
+    ''' Calculate the calcium triggered average
+        
+
+    Assumes repetitive cycles through each stimuli
+    in an ordered fashion (see staAccumulator for 
+    any order of stimuli).
+    
+    Returns mean STA for each stimuli & neuron
+    ________________________________________________________________________
+
+                                   ARGUMENTS
+    ________________________________________________________________________
+
+
+    nstim : Number of stimuli presented
+    nf    : Number of frames to save after stimuli
+        
+    ________________________________________________________________________
+ 
+
+    '''
+    
+    #Stimuli presented in cycles
+    labels = np.arange(len(frames)) % nstim
+
+    sta   = staAccumulator(data.shape[0], nf).update(data, frames, labels)
+    shift = sta.shift
+
+    meanSTA = sta.mean
+
+    #Integrating overtime
+    cellResp = np.sum(meanSTA[:,:,shift:-shift], axis=2)
+
+    return meanSTA, cellResp
+
+
+def remBaseline(data, percentile = 10, binsize = 1000, step = 1, nJobs = 1):
+    ''' 
+    Will iterate through a time serie, bin it, calculate the 
+    specified percentile and substract this value from the bin.
+    This should remove the slower trend not task specific. 
+
+    The percentile of each bin is obtained from the order statistics of 
+    all the bins of a unit at once with a running rank filter (see 
+    scipy.ndimage.rank_filter, O(T log w) from SciPy 1.14) or a sorted 
+    window updated frame by frame on older SciPy, instead of a sort of 
+    every bin, and units are split across nJobs processes. 
+
+    ________________________________________________________________________
+
+                                   ARGUMENTS
+    ________________________________________________________________________
+ 
+
+    Data       : Has to be size [N x T], where N is number of units 
+                        and T is time of serie
+    percentile : Percentile value that will be used to substract the bin
+    binsize    : Bins size that will be used to correct for drifts
+    step       : If > 1, the percentile is only calculated every step 
+                 frames and linearly interpolated in between
+    nJobs      : Number of processes used (units are split between them)
+
+    ________________________________________________________________________
+ 
+    See remBaselineChunks to remove the baseline by chunks of time.
+
+    '''
+
+    #Variables
+    N    = data.shape[0] #Number of neurons
+    T    = data.shape[1] #Number of frames
+    half = int(binsize/2)-1 # Number of points on right and left of bin center
+
+    #Init
+    baseline = np.zeros([N,T])
+
+    #Percentile of each bin centered on half:T-half
+    baseline[:,half:T-half] = _rollPercentile(data, percentile, 2*half+1, step, nJobs)
+
+    #Filling boundaries baseline
+    baseline[:,:half]   = baseline[:,  half  ].reshape(-1,1)
+    baseline[:,T-half:] = baseline[:,T-half-1].reshape(-1,1)
 
     #Removing baseline
-    dataBL = dataBL - baseline
+    dataBL = data - baseline
+
+    return dataBL, baseline
+
+
+def remBaselineChunks(data, percentile = 10, binsize = 1000, chunk = 100000, step = 1, nJobs = 1):
+    ''' 
+    Same as remBaseline, but going through the time serie by chunks of 
+    time so that neither the whole data nor the whole baseline have to be
+    held in memory. data can be any array that can be sliced (numpy array,
+    memmap, h5py dataset, etc.) and is read one chunk (plus half a bin on
+    each side) at a time.
+
+    ________________________________________________________________________
+
+                                   ARGUMENTS
+    ________________________________________________________________________
+ 
+
+    chunk : Number of frames per chunk
+
+    See remBaseline for the other arguments.
+
+    ________________________________________________________________________
+
+                                    RETURNS
+    ________________________________________________________________________
+
+
+    Generator of (t0, t1, dataBL, baseline) for each chunk, where dataBL 
+    and baseline are the remBaseline outputs for frames [t0, t1[ .
+
+    ________________________________________________________________________
+ 
+    '''
+
+    #Variables
+    N    = data.shape[0] #Number of neurons
+    T    = data.shape[1] #Number of frames
+    half = int(binsize/2)-1 # Number of points on right and left of bin center
+    w    = 2*half+1         # Number of points per bin
+
+    #Baseline of first and last bins, used for the boundaries
+    first = _rollPercentile(np.asarray(data[:,   :w]), percentile, w)[:,0]
+    last  = _rollPercentile(np.asarray(data[:,T-w: ]), percentile, w)[:,0]
+
+    for t0 in range(0, T, chunk):
+        t1 = min(t0+chunk, T)
+
+        #Bins centers in current chunk
+        c0 = max(t0,   half)
+        c1 = min(t1, T-half)
+
+        baseline = np.zeros([N,t1-t0])
+
+        if c0 < c1:
+            baseline[:,c0-t0:c1-t0] = _rollPercentile( np.asarray(data[:, c0-half:c1+half]), 
+                                                       percentile, w, step, nJobs )
+        #Filling boundaries baseline
+        if t0 < half:
+            baseline[:,:min(half,t1)-t0]   = first.reshape(-1,1)
+        if t1 > T-half:
+            baseline[:,max(T-half,t0)-t0:] = last.reshape(-1,1)
+
+        #Removing baseline
+        dataBL = np.asarray(data[:,t0:t1]) - baseline
+
+        yield t0, t1, dataBL, baseline
+
+
+def _rollPercentile(X, percentile, w, step = 1, nJobs = 1):
+    ''' 
+    Percentile of every w-long window of each row of X ( N x L ), same as 
+    np.percentile (linear interpolation). Returns N x (L-w+1). Rows are 
+    split across nJobs processes.
+    '''
+
+    if nJobs == 1:
+        return np.vstack([ _rollPercentileRow(x, percentile, w, step) for x in X ])
+
+    #Units are split between processes
+    rows = np.array_split(np.arange(X.shape[0]), nJobs)
+    base = Parallel(n_jobs = nJobs)( delayed(_rollPercentile)(X[r], percentile, w, step)
+                                     for r in rows if len(r) )
+
+    return np.vstack(base)
+
+
+def _rollPercentileRow(x, percentile, w, step = 1):
+    ''' Rolling percentile of a single time serie x (see _rollPercentile) '''
+
+    nOut = len(x) - w + 1 #Number of windows
+
+    #Sorted ranks surrounding the percentile
+    p    = percentile/100.*(w-1)
+    lo   = int(np.floor(p))
+    hi   = min(lo+1, w-1)
+    frac = p - lo
+
+    if step > 1:
+        #Percentile every step frames (and last frame), interpolated in between
+        centers = np.unique(np.hstack([ np.arange(0, nOut, step), nOut-1 ]))
+        windows = np.lib.stride_tricks.as_strided(x, shape   = (nOut, w), 
+                                                     strides = x.strides*2)
+        base    = np.hstack([ np.percentile(windows[c], percentile, axis = 1) 
+                              for c in np.array_split(centers, len(centers)//1000+1) ])
+
+        return np.interp(np.arange(nOut), centers, base)
+
+    x = np.asarray(x, dtype = np.float64)
+
+    if _rankFilter1D:
+        #Order statistics lo and hi of all windows, the window starting at t
+        #is the one of the rank filter output at t + w//2
+        c    = w//2
+        low  = rank_filter(x, lo, size = w)[c:c+nOut]
+        high = rank_filter(x, hi, size = w)[c:c+nOut] if hi != lo else low
+
+        return low + frac*(high-low)
+
+    #Sorted window, updated by a binary search removal and insertion per frame
+    window = sorted(x[:w].tolist())
+    out    = np.empty(nOut)
+    xl     = x.tolist()
+
+    for t in range(nOut):
+        out[t] = window[lo] + frac*(window[hi]-window[lo])
+        if t+w < len(xl):
+            del window[bisect.bisect_left(window, xl[t])]
+            bisect.insort(window, xl[t+w])
+
+    return out
+
+
+def pairScreen(ED, targets = None):
+    ''' 
+    Cheap statistics of every (stimulated cell, decoding cell) pair, all 
+    computed at once from the stimulation epochs of epochData ED. For each
+    stimulation and unit, the response is the mean activity after minus 
+    before the stimulation (seqRange). The responses of the stimulations of
+    a target are then compared to the other stimulations with sums over a 
+    stimulation x target incidence matrix (matrix products).
+
+    ________________________________________________________________________
+
+                                   ARGUMENTS
+    ________________________________________________________________________
+
+
+    ED      : epochData
+    targets : Stimulated cells to screen (all the stimulated cells if None)
+
+    ________________________________________________________________________
+
+                                    RETURNS
+    ________________________________________________________________________
+
+
+    stats : { targets : Stimulated cells,
+              effect  : Mean response difference (stim - other stim),
+              t       : Welch's t statistic of the response difference,
+              auc     : Probability that a response to stim is larger than
+                        a response to other stim (Mann-Whitney),
+              n1, n0  : Number of stim and other stim of each target }
+
+            Format:
+                    effect, t, auc : nTargets x nN
+
+    ________________________________________________________________________
+
+    '''
+
+    if targets is None:
+        targets = [c for c in ED.index.cells if c <= ED.nN]
+    targets = np.array(targets)
+
+    #Response to each stimulation (nN x nS)
+    nPre  = ED.seqRange[0][1] - ED.seqRange[0][0] #Number of time points before stim
+    resp  = np.float64(ED.epochs[:,:,nPre:]).mean(axis = 2)
+    if nPre:
+        resp -= np.float64(ED.epochs[:,:,:nPre]).mean(axis = 2)
+
+    #Whether target was stimulated (nS x nTargets)
+    M = np.float64( np.stack([ED.index.labels(t) for t in targets], axis = 1) )
+
+    n1 = M.sum(axis = 0)
+    n0 = ED.nS - n1
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        #Means and variances of stim (1) and other stim (0) responses
+        s1 = resp.dot(M);      s0 = resp.sum(axis = 1, keepdims = True) - s1
+        q1 = (resp**2).dot(M); q0 = (resp**2).sum(axis = 1, keepdims = True) - q1
+
+        m1 = s1/n1;                 m0 = s0/n0
+        v1 = (q1 - n1*m1**2)/(n1-1); v0 = (q0 - n0*m0**2)/(n0-1)
+
+        t = (m1 - m0) / np.sqrt(v1/n1 + v0/n0)
+
+        #Area under ROC curve from the rank sums of stim responses
+        ranks = _rowRanks(resp)
+        auc   = ( ranks.dot(M) - n1*(n1+1)/2 ) / (n1*n0)
+
+    stats = { 'targets': targets, 'effect': (m1 - m0).T, 't': t.T, 'auc': auc.T,
+              'n1': n1, 'n0': n0 }
+
+    return stats
+
+
+def _rowRanks(X):
+    ''' Ranks (1 to n) of the elements of each row of X, ties getting their
+        average rank as scipy.stats.rankdata, with a single sort of X '''
+
+    n     = X.shape[1]
+    order = np.argsort(X, axis = 1, kind = 'mergesort')
+    rows  = np.arange(X.shape[0]).reshape(-1,1)
+    S     = X[rows, order]
+
+    #Groups of tied values, never spanning two rows
+    new        = np.ones(S.shape, dtype = bool)
+    new[:,1:]  = S[:,1:] != S[:,:-1]
+    start      = np.flatnonzero(new)
+    size       = np.diff(np.append(start, S.size))
+    group      = np.cumsum(new) - 1
+
+    #Average rank of each group
+    avg = start % n + (size + 1)/2.
+
+    R = np.empty(S.shape)
+    R[rows, order] = avg[group].reshape(S.shape)
+
+    return R
+
+
+def permTest(acc, accNull):
+    ''' 
+    Permutation test of the pair classifiers. The p-value of each pair is 
+    the proportion of its label-shuffled replicas reaching its accuracy 
+    (averaged over folds), (1 + #{null >= acc}) / (1 + nNull). The 
+    accuracy of each replica needs to be averaged over the same number of
+    folds (see dataPrepClassiPairs).
+
+    ________________________________________________________________________
+
+                                   ARGUMENTS
+    ________________________________________________________________________
+
+
+    acc     : Accuracy of the pairs (nFolds x nTargets x nDecoders)
+    accNull : Accuracy of the shuffled replicas, averaged over their folds
+              (nNull x nTargets x nDecoders)
+
+    ________________________________________________________________________
+
+                                    RETURNS
+    ________________________________________________________________________
+
+
+    pVal : P-value of each pair (nTargets x nDecoders), NaN if not trained
+
+    ________________________________________________________________________
+
+    '''
+
+    obs  = np.mean(acc, axis = 0)
+    nGeq = np.sum(accNull >= obs, axis = 0)
+
+    pVal = (1. + nGeq) / (1. + accNull.shape[0])
+    pVal[np.isnan(obs)] = np.nan
 
-    return dataBL, baseline
+    return pVal
 
-def preProcess(D, prepMethod = 1, base = None):
-        #Calibrating data 
-    nT = D.shape[1] #Number of time point
 
-    #Calibrating data 
+def prepDataset(dataDict, prepMethod = 1):
+    ''' 
+    Preprocessed dataset of dataDict (see preProcess), where prepMethod 
+    can be a single method or a list of methods executed in order. The 
+    methods are fused in a single pass and the result is float32 (see 
+    prepPipeline).
+
+    If the dataset was already preprocessed with prepMethod (dataDict 
+    'prepDone' element, see loadDataPrep), it is returned as is.
+    '''
+
+    D = dataDict['dataset']
+    B = dataDict['baseline']
+
+    #Already preprocessed (e.g. loaded from cache)
+    if 'prepDone' in dataDict and np.array_equal(dataDict['prepDone'], prepMethod):
+        return D
+
+    return prepPipeline(D, prepMethod, base = B)
+
+
+def prepPipeline(D, prepMethod = 1, base = None, chunk = 100000, out = None, 
+                 dtype = np.float32):
+    ''' 
+    Preprocessing of D with a list of methods (see preProcess) compiled 
+    into a single transformation. Methods 1 to 4 are affine transformations
+    of each unit, so consecutive ones are composed into one, and the 
+    statistics they need are derived from the previous ones without reading
+    the data again. Statistics are only computed (by chunks of frames, with
+    merged running means and variances) at the start of the chain or after 
+    a division by the baseline (method 5).
+
+    The preprocessed data is then written chunk frames at a time in out, 
+    with in place arithmetic, so no full temporary array is created. If out
+    is D itself (writable float array), D is preprocessed in place with no 
+    copy. If D is an h5Sessions, the transformation stays lazy (see 
+    h5Sessions.prep).
+
+    ________________________________________________________________________
+
+                                   ARGUMENTS
+    ________________________________________________________________________
+
+
+    D          : Data of size [N x T] (array, memory-mapped array or 
+                 h5Sessions)
+    prepMethod : Method or list of methods executed in order (see preProcess)
+    base       : Baseline of size [N x T] (method 5)
+    chunk      : Number of frames read at once
+    out        : Output array of size [N x T] (e.g. D or memory-mapped)
+    dtype      : Type of the output if out is None
+
+    ________________________________________________________________________
+
+                                    RETURNS
+    ________________________________________________________________________
+
+
+    D : Preprocessed data (D as is if no method applies)
+
+    ________________________________________________________________________
+
+    '''
+
+    methods = [prepMethod] if np.ndim(prepMethod) == 0 else list(prepMethod)
+    L       = D if isinstance(D, h5Sessions) else h5Sessions([D])
+
+    #Compiling the methods into a list of operations
+    ops = []; stats = None
+    for meth in methods:
+        if meth == 5:
+            #Delta f over F
+            ops.append(('base', base)); stats = None
+
+        elif meth in [1,2,3,4]:
+            if stats is None:
+                #Statistics of the data transformed so far
+                stats = h5Sessions(L.sessions, L.rows, L.ops + ops).rowStats(chunk)
+
+            a, b  = _prepAffine(meth, *stats)
+            stats = _affineStats(a, b, *stats)
+
+            if ops and ops[-1][0] == 'affine':
+                #Composing with the previous affine transformation
+                a, b = ops[-1][1]*a, ops[-1][2]*a + b
+                ops.pop()
+
+            ops.append(('affine', a, b))
+
+    if not ops:
+        return D
+
+    if isinstance(D, h5Sessions):
+        return h5Sessions(D.sessions, D.rows, D.ops + ops)
+
+    if out is None:
+        out = np.empty(D.shape, dtype = dtype)
+
+    for t0 in range(0, D.shape[1], int(chunk)):
+        t1 = min(t0 + int(chunk), D.shape[1])
+        X  = out[:, t0:t1]
+
+        if out is not D:
+            X[...] = D[:, t0:t1]
+
+        for op in ops:
+            if op[0] == 'base':
+                np.divide(X, op[1][:, t0:t1], out = X, casting = 'unsafe')
+            else:
+                X *= op[1].reshape(-1,1).astype(X.dtype)
+                X += op[2].reshape(-1,1).astype(X.dtype)
+
+    return out
+
+
+def _affineStats(a, b, mean, std, mn, mx):
+    ''' Statistics of each unit after the transformation a*x + b '''
+
+    lo, hi = mn*a + b, mx*a + b
+
+    return mean*a + b, std*np.absolute(a), np.minimum(lo, hi), np.maximum(lo, hi)
+
+
+def _prepAffine(prepMethod, mean, std, mn, mx):
+    ''' 
+    Scale a and shift b of each unit (a*x + b) of methods 1 to 4 (see 
+    preProcess), from the mean, std, min and max of each unit.
+    '''
+
     if prepMethod == 1:
         # Standardizing
-        std  = np.tile( np.std(D, axis = 1),(nT,1)).T #Matrix of mean for each row 
-        mean = np.tile(np.mean(D, axis = 1),(nT,1)).T #Matrix of std  for each row
-        D = np.divide(D-mean,std)
+        a = 1/std
+        b = -mean/std
 
     elif prepMethod == 2:
         # Normalizing 
-        D = D/np.absolute(D).max(axis=1).reshape(-1, 1)
+        a = 1/np.maximum(np.absolute(mn), np.absolute(mx))
+        b = np.zeros_like(a)
 
     elif prepMethod == 3:
         # Normalizing with only positive values by shifting values in positive
-        D = D+abs(D.min())
-        D = D/D.max(axis=1).reshape(-1, 1)
+        shift = abs(mn.min())
+        a     = 1/(mx + shift)
+        b     = shift*a
 
-    elif prepMethod == 4: 
-        # Standardizing
-        std  = np.tile( np.std(D, axis = 1),(nT,1)).T #Matrix of mean for each row 
-        mean = np.tile(np.mean(D, axis = 1),(nT,1)).T #Matrix of std  for each row
-        D = np.divide(D-mean,std)
+    elif prepMethod == 4:
+        # Standardizing, then normalizing with the maximum of standardized values
+        a = 1/std
+        b = -mean/std
+        m = np.maximum(np.absolute(mn*a + b), np.absolute(mx*a + b))
+        a = a/m
+        b = b/m
+
+    return a, b
+
+
+def preProcess(D, prepMethod = 1, base = None):
+        #Calibrating data 
+    if isinstance(D, h5Sessions):
+        #Lazy dataset, transformation applied when frames are read
+        return D.prep(prepMethod, base)
+
+    #Calibrating data (1: standardizing, 2: normalizing, 3: normalizing with
+    #only positive values, 4: standardizing then normalizing, 5: delta f over F)
+    return prepPipeline(D, prepMethod, base = base, dtype = np.float64)
 
-        # Normalizing 
-        D = D/np.absolute(D).max(axis=1).reshape(-1, 1)
 
-    elif prepMethod == 5:
-        #Delta f over F
-        D = D/base
+def saveNpyDir(path, data):
+    ''' 
+    Will save each array of the data dictionnary as path/key.npy, a format 
+    that can be memory-mapped (see loadNpyDir). 
+    '''
 
-    return D
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    for key in data:
+        np.save(os.path.join(path, key + '.npy'), np.asarray(data[key]))
 
 
 def shapeData(_Xtr, seqLen, nInput):
@@ -892,33 +1894,485 @@ def shapeData(_Xtr, seqLen, nInput):
     return _Z1
 
 
-def stim_nstim_split(data,frameSet):
+class spontSampler(object):
+    ''' 
+    Random windows of spontaneous activity, drawn when needed from the 
+    recording (array, memory-mapped array, h5Sessions or h5py dataset) 
+    without loading it. All the windows of a draw are read with a single
+    gather (see stimEpochs), so only the frames of the windows are read.
+
+    ________________________________________________________________________
+
+                                   ARGUMENTS
+    ________________________________________________________________________
+
+
+    source : Spontaneous activity of size [N x T]
+    sL     : Lenght of windows
+
+    ________________________________________________________________________
+
+    '''
+
+    def __init__(self, source, sL):
+
+        if not isinstance(source, (np.ndarray, h5Sessions)):
+            #Single session on disk (e.g. h5py dataset)
+            source = h5Sessions([source])
+
+        self.source = source
+        self.sL     = sL
+        self.shape  = source.shape
+
+
+    def sample(self, n, unit = None):
+        ''' 
+        n random windows of unit (n x sL), or of all units (N x n x sL) 
+        if unit is None.
+        '''
+
+        #First frame of windows
+        starts = np.random.randint(0, self.shape[1] - self.sL, n)
+
+        S = self.source if unit is None else self.source[unit:unit+1]
+        W = stimEpochs(S, starts, [[0,0],[0,self.sL]], dtype = S.dtype)
+
+        return W if unit is None else W[0]
+
+
+class staAccumulator(object):
+    ''' 
+    Stimulus triggered averages (STA) of any number of stimuli, updated 
+    incrementally as new events arrive. The mean, variance and number of 
+    events of each (stimulus, neuron, lag) are merged batch by batch (Chan 
+    et al.), so the data can be passed in chunks and never needs to be in 
+    memory at once. The windows of a batch are extracted with a single 
+    gather (see stimEpochs) and summed per stimulus with np.add.at.
+
+    ________________________________________________________________________
+
+                                   ARGUMENTS
+    ________________________________________________________________________
+
+
+    N     : Number of neurons
+    nf    : Number of frames of each window
+    shift : Frames of the window before the event (window is 
+            [f+1-shift, f+1+nf-shift[ as in meanSTA). nf/4 if None.
+
+    ________________________________________________________________________
+
+                                   ATTRIBUTES
+    ________________________________________________________________________
+
+
+    labels : Stimuli seen so far (sorted), of the type of the labels given
+             to update (any sortable type, None before the first update)
+    count  : Number of events of each stimulus
+    mean   : STA of each stimulus        (nStim x N x nf)
+    var    : Variance around the STA     (nStim x N x nf)
+
+    ________________________________________________________________________
+
+    '''
+
+    def __init__(self, N, nf, shift = None):
+
+        self.N     = N
+        self.nf    = nf
+        self.shift = int(np.floor(nf/4)) if shift is None else shift
+
+        self.labels = None
+        self.count  = np.zeros(0)
+        self.mean   = np.zeros([0,N,nf])
+        self._M2    = np.zeros([0,N,nf]) #Summed squared deviations
+
+
+    @property
+    def var(self):
+        ''' Variance around the STA (0 for stimuli with a single event) '''
+        return self._M2 / np.maximum(self.count - 1, 1).reshape(-1,1,1)
+
+
+    def update(self, data, frames, labels, offset = 0, chunk = None):
+        ''' 
+        Adds the events of stimuli labels at frames. data holds the frames
+        offset to offset+T of the recording (N x T), and the windows of the
+        events need to be inside data. Events are gathered by chunks of 
+        chunk events (all at once if None).
+        '''
+
+        frames = np.int64(np.ravel(frames)) - offset
+        idx    = self._index(np.ravel(labels))
+        chunk  = len(frames) if chunk is None else chunk
+
+        for c in range(0, len(frames), chunk):
+            s = slice(c, c+chunk)
+
+            #Windows of the events ( nEvents x N x nf )
+            E = stimEpochs(data, frames[s], [[0,0],[1-self.shift, 1+self.nf-self.shift]],
+                           dtype = np.float64).transpose(1,0,2)
+
+            self._merge(E, idx[s])
+
+        return self
+
+
+    def _merge(self, E, idx):
+        ''' Merges the mean and deviations of a batch of windows, only for
+            the stimuli of the batch '''
+
+        u, inv = np.unique(idx, return_inverse = True)
+        inv    = np.ravel(inv)
+        n      = np.bincount(inv).astype(np.float64)
+
+        #Mean and summed squared deviations of the batch, per stimulus
+        mB = np.zeros((len(u),) + E.shape[1:])
+        np.add.at(mB, inv, E)
+        mB /= n.reshape(-1,1,1)
+
+        M2B = np.zeros_like(mB)
+        np.add.at(M2B, inv, (E - mB[inv])**2)
+
+        #Chan et al. parallel merge
+        c     = self.count[u]
+        nT    = c + n
+        delta = mB - self.mean[u]
+        w     = (n / nT).reshape(-1,1,1)
+
+        self.mean[u]  += delta * w
+        self._M2[u]   += M2B + delta**2 * w * c.reshape(-1,1,1)
+        self.count[u]  = nT
+
+
+    def _index(self, labels):
+        ''' Index of each label, adding the new stimuli '''
+
+        labels = np.asarray(labels)
+
+        if self.labels is None:
+            self.labels = labels[:0]
+
+        new = np.setdiff1d(labels, self.labels)
+
+        if len(new):
+            #Room for the new stimuli, keeping the labels sorted
+            pos = np.searchsorted(self.labels, new)
+            typ = np.result_type(self.labels, new) #Labels are never truncated
+
+            self.labels = np.insert(self.labels.astype(typ), pos, new)
+            self.count  = np.insert(self.count,  pos, 0)
+            self.mean   = np.insert(self.mean,   pos, 0, axis = 0)
+            self._M2    = np.insert(self._M2,    pos, 0, axis = 0)
+
+        return np.searchsorted(self.labels, labels)
+
+
+def stimEpochs(D, frames, seqRange, dtype = np.float32):
+    ''' 
+    Extracts the time points around every stimulation for all units with a 
+    single gather. A sliding window view of D (no copy) is indexed at the 
+    stimulation frames, and the before and after ranges of seqRange are 
+    picked inside the windows in the same operation. 
+
+    ________________________________________________________________________
+
+                                   ARGUMENTS
+    ________________________________________________________________________
+
+
+    D        : Data of size [N x T], where N is number of units and T is 
+               time of serie (array or h5Sessions)
+    frames   : Frame of each stimulation
+    seqRange : List of 2 lists, the range before stimulation ( [t-u, t-v[ ) 
+               and the range after stimulation ( [t+x, t+y[ ).
+    dtype    : Type of the returned epochs
+
+    ________________________________________________________________________
+
+                                    RETURNS
+    ________________________________________________________________________
+
+
+    epochs : Epochs of size [N x nStim x seqLen]
+
+    ________________________________________________________________________
+
+    '''
+
+    frames  = np.int64(np.ravel(frames))
+
+    #Time points to keep relative to the stimulation frame
+    offsets = np.hstack([ np.arange(seqRange[0][0], seqRange[0][1]),
+                          np.arange(seqRange[1][0], seqRange[1][1]) ]).astype(np.int64)
+
+    first = offsets.min()            #First time point of windows
+    span  = offsets.max() - first + 1 #Lenght of windows
+
+    N, T  = D.shape
+    nWin  = T - span + 1 #Number of windows
+
+    if len(frames) and ( (frames + first).min() < 0 or (frames + first).max() >= nWin ):
+        raise ValueError('Stimulation epochs (seqRange = {}) '.format(seqRange) +
+                         'need to be inside the {} frames of the data.'.format(T))
+
+    if isinstance(D, h5Sessions):
+        #Lazy dataset, only the frames of the epochs are read
+        idx = (frames + first).reshape(-1,1) + (offsets - first).reshape(1,-1)
+        return D.take(idx).reshape(N, len(frames), -1).astype(dtype, copy = False)
+
+    #Sliding windows view (N x nWin x span)
+    W = np.lib.stride_tricks.as_strided(D, shape   = (N, nWin, span), 
+                                           strides = (D.strides[0],) + (D.strides[1],)*2 )
+
+    #Single gather of all stimulations and time points
+    epochs = W[:, (frames + first).reshape(-1,1), (offsets - first).reshape(1,-1)]
+
+    return epochs.astype(dtype, copy = False)
+
+
+class stimIndex(object):
+    ''' 
+    Index of the stimulations, built once from stimIdx. Holds the sparse 
+    incidence matrix of the cells stimulated by each stimulation, in CSR 
+    format by cell, so the stimulations of any cell are a slice of a single
+    array. Stimulations of several cells at once are entries of each of 
+    these cells.
+
+    ________________________________________________________________________
+
+                                   ARGUMENTS
+    ________________________________________________________________________
+
+
+    stimIdx : Index of the cells stimulated (1 to N) by each stimulation 
+              (nS x nCells per stimulation). Other values (e.g. 0) are 
+              ignored.
+
+    ________________________________________________________________________
+
+                                   ATTRIBUTES
+    ________________________________________________________________________
+
+
+    nS        : Number of stimulations
+    incidence : Whether cell c was stimulated by stimulation s, sparse 
+                matrix of size (max cell + 1) x nS
+    cells     : Stimulated cells (sorted)
+    counts    : Number of stimulations of each cell (max cell + 1)
+
+    ________________________________________________________________________
+
+    '''
+
+    def __init__(self, stimIdx):
+
+        I       = np.reshape(stimIdx, [len(stimIdx), -1])
+        self.nS = I.shape[0]
+
+        #(cell, stimulation) of each entry, a cell counted once per stimulation
+        stim, col = np.nonzero(I > 0)
+        cell      = np.int64(I[stim, col])
+        nC        = cell.max()+1 if len(cell) else 1
+        entries   = np.unique(cell*self.nS + stim)            #Sorted by cell, then stimulation
+        entries   = np.stack([entries//self.nS, entries%self.nS], axis = 1)
+
+        self.incidence = sparse.csr_matrix( (np.ones(len(entries), dtype = bool), 
+                                             (entries[:,0], entries[:,1])), 
+                                             shape = (nC, self.nS) )
+        self.incidence.sort_indices()
+
+        self.counts = np.diff(self.incidence.indptr)
+        self.cells  = np.nonzero(self.counts)[0]
+        self._label = {}
+
+
+    def trials(self, cell):
+        ''' Stimulations of cell (sorted), as a read-only view of the index '''
+
+        if not 0 <= cell < len(self.counts):
+            return self.incidence.indices[:0]
+
+        M = self.incidence
+        T = M.indices[M.indptr[cell]:M.indptr[cell+1]]
+        T.flags.writeable = False
+        return T
+
+
+    def labels(self, cell):
+        ''' Whether cell was stimulated (True) or not (False) for each 
+            stimulation, built once per cell. The labels are shared by all
+            the users of the index, so they are read-only. '''
+
+        if cell not in self._label:
+            label = np.zeros(self.nS, dtype = bool)
+            label[self.trials(cell)] = True
+            label.flags.writeable = False
+            self._label[cell] = label
+
+        return self._label[cell]
+
+
+def stimResponse(data, frames, cells, nf = 12, nfb = 1, nAll = None, chunk = None, 
+                 norm = True, out = None):
+    ''' 
+    Calcium responses around the stimulations (see calcResponse), with the 
+    stimulations sorted by stimulated cell using the stimulation index of 
+    cells (see cachedStimIndex), which is only built once for the same 
+    stimulations. The windows of a chunk of 
+    stimulations are extracted with a single gather (see stimEpochs) and 
+    the control responses are summed per stimulated cell with np.add.at. 
+    With chunk, at most chunk stimulations are held in memory at once, and
+    allS (the only output growing with nAll x N) can be written in out 
+    (e.g. a memory-mapped array) one chunk at a time.
+
+    ________________________________________________________________________
+
+                                   ARGUMENTS
+    ________________________________________________________________________
+
+
+    data   : Dataset containing optogenetic stimulation (N x T)
+    frames : Frame of each stimulation
+    cells  : Stimulated cell of each stimulation (1 to nStimCell)
+    nf     : Number of frames to keep after stimulation  
+    nfb    : Number of frames before stimulation
+    nAll   : Number of stimulations kept in allS (all if None)
+    chunk  : Number of stimulations extracted at once (all if None)
+    norm   : If each response is normalized by its mean absolute value
+    out    : Output array of allS, of size nAll*N x tnf (allocated if None)
+
+    ________________________________________________________________________
+
+                                    RETURNS
+    ________________________________________________________________________
+
+
+    trig: Invididual cells repsonse when directly stimulated (nStim x tnf)
+    ctrl: Average cells response when other cells are stimulated 
+          (nStimCell x tnf)
+    allS: Individual cells response when stimulation of any other cell
+          (nAll*N x tnf, N rows per stimulation)
+
+    ________________________________________________________________________
+
+    '''
+
+    nfb = nfb - 1 #correct for python indexing
+    tnf = nf+nfb  #total number of frames
+
+    N      = data.shape[0]
+    frames = np.int64(np.ravel(frames))
+    cells  = np.ravel(cells)
+
+    #Stimulations of each stimulated cell (one stimulation per entry of cells)
+    index = cachedStimIndex(cells.reshape(-1,1))
+
+    nStim     = len(frames)
+    nStimCell = len(index.cells) # Number of cells that are stimulated
+    nAll      = nStim if nAll is None else min(nAll, nStim)
+    chunk     = nStim if chunk is None else chunk
+
+    #Ordering stimulation frames based on neuron number 
+    ordStim = index.incidence.indices
+    cellIdx = np.repeat(np.arange(len(index.counts)), index.counts) - 1 #Stimulated cell (python index)
+
+    #Initialization
+    trig  = np.zeros([nStim,tnf])     # Activity when stimulated
+    total = np.zeros([nStimCell,tnf]) # Summed activity over all stimulations
+    own   = np.zeros([nStimCell,tnf]) # Summed activity when stimulated
+    dtype = data.dtype if not norm or np.issubdtype(data.dtype, np.floating) else np.float64
+    allS  = np.zeros([nAll*N,tnf], dtype = dtype) if out is None else out
+
+    for c in range(0, nStim, chunk):
+        s = np.arange(c, min(c+chunk, nStim))
+
+        #Frames from nfb before to nf after the stimulation ( N x len(s) x tnf )
+        E = stimEpochs(data, frames[ordStim[s]], [[0,0],[-nfb,nf]], dtype = np.float64)
+
+        trig[s] = E[cellIdx[s], np.arange(len(s))]
+
+        #Control of each cell is its summed activity minus when stimulated
+        total += E[:nStimCell].sum(axis = 1)
+        np.add.at(own, cellIdx[s], trig[s])
+
+        k = s[s < nAll]
+        if len(k):
+            A = E[:, :len(k)].transpose(1,0,2).reshape(-1,tnf)
+            allS[k[0]*N:(k[-1]+1)*N] = _rowNorm(A) if norm else A
+
+    #Taking the mean
+    nCtrl = nStim - index.counts[1:nStimCell+1]
+    ctrl  = (total - own) / nCtrl.reshape(-1,1)
+
+    if norm:
+        #Normalizing for each trial (allS by chunks above)
+        trig, ctrl = _rowNorm(trig), _rowNorm(ctrl)
+
+    return trig, ctrl, allS
+
+
+def _rowNorm(X):
+    ''' Each row of X divided by its mean absolute value '''
+
+    return X / np.mean(np.abs(X), axis = 1, keepdims = True)
+
+
+def stim_nstim_split(data, frameSet, generator = False):
     '''
         Will split the stimulation part ([-1 frame,stimulation,+1 frame])
         from the non-stimulation part (frames non present in the stimulation section)
         and concatenate the segments.
 
+        The bounds of all the segments are computed at once and each part 
+        is extracted with a single indexing of data. If generator, the 
+        (non-stimulation, stimulation) segments of each stimulation are 
+        yielded instead as views of data, without concatenating them.
+
     '''
 
-    N = data.shape[0]
-    
-    data_nstim = np.zeros([N,0]) # All the data after and between stimulations ( ]-1,stim,+1[ )
-    data_stim  = np.zeros([N,0]) # All the data immediately before (-1)
+    T      = data.shape[1]
+    frames = np.int64([f[0] for f in frameSet]) # Frame of each stimulation
 
-    nStims = len(frameSet) # Number of frames of stimulations
+    #Bounds of the data after and between stimulations ( ]-1,stim,+1[ ),
+    #the next 12 time points after the last stimulation
+    nstimB = np.stack([ frames+2, np.append(frames[1:]-1, frames[-1:]+15) ], axis = 1)
 
-    for i in range(nStims):
-        frames = [f[0] for f in frameSet[i:i+2][:]] # Current and +1 frames
+    #Bounds of the stimulation periods ( 3 frames ; -1:stim:+1 )
+    stimB  = np.stack([ frames-1, frames+2 ], axis = 1)
 
-        if i != nStims-1:
-            data_nstim = np.hstack( [data_nstim, data[:,frames[0]+2:frames[1]-1]] )
-        else:
-            #If last frame, will take the next 12 time points
-            data_nstim = np.hstack( [data_nstim, data[:,frames[0]+2:frames[0]+15]] )
-            
-        # Stimulation period ( 3 frames ; -1:stim:+1 )
-        data_stim = np.hstack( [data_stim, data[:,frames[0]-1:frames[0]+2]] )
-    return data_nstim, data_stim
+    #Same bounds as slicing data (negative bounds count from the end)
+    nstimB = _sliceBounds(nstimB, T); stimB = _sliceBounds(stimB, T)
+
+    if generator:
+        return _stimSegments(data, nstimB, stimB)
+
+    return data[:, _segmentIdx(nstimB)], data[:, _segmentIdx(stimB)]
+
+
+def _segmentIdx(bounds):
+    ''' Concatenated time points of the segments [start, stop[ of bounds '''
+
+    n      = np.maximum(bounds[:,1] - bounds[:,0], 0) #Lenght of segments
+    starts = np.repeat(bounds[:,0] - np.cumsum(n) + n, n)
+
+    return starts + np.arange(n.sum())
+
+
+def _sliceBounds(bounds, T):
+    ''' Bounds of a slice [start:stop] of T elements as python resolves them,
+        a negative bound counting from the end '''
+
+    bounds = np.where(bounds < 0, bounds + T, bounds)
+
+    return np.clip(bounds, 0, T)
+
+
+def _stimSegments(data, nstimB, stimB):
+    ''' Non-stimulation and stimulation segments of each stimulation (views) '''
+
+    for (a, b), (c, d) in zip(nstimB, stimB):
+        yield data[:, a:max(a,b)], data[:, c:d]
 
 
 def varInit(dim, Wname, ortho = False, train = True, std = None):